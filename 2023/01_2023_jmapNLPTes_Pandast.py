@@ -9,541 +9,470 @@
 ## "-//NLM/DTD Journal Archiving and interchange DTD v2.2 20060430//EN
 ## "-//NLM//DTD Journal Publishing DTD v3.0 20080202//EN"
 ##
+## Usage:
+##     python 01_2023_jmapNLPTes_Pandast.py [--config settings.json] [--start-dir DIR] [--out-dir DIR]
+##                                          [--parsers a,b] [--format csv] [--fresh] [--shard i/N]
+##     python 01_2023_jmapNLPTes_Pandast.py merge [--config settings.json] [--out-dir DIR] [--shards N]
+## Anything not given on the command line or in the config file is as set below.
+## Each --shard i/N run can go on its own machine; merge then builds the usual
+## output files in outDir from all N of them (see jmapShard.py).
+##
 ## External Dependencies
-##     BeautifulSoup4
+##     lxml (BeautifulSoup4 for the old "soup" extractor)
 ##     Pandas
+##     requests
+##     pyarrow (only for the "parquet" and "arrow" locations formats)
 #####################################################################################
 
-import os, sys, re, io
-import fnmatch
-import unicodecsv, csv
-import requests, json, time
+import os, sys
+import fnmatch, shutil, argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import unicodecsv
+import json, time
 
-from decimal import Decimal, setcontext, ExtendedContext
 from datetime import datetime
-from bs4 import BeautifulSoup
-from bs4 import UnicodeDammit
 
 import pandas as pd
 
-geoparser = "spacy-lg" # Which NLP parser to use: "spacy-lg", "spacy-trf", "mordecai", "stanza", "locatext", "nltk"
+from jmapClient import GeoClient, endpoints, baseURL
+from jmapCache import ResponseCache
+from jmapGazetteer import GazetteerClient
+from jmapExtract import extractLogged, articleSections
+from jmapLog import ParseLog
+from jmapManifest import RunManifest, appendDurably
+from jmapPipeline import Pipeline
+from jmapRelevance import SectionFilter
+from jmapSnapshot import CorpusSnapshot
+from jmapStore import ResultsStore, articleRecord, responseLocations
+from jmapShard import parseShard, inShard, shardDir, countShards, mergeShards
+from jmapWriter import LocationsWriter, extensions, locationsHeader, articleFrame, articleFields
+from jmapToponyms import ToponymMemo, mentionFields
+
+# Which NLP parsers to use: "spacy-lg", "spacy-trf", "mordecai", "stanza", "nltk" ("locatext" is not hooked up),
+# or "gazetteer", a local lookup of GeoNames place names that needs no network (see gazetteerFile).
+# Each article is read once and its text sent to all of them in parallel.
+geoparsers = ["spacy-lg"]
+longFormat = False # Write one locations_all_2023.csv with a parser column (True) or one locations file per parser (False)?
 
 startDir = 'C:/Users/bgodfrey/Documents/GitHub/Placenames/XML/PLOSOne'
 outDir = 'C:/Users/bgodfrey/Documents/GitHub/Placenames/2023'
-articlesFile = outDir + '/articles_' + geoparser + '_2023.csv'
-locationsFile = outDir + '/locations_' + geoparser + '_2023.csv'
-logFile = outDir + '/jmap_parse_' + geoparser + '_2023.log'
 
-#articlesFile = outDir + '/articles_mordecai_2023.csv'
-#locationsFile = outDir + '/locations_mordecai_2023.csv'
-#logFile = outDir + '/jmap_parse_mordecai_2023.log'
+# Locations output: "csv" (the original table), or a typed "parquet" or "arrow" dataset
+# directory with float lat/lon columns for every parser (see jmapWriter.py)
+locationsFormat = "csv"
+# Compact locations CSV: each distinct place name a parser resolves is stored once, in
+# toponyms_<parser>_2023.csv, and the locations rows just carry its toponym_id and the
+# mention's start_char/end_char (True), instead of repeating names and coordinates (False)
+toponymMemo = False
+# Also write each article and the locations every parser found in it to this SQLite results
+# store (see jmapStore.py), which any number of runs can share ('' for none)
+storeFile = ''
+# Write everything the run does, as it happens, to jmap_parse_<parser>_2023.events.jsonl,
+# one JSON object per line: per-article stage times, every geoparser request's latency
+# and size, retries and messages
+writeEvents = True
+
+# Pick up where the last run left off: only parse articles that are new, have changed or
+# failed last time, appending to the existing output (False deletes it and starts over)
+resume = True
+
+cacheFile = outDir + '/geoparse_cache.sqlite' # Persistent cache of geoparser responses ('' to disable)
+cacheMaxBytes = 2 * 1024**3 # Evict least recently used responses beyond this size
+offline = False # Only answer from the response cache, never touch the network
+# Where the geoparser API is; each parser is at apiURL + parser. Point it at jmapMockServer.py
+# (e.g. http://127.0.0.1:8765/api/) to run the whole pipeline without the network
+apiURL = baseURL
+
+gazetteerFile = outDir + '/allCountries.txt' # GeoNames dump for the "gazetteer" parser
+gazetteerMinPopulation = 1000 # Leave out populated places smaller than this
+
+xmlExtractor = "lxml" # How to read the XML: "lxml" (single streaming pass) or "soup" (the old BeautifulSoup tree)
+extractWorkers = os.cpu_count() or 1 # Processes reading XML in parallel (1 to read in a thread of this process)
+# Keep every article as extracted in corpus_snapshot.bin, and read it from there in later
+# runs instead of parsing its XML again, for as long as the file is unchanged (see jmapSnapshot.py)
+useSnapshot = True
+# Articles go through the run in stages joined by bounded queues: the XML walk, extraction,
+# geoparsing and writing. While one article is written, the next ones are being read and
+# their geoparser requests are in flight.
+geoparseWorkers = 4 # Articles whose geoparser requests can be in flight at once
+pipelineWindow = 32 # Most articles anywhere between the XML walk and the writer at once
+
+# Leave out sections that cannot hold a study location (statistics, funding, acknowledgments...)
+# instead of geoparsing them, and, above 0, sections whose lexical score is below
+# relevanceMinScore (see jmapRelevance.py for what each setting costs in accuracy)
+sectionFilter = True
+relevanceMinScore = 0.0
 
 collectionKeyword = "" # Add special keyword for organizing into a collection
 allArticles = True  # Include all articles (True) or only articles that have parsed locations in the output (False)?
 
-
-class UnicodeWriter(object):
-    """
-    Like UnicodeDictWriter, but takes lists rather than dictionaries.
-    
-    Usage example:
-    
-    fp = open('my-file.csv', 'wb')
-    writer = UnicodeWriter(fp)
-    writer.writerows([
-        [u'Bob', 22, 7],
-        [u'Sue', 28, 6],
-        [u'Ben', 31, 8],
-        # \xc3\x80 is LATIN CAPITAL LETTER A WITH MACRON
-        ['\xc4\x80dam'.decode('utf8'), 11, 4],
-    ])
-    fp.close()
-    """
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = io.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoding = encoding
-    
-    def writerow(self, row):
-        # Modified from original: now using unicode(s) to deal with e.g. ints
-        self.writer.writerow([unicode(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = data.encode(self.encoding)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-    
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
-
-class ParseLog(object):
-    def __init__(self):
-        self.messages = []
-        self.countArticles = 0
-        self.countGeoTagged = 0
-        self.locations = 0
-        self.countErrors = 0
-        self.countNoAuthors = 0
-        self.countArticlesWritten = 0
-    
-    def add_msg(self, msg):
-        self.messages.append(msg)
-
-class Article(object):
-    
-    def __init__(self, doi, title, year):
-        self.doi = doi
-        self.title = title
-        self.year = year
-        
-        # Set the remaining attributes to blank
-        self.no_keywords = False
-        self.no_abstract = False
-        self.url = ''
-        self.publisher_abbreviation = ''
-        self.publisher_name = ''
-        self.citation = ''
-        self.first_author = ''
-        self.volume_issue_pages = ''
-        self.volume = ''
-        self.issue = ''
-        self.start_page = ''
-        self.end_page = ''
-        self.abstract = ''
-        self.authors = []
-        self.keywords = []
-        self.body = ''
-        
-    def add_author(self, author):
-        if not author in self.authors:
-            self.authors.append(author)
-    
-    def add_keyword(self, keyword):
-        if not keyword in self.keywords:
-            self.keywords.append(keyword)
-
-    def format_authors(self):
-        author_string = ''
-        for author in self.authors:
-            author_string = author_string + ', ' + author
-        return author_string[2:]
-
-    def format_keywords(self):
-        kw_string = ''
-        for kw in self.keywords:
-            kw_string = kw_string + ', ' + kw
-        return kw_string[2:]
-
-    def format_volisspg(self):
-        #Must have a volume     
-        # check for issue
-        if self.issue: istring = "(" + str(self.issue) + ")"
-        else: istring = ''
-        # Check for pages
-        if self.end_page: pgstring = "-"+str(self.end_page)
-        else: pgstring = ""
-        if self.start_page: pgstring = ":" + str(self.start_page) + pgstring
-        vip = str(self.volume) + istring + pgstring
-        return vip
-
-    def build_citation(self):
-        citation = self.format_authors() + ". " + str(self.year) +". " + self.title + ". " + self.publisher_name + ". "
-        self.citation = citation
-        return citation
-
-
+# Only parse shard i of N, (i, N), writing to its own directory under outDir (see jmapShard.py)
+shard = None
+
+# The settings above that a --config file (JSON, {"name": value, ...}) can set
+configNames = ['geoparsers', 'longFormat', 'startDir', 'outDir', 'locationsFormat', 'toponymMemo', 'storeFile',
+               'writeEvents', 'resume', 'cacheFile', 'cacheMaxBytes', 'offline', 'apiURL', 'gazetteerFile', 'gazetteerMinPopulation',
+               'xmlExtractor', 'extractWorkers', 'useSnapshot', 'geoparseWorkers', 'pipelineWindow', 'sectionFilter',
+               'relevanceMinScore', 'collectionKeyword', 'allArticles']
+
+def setPaths():
+    # Work out the output file names from the settings
+    global runDir, outputs, runName, articlesFiles, locationsExt, locationsFiles, toponymsFiles
+    global logFile, eventsFile, manifestFile, snapshotFile
+    runDir = shardDir(outDir, shard) if shard else outDir
+    # Output files are keyed by parser, or by 'all' when writing the long format table
+    outputs = ['all'] if longFormat else geoparsers
+    runName = geoparsers[0] if len(geoparsers) == 1 else 'all'
+    articlesFiles = dict((o, runDir + '/articles_' + o + '_2023.csv') for o in outputs)
+    locationsExt = '.csv' if locationsFormat == "csv" else extensions[locationsFormat]
+    locationsFiles = dict((o, runDir + '/locations_' + o + '_2023' + locationsExt) for o in outputs)
+    toponymsFiles = dict((o, runDir + '/toponyms_' + o + '_2023.csv') for o in outputs)
+    logFile = runDir + '/jmap_parse_' + runName + '_2023.log'
+    eventsFile = runDir + '/jmap_parse_' + runName + '_2023.events.jsonl' if writeEvents else ''
+    manifestFile = runDir + '/manifest_' + runName + '_2023.csv'
+    snapshotFile = runDir + '/corpus_snapshot.bin' if useSnapshot else ''
+
+setPaths()
+
+def configure(settings, shardSpec=None):
+    # Apply settings by name (from a config file or the command line) and work out the
+    # file names again; the files that live in outDir by default follow it
+    global shard
+    unknown = [k for k in settings if k not in configNames]
+    if unknown:
+        sys.exit("Unknown setting(s): " + ", ".join(unknown) + ". These can be set: " + ", ".join(configNames))
+    g = globals()
+    if 'outDir' in settings:
+        for name, fileName in (('cacheFile', '/geoparse_cache.sqlite'), ('gazetteerFile', '/allCountries.txt')):
+            if name not in settings and g[name] == outDir + fileName:
+                settings[name] = settings['outDir'] + fileName
+    g.update(settings)
+    shard = shardSpec
+    setPaths()
+
+def commandLine(argv):
+    ap = argparse.ArgumentParser(description="Parse a directory of publisher XML files for JournalMap. "
+                                 "Settings not given here are the ones at the top of this script.")
+    ap.add_argument("command", nargs="?", default="parse", choices=["parse", "merge"],
+                    help="parse XML (default), or merge the output of a sharded run into outDir")
+    ap.add_argument("--config", help="JSON file of settings, by the names at the top of this script")
+    ap.add_argument("--start-dir", dest="startDir")
+    ap.add_argument("--out-dir", dest="outDir")
+    ap.add_argument("--parsers", help="comma separated, e.g. spacy-lg,nltk")
+    ap.add_argument("--format", dest="locationsFormat", choices=["csv", "parquet", "arrow"])
+    ap.add_argument("--workers", dest="extractWorkers", type=int, help="XML extraction processes")
+    ap.add_argument("--fresh", action="store_true", help="delete earlier output and start over (resume = False)")
+    ap.add_argument("--offline", action="store_true", default=None, help="only answer from the response cache")
+    ap.add_argument("--api-url", dest="apiURL", help="geoparser API, e.g. http://127.0.0.1:8765/api/ for jmapMockServer.py")
+    ap.add_argument("--shard", help="i/N: parse only shard i (0 to N-1) of N, into outDir/shard_<i>_of_<N>")
+    ap.add_argument("--shards", type=int, help="merge: how many shards (default: as many as outDir has)")
+    args = ap.parse_args(argv)
+
+    settings = {}
+    if args.config:
+        with open(args.config) as f:
+            settings.update(json.load(f))
+    for name in ('startDir', 'outDir', 'locationsFormat', 'extractWorkers', 'offline', 'apiURL'):
+        if getattr(args, name) is not None: settings[name] = getattr(args, name)
+    if args.parsers: settings['geoparsers'] = args.parsers.split(',')
+    if args.fresh: settings['resume'] = False
+    try:
+        configure(settings, parseShard(args.shard) if args.shard else None)
+    except ValueError as inst:
+        ap.error(str(inst))
+    return args
+
+def mergeRun(n):
+    # Build the canonical output in outDir from the n shards of a sharded run
+    name = os.path.basename
+    tables = [name(f) for f in list(articlesFiles.values()) + list(locationsFiles.values()) + [manifestFile]]
+    pairs = [(name(locationsFiles[o]), name(toponymsFiles[o])) for o in outputs] if toponymMemo else []
+    logs = [name(logFile)] + ([name(eventsFile)] if eventsFile else [])
+    try:
+        merged = mergeShards(outDir, n, tables, pairs, logs)
+    except ValueError as inst:
+        sys.exit(str(inst))
+    print("Merged " + str(n) + " shards into:")
+    for f in merged: print("    " + f)
+
+
+def walkXML(startDir):
+    # Every XML file under startDir, in a stable (sorted) order
+    for root, dirs, files in os.walk(startDir):
+        dirs.sort()
+        for name in sorted(fnmatch.filter(files, '*.xml')):
+            yield os.path.join(root, name)
+
+def pendingXML(xmlFiles, manifest, parsers, log):
+    # The files that at least one parser still has to do
+    for xmlFile in xmlFiles:
+        if any(manifest.needs(xmlFile, p) for p in parsers):
+            yield xmlFile
+        else:
+            log.countUnchanged += 1
+
+def extractJob(xmlFile, pool=None, corpus=None):
+    # Pipeline stage: (xmlFile, article, sections, log) for a file, from the corpus snapshot
+    # if it has the file as it is now, otherwise read in pool if there is one (and snapshotted)
+    got = corpus.load(xmlFile) if corpus is not None else None
+    if got is not None:
+        return (xmlFile,) + got
+    if pool is None:
+        got = extractLogged(xmlFile, collectionKeyword, xmlExtractor)
+    else:
+        got = pool.submit(extractLogged, xmlFile, collectionKeyword, xmlExtractor).result()
+    if corpus is not None and got[0] is not None:
+        corpus.add(xmlFile, got[0], got[1])
+    return (xmlFile,) + got
+
+def geoparseJob(job, clients, manifest):
+    # Pipeline stage: send an article's texts to every parser that still needs it and wait
+    # for the answers, adding (sections, {parser: responses or the exception}) to the job
+    xmlFile, article, secs, alog = job
+    if article is None: return job + (None, {})
+    # The title, abstract and each section's own text; every parser gets the same text
+    sections = articleSections(article, secs)
+    if sectionFilter:
+        relevance = SectionFilter(minScore=relevanceMinScore)
+        sections = relevance.filter(sections)
+        alog.countSectionsSkipped += relevance.countSkipped
+        alog.charsSkipped += relevance.charsSkipped
+    texts = [secText for level, secTitle, secPath, secText in sections]
+    todo = [p for p in geoparsers if manifest.needs(xmlFile, p)]
+    results = {}
+    with alog.timed('geoparse'):
+        # Queue the requests for all parsers before waiting on any of them
+        pending = dict((p, clients[p].submit_many(texts)) for p in todo)
+        for p in todo:
+            try:
+                results[p] = [f.result() for f in pending[p]]
+            except Exception as inst:
+                for f in pending[p]: f.cancel()
+                results[p] = inst
+    return job + (sections, results)
+
+def outputKey(parser):
+    return 'all' if longFormat else parser
 
 def writeLocationsHeader(headerString, f):
     with open(f, "wb") as locationsCSV:
         locationWriter = unicodecsv.writer(locationsCSV)
         locationWriter.writerows(headerString)
 
-#start logging
-log = ParseLog()
-lf = open(logFile,"w")
-lf.write("Starting processing of "+startDir+" on "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')+"\n")
-
-# delete the locations file if it exists
-try:
-    os.remove(locationsFile)
-except OSError:
-    pass
-
-# open/create the articles file and set header rows
-with open(articlesFile, 'wb') as articlesCSV:
-        articleWriter = unicodecsv.writer(articlesCSV)
+# The run itself. Guarded so that extraction worker processes, which import
+# this module on Windows, don't start a run of their own.
+if __name__ == "__main__":
+    args = commandLine(sys.argv[1:])
+    if args.command == "merge":
+        n = args.shards or countShards(outDir)
+        if not n: sys.exit("No shard output in " + outDir + " (or shards of different runs); give --shards N")
+        mergeRun(n)
+        sys.exit(0)
+    os.makedirs(runDir, exist_ok=True)
+
+    #start logging
+    log = ParseLog(eventsFile or None)
+    log.event("start", startDir=startDir, geoparsers=geoparsers, resume=resume, shard=shard)
+    lf = open(logFile,"w")
+    lf.write("Starting processing of "+startDir+" on "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')+"\n")
+
+    unknown = [p for p in geoparsers if p not in endpoints and p != 'gazetteer']
+    if unknown:
+        sys.exit("I don't know what to do with geoparser(s): " + ", ".join(unknown))
+    if toponymMemo and locationsFormat != "csv":
+        sys.exit("toponymMemo is for the CSV locations format; the typed formats already store coordinates compactly.")
+
+    # one pooled client per parser for the whole run; they rate-limit requests
+    # themselves, so the old time.sleep(1) between articles is gone
+    cache = ResponseCache(cacheFile, cacheMaxBytes) if cacheFile else None
+    clients = dict((p, GeoClient(p, url=apiURL.rstrip('/') + '/' + p, cache=cache, offline=offline, log=log))
+                   for p in geoparsers if p in endpoints)
+    if 'gazetteer' in geoparsers:
+        clients['gazetteer'] = GazetteerClient(gazetteerFile, minPopulation=gazetteerMinPopulation)
+
+    # Starting over: delete the output and manifest from earlier runs
+    if not resume:
+        for f in list(articlesFiles.values()) + list(locationsFiles.values()) + list(toponymsFiles.values()) + [manifestFile]:
+            try:
+                if os.path.isdir(f): shutil.rmtree(f)
+                else: os.remove(f)
+            except OSError:
+                pass
+
+    # Drop rows left by articles that were half written or have changed since,
+    # they get parsed again below
+    manifest = RunManifest(manifestFile)
+    store = ResultsStore(storeFile) if storeFile else None
+    for p in geoparsers:
+        o = outputKey(p)
+        dropped = manifest.purge(p, [locationsFiles[o], articlesFiles[o]])
+        if dropped: log.add_msg("Removed " + str(dropped) + " stale " + p + " rows from " + o + " output.")
+
+    # create the locations files with their header rows
+    locationsHeaders = {}
+    locationsWriters = {}
+    memos = {}
+    for o in outputs:
+        if toponymMemo:
+            memos[o] = ToponymMemo(toponymsFiles[o])
+            locationsHeaders[o] = articleFields + mentionFields
+        else:
+            locationsHeaders[o] = locationsHeader(geoparsers if longFormat else [o])
+        if locationsFormat != "csv":
+            locationsWriters[o] = LocationsWriter(locationsFiles[o], locationsFormat)
+        elif not os.path.isfile(locationsFiles[o]):
+            writeLocationsHeader([locationsHeaders[o]], locationsFiles[o])
+        elif pd.read_csv(locationsFiles[o], nrows=0).columns.tolist() != locationsHeaders[o]:
+            sys.exit(locationsFiles[o] + " has different columns to this run. Set resume = False to start over.")
+
+    # open/create the articles files and set header rows
+    with contextlib.ExitStack() as stack:
+        articleHandles = {}
+        articleWriters = {}
         articlelines = [['doi','publisher_name','publisher_abbreviation','citation','title','publish_year','first_author','authors_list','volume_issue_pages','volume','issue','start_page','end_page','keywords_list','no_keywords_list','abstract','no_abstract','url']]
-        articleWriter.writerows(articlelines)    
+        for o in outputs:
+            articleHandles[o] = stack.enter_context(open(articlesFiles[o], 'ab'))
+            articleWriters[o] = unicodecsv.writer(articleHandles[o])
+            if articleHandles[o].tell() == 0: articleWriters[o].writerows(articlelines)
     
     
-        # Traverse the start directory structure
-        for root, dirs, files in os.walk(startDir):
-            for name in fnmatch.filter(files, '*.xml'):
+        # Traverse the start directory structure. XML is read and geoparsed in the
+        # pipeline's threads (and extraction processes); articles come back in walk
+        # order and everything is written from here.
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=extractWorkers)) if extractWorkers > 1 else None
+        xmlFiles = inShard(walkXML(startDir), shard) if shard else walkXML(startDir)
+        pipe = Pipeline(pendingXML(xmlFiles, manifest, geoparsers, log), window=pipelineWindow)
+        corpus = CorpusSnapshot(snapshotFile, collectionKeyword) if snapshotFile else None
+        if corpus is not None: stack.callback(corpus.close)
+        pipe.stage('extract', lambda xmlFile: extractJob(xmlFile, pool, corpus), workers=extractWorkers)
+        pipe.stage('geoparse', lambda job: geoparseJob(job, clients, manifest), workers=geoparseWorkers)
+        stack.enter_context(pipe)
+        for xmlFile, article, secs, alog, sections, results in pipe:
+                name = os.path.basename(xmlFile)
+                log.merge(alog)
+                for msg in alog.messages: print(msg)
+                todo = list(results) if article is not None else [p for p in geoparsers if manifest.needs(xmlFile, p)]
+                if article is None:
+                    for p in todo: manifest.record(xmlFile, p, '', 'failed' if alog.countErrors else 'skipped')
+                    log.end_article(xmlFile, status='skipped')
+                    continue
+                for p in todo: manifest.record(xmlFile, p, article.doi, 'started')
+
                 ###############################
-                ## Grab the article XML file ##
-                ############################### 
-                xmlFile = os.path.join(root,name)
-                print("Processing " + xmlFile)
-                log.add_msg("Processing " + xmlFile)
-                log.countArticles += 1
-                
+                ## write the locations the   ##
+                ## parsers found to CSV      ##
                 ###############################
-                ## Grab the article metadata ##
-                ###############################        
-    
-                # Read the XML
-                f = open(xmlFile, encoding='utf-8')
-                #xmlStr = UnicodeDammit(f.read())
-                tree = BeautifulSoup(f.read(),"lxml")
-                #rawtext = UnicodeDammit.detwingle(f.read())
-                #tree = BeautifulSoup(rawtext.decode("utf-8",'ignore'),'xml')
-                f.close()
-                #print(tree.prettify())
-
-                #############################################
-                ## Process NLM or JATS-formatted XML files ##
-                #############################################                
-                if tree.find('front'):  # NLM or JATS formatted XML
-                    fmt = "NLM"
-                    # Read the first three elements and create the article object
-                    try: doi = tree.front.find('article-id', {'pub-id-type':'doi'}).text.strip() 
-                    except: doi=''
-                    try: title = tree.front.find('article-title').text.strip()
-                    except: title=''
-                    try: year = tree.front.find('pub-date').year.text.strip()
-                    except: year = ''
-        
-                    article = Article(doi, title, year)
-        
-                    # Add the other single item attributes
-                    try: article.publisher_name = tree.front.find('journal-title').text
-                    except: article.publisher_name = ''            
-                    
-                    try: article.volume = tree.front.find('volume').text
-                    except: article.volume = ''
-                    
-                    try: article.issue = tree.front.find('issue').text
-                    except: article.issue = ''
-                    
-                    try: article.start_page = tree.front.find('fpage').text
-                    except:
-                        try: article.start_page = tree.front.find('elocation-id').text
-                        except: article.start_page = ''
-                        
-                    try: article.end_page = tree.front.find('lpage').text
-                    except: article.end_page = ''
-                    
+                articlelocs = {}
+                parsed = []
+                frames = {}
+                for p in todo:
+                    o = outputKey(p)
                     try:
-                        for a in tree.find_all('abstract'):
-                            if not a.get('abstract-type')=='precis':
-                                article.abstract = a.text
+                        print("Parsed " + str(len(sections)) + " sections with " + p + "...")
+                        rjsons = results[p]
+                        if isinstance(rjsons, Exception): raise rjsons
+                        with log.timed('frames'):
+                            if toponymMemo:
+                                rows = [[dict(zip(mentionFields, m)) for m in memos[o].mentions(p, rjson)] for rjson in rjsons]
                             else:
-                                article.abstract = ''
-                        if not article.abstract: article.no_abstract = True
-                    except: 
-                        article.abstract = ''
-                        article.no_abstract = True
-                    
-                    
-                    ###############################
-                    ## Build authors list        ##
-                    ############################### 
-                    try:
-                        for author in tree.find_all('contrib'):
-                            article.add_author(author.find('surname').text + ", " + author.find('given-names').text)
-                        if len(article.authors)==0: raise
-                    except:
-                        print ("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.add_msg("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.countNoAuthors += 1
-                        continue
-                    
-                    ###############################
-                    ## Build keywords list       ##
-                    ############################### 
-                    if tree.find('kwd'):
-                        for kw in tree.find_all('kwd'):
-                            article.add_keyword(kw.text)
-                    if collectionKeyword: article.add_keyword(collectionKeyword)    
-                    if not article.keywords: no_keywords = True
-
-                    ###############################
-                    ## Retrieve article body text #
-                    ###############################
-                    # this is a bit kludgy. The body text is located within <sec> tags, multiple <sec> 
-                    # tags need to be assembled to make up the body. However, each tag has lots of other 
-                    # tags within it, so we need to strip out all that garbage. Probably a more elegant/robust way to do this.
-                    body = ''
-                    for sec in tree.find_all('sec'):
-                        for s in sec.stripped_strings:
-                            s = s + ' '
-                            body += s
-                    article.body = body
-
-                ########################################
-                ## Process Elsevier XML files         ##
-                ########################################                
-                elif tree.find('coredata'):
-                    fmt = "Elsevier"
-                    meta = tree.find('coredata')
-                    print ('Elsevier formatted XML for' + xmlFile)
-                    # Read the first three elements and create the article object
-                    try: doi = tree.coredata.find('doi').text 
-                    except: doi=''
-                    try: title = tree.coredata.find('title').text
-                    except: title=''
-                    try: year = tree.coredata.find('coverDate').text[:4]
-                    except: year = ''
-        
-                    article = Article(doi, title, year)
-                    
-                    # Add the other single item attributes
-                    try: article.publisher_name = tree.coredata.find('publicationName').text
-                    except: article.publisher_name = ''            
-                    
-                    try: article.volume = tree.coredata.find('volume').text
-                    except: article.volume = ''
-                    
-                    try: article.issue = tree.coredata.find('issueIdentifier').text
-                    except: article.issue = ''
-                    
-                    try: article.start_page = tree.coredata.find('startingPage').text
-                    except: article.start_page = ''
-                        
-                    try: article.end_page = tree.coredata.find('endingPage').text
-                    except: article.end_page = ''                    
-                    
-                    try: 
-                        abs = tree.coredata.find('description').text
-                        if abs[:8] == "Abstract":
-                            article.abstract = abs[8:]
-                        else: 
-                            article.abstract = abs
-                        if not article.abstract: article.no_abstract = True
-                    except: 
-                        article.abstract = ''
-                        article.no_abstract = True                    
-
-                    ###############################
-                    ## Build keywords list       ##
-                    ############################### 
-                    if tree.coredata.find('subject'):
-                        for kw in tree.coredata.find_all('subject'):
-                            article.add_keyword(kw.text)
-                    if collectionKeyword: article.add_keyword(collectionKeyword)    
-                    if not article.keywords: no_keywords = True                    
-                    
-                    ###############################
-                    ## Build authors list        ##
-                    ############################### 
-                    try:
-                        for author in tree.coredata.find_all('creator'):
-                            article.add_author(author.text)
-                        if len(article.authors)==0: raise
-                    except:
-                        print("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.add_msg("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.countNoAuthors += 1
-                        continue
-                    
-                    ###############################
-                    ## Retrieve article body text #
-                    ###############################                       
-                    article.body = " ".join(tree.find('originalText').stripped_strings)
-                    
-                else:
-                    fmt = "other"
-                    print('Unknown XML format...')
-                    
-                
-                ###############################
-                ## parse XML for locations   ##
-                ## and write to CSV file     ##
-                ###############################
-                try:
-                    
-                    #print text
-                    initlocs = log.locations
-                    if geoparser == "spacy-lg":
-                        print("using spacy-lg")
-                        URL = "https://geolocate.nkn.uidaho.edu/api/spacy-lg"
-                        if not os.path.exists(locationsFile):
-                            header = [['pandas.index','filename','doi','title','level','section','nchar','status','parser',
-                                   'coordinates','end_char','score','start_char','text','type']]
-                            writeLocationsHeader(header,locationsFile)                           
-
-                    elif geoparser == "spacy-trf":
-                        print("using spacy-trf")
-                        URL = "https://geolocate.nkn.uidaho.edu/api/spacy-trf"
-                        if not os.path.exists(locationsFile):
-                            header = [['pandas.index','filename','doi','title','level','section','nchar','status','parser',
-                                   'coordinates','end_char','score','start_char','text','type']]
-                            writeLocationsHeader(header,locationsFile)                           
-                        
-                    elif geoparser == 'mordecai':
-                        # pass info to mordecai service
-                        print("using Mordecai")
-                        URL = "https://geolocate.nkn.uidaho.edu/api/mordecai"
-                        if not os.path.exists(locationsFile):
-                            header = [['pandas.index','filename','doi','title','level','section','nchar','status','parser',
-                                       'country_conf','country_predicted','geo.admin1',
-                                       'geo.country_code3', 'geo.feature_class', 'geo.feature_code',
-                                       'geo.geonameid', 'geo.lat', 'geo.lon', 'geo.place_name','spans','word']]
-                            writeLocationsHeader(header,locationsFile)
-                                                
-                    elif geoparser == 'locatext':
-                        print("using LocateXT")
-
-                    elif geoparser == 'stanza':
-                        print("Using stanza")
-                        URL = "https://geolocate.nkn.uidaho.edu/api/stanza"
-                        if not os.path.exists(locationsFile):                        
-                            header = [['pandas.index','filename','doi','title','level','section','nchar','status','parser',
-                                       'coordinates','end_char','score','start_char','text','type']]
-                            writeLocationsHeader(header,locationsFile)                            
-                        
-                    elif geoparser == 'nltk':
-                        print("Using NLTK")
-                        URL = "https://geolocate.nkn.uidaho.edu/api/nltk"
-                        if not os.path.exists(locationsFile):                        
-                            header = [['pandas.index','filename','doi','title','level','section','nchar','status','parser',
-                                       'coordinates','score','text','type']]
-                            writeLocationsHeader(header,locationsFile)                        
-                                                
-                    else: # no parsing??
-                        print("I don't know what to do!!!")
-                    
-                    # Need initialize values in case the title and/or abstract doesn't contain any location info.
-                    # Also need to reinitialize the values between each returned record so we don't get bleed over if a record doesn't have a 'geo' element
-                    
-                    print("Parsing title...")    
-                    rjson={}; j='' #reset this to prevent bleed-over from prior article/section
-                    resp = requests.post(URL, article.title.encode('utf-8'))
-                    rjson = json.loads(resp.text)
-                    if len(rjson) > 0:  
-                        df = pd.json_normalize(rjson, max_level=1)
-                        df['7_status'] = "True"
-                    else:
-                        df = pd.DataFrame(data={"7_status":["False"]})
-                        
-                    df['1_name'] =  name
-                    df['2_doi'] = article.doi
-                    df['3_title'] = article.title
-                    df['4_level'] = "title"
-                    df['5_section'] = "title"
-                    df['6_nchar'] = len(article.title)
-                    df['8_parser'] = geoparser
-
-                    df = df.reindex(sorted(df.columns), axis=1)
-
-                    hdr = False  if os.path.isfile(locationsFile) else True
-                    df.to_csv(locationsFile, mode='a', header=hdr)
-                    
-                    # Parse Abstract
-                    print("Parsing abstract...")                   
-                    rjson={}; j='' #reset this to prevent bleed-over from prior article/section
-                    resp = requests.post(URL, article.abstract.encode('utf-8'))
-                    if len(rjson) > 0:  
-                        df = pd.json_normalize(rjson, max_level=1)
-                        df['7_status'] = "True"
-                    else:
-                        df = pd.DataFrame(data={"7_status":["False"]})
-                        
-                    df['1_name'] =  name
-                    df['2_doi'] = article.doi
-                    df['3_title'] = article.title
-                    df['4_level'] = "abstract"
-                    df['5_section'] = "abstract"
-                    df['6_nchar'] = len(article.abstract)
-                    df['8_parser'] = geoparser
-
-                    df = df.reindex(sorted(df.columns), axis=1)
-
-                    hdr = False  if os.path.isfile(locationsFile) else True
-                    df.to_csv(locationsFile, mode='a', header=hdr)                       
-                    
-                    # Parse body of article
-                    for sec in tree.find_all('sec'):
-                        secText = " ".join(sec.stripped_strings)
-                        secID = sec.attrs #["id"]
-                        secTitle = sec.find("title").text
-                    
-                        print("Parsing "+secTitle+"...")                   
-                        rjson={}; j='' #reset this to prevent bleed-over from prior article/section
-                        resp = requests.post(URL, secText.encode('utf-8'))
-                        rjson = json.loads(resp.text)
-                        if len(rjson) > 0:  
-                            df = pd.json_normalize(rjson, max_level=1)
-                            df['7_status'] = "True"
+                                rows = rjsons
+                            df = articleFrame(sections, rows, name, article, p, locationsHeaders[o])
+                        # all of this article's rows in one write, so a crash can't leave half of them
+                        if locationsFormat == "csv":
+                            with log.timed('write'):
+                                # any new toponyms go down first, so every id the rows use is on disk
+                                if toponymMemo: memos[o].flush()
+                                appendDurably(locationsFiles[o], df.to_csv(header=False).encode('utf-8'))
                         else:
-                            df = pd.DataFrame(data={"7_status":["False"]})
-                            
-                        df['1_name'] =  name
-                        df['2_doi'] = article.doi
-                        df['3_title'] = article.title
-                        df['4_level'] = "body"
-                        df['5_section'] = secTitle
-                        df['6_nchar'] = len(secText)
-                        df['8_parser'] = geoparser
-    
-                        df = df.reindex(sorted(df.columns), axis=1)
-    
-                        hdr = False  if os.path.isfile(locationsFile) else True
-                        df.to_csv(locationsFile, mode='a', header=hdr)                        
-                        
-                        
-                                                  
-                    
-                except Exception as inst:
-                    print(type(inst))
-                    print(inst)
-                    print ("Error in parsing article text for place names: " + xmlFile)
-                    log.add_msg("Error in parsing article text for place names: " + xmlFile)
+                            frames[p] = df
+                        articlelocs[o] = articlelocs.get(o, 0) + sum(len(rjson) for rjson in rjsons)
+                        parsed.append(p)
+                    except Exception as inst:
+                        print(type(inst))
+                        print(inst)
+                        print ("Error in parsing article text for place names (" + p + "): " + xmlFile)
+                        log.add_msg("Error in parsing article text for place names (" + p + "): " + xmlFile)
+                        manifest.record(xmlFile, p, article.doi, 'failed')
+
+                if not articlelocs:
+                    log.end_article(xmlFile, doi=article.doi, status='failed')
                     continue
+                log.locations += sum(articlelocs.values())
+                if sum(articlelocs.values()) > 0: log.countGeoTagged += 1
                 
                 
                 ###############################
                 ## Write article to output   ##
                 ###############################
-                if (allArticles or articlelocs>0):
-                    try:
-                        articleLine = [[article.doi,article.publisher_name,'',article.build_citation(),article.title,str(article.year),article.authors[0],article.format_authors(),article.format_volisspg(),article.volume,article.issue,article.start_page,article.end_page,article.format_keywords(),article.no_keywords,article.abstract,article.no_abstract,article.url]]
-                        articleWriter.writerows(articleLine)            
-                        log.countArticlesWritten += 1
-                    except: 
-                        print ("Error writing record for " + xmlFile + " - " + article.title)
-                        log.add_msg("Error writing record for " + xmlFile + " - " + article.title)
-                        log.countErrors += 1
-                        continue                
-                
-                # Pause for a second to keep the API happy.
-                time.sleep(1)
+                writeStart = time.perf_counter()
+                written = False
+                for o in articlelocs:
+                    if (allArticles or articlelocs[o]>0):
+                        try:
+                            articleLine = [[article.doi,article.publisher_name,'',article.build_citation(),article.title,str(article.year),article.authors[0],article.format_authors(),article.format_volisspg(),article.volume,article.issue,article.start_page,article.end_page,article.format_keywords(),article.no_keywords,article.abstract,article.no_abstract,article.url]]
+                            articleWriters[o].writerows(articleLine)            
+                            written = True
+                        except: 
+                            print ("Error writing record for " + xmlFile + " - " + article.title)
+                            log.add_msg("Error writing record for " + xmlFile + " - " + article.title)
+                            log.countErrors += 1
+                            break
+                # once per article, however many parsers' articles files it went to
+                if written: log.countArticlesWritten += 1
+                for o in articlelocs:
+                    articleHandles[o].flush()
+                    os.fsync(articleHandles[o].fileno())
+                if store is not None:
+                    for p in parsed: store.add_article(articleRecord(article), p, responseLocations(name, article, p, sections, results[p]))
+                if locationsFormat == "csv":
+                    for p in parsed: manifest.record(xmlFile, p, article.doi, 'done')
+                else:
+                    # typed rows are written a batch at a time; an article is done once its batch is on disk
+                    for p in parsed:
+                        for tagFile, tagParser, tagDoi in locationsWriters[outputKey(p)].add(frames[p], (xmlFile, p, article.doi)):
+                            manifest.record(tagFile, tagParser, tagDoi, 'done')
+                log.add_time('write', time.perf_counter() - writeStart)
+                log.end_article(xmlFile, doi=article.doi, status='done', parsers=parsed,
+                                locations=sum(articlelocs.values()))
                 
+        for writer in locationsWriters.values():
+            for tagFile, tagParser, tagDoi in writer.close():
+                manifest.record(tagFile, tagParser, tagDoi, 'done')
+
         ###############################
         ## Clean up and log errors   ##
         ############################### 
         
+        for line in pipe.summary(): log.add_msg(line)
+        for p, client in clients.items():
+            client.close()
+            log.add_msg(p + ": " + str(client.countRequests) + " requests (" + str(client.countBatched) + " texts sent in batches, " + str(client.countChunked) + " split into chunks), " + str(client.countRetries) + " retries.")
+        if cache:
+            log.cacheHits, log.cacheMisses = cache.hits, cache.misses
+            print (str(log.cacheHits) + " geoparser responses from cache, " + str(log.cacheMisses) + " fetched.")
+            log.add_msg("Response cache " + cacheFile + ": " + str(log.cacheHits) + " hits, " + str(log.cacheMisses) + " misses, " + str(cache.evictions) + " evictions.")
+            cache.close()
+        if store is not None:
+            counts = store.query("SELECT (SELECT COUNT(*) FROM articles) AS articles, (SELECT COUNT(*) FROM locations) AS locations")
+            log.add_msg("Results store " + storeFile + ": " + str(counts['articles'][0]) + " articles, " + str(counts['locations'][0]) + " locations rows.")
+            store.close()
+        if corpus is not None:
+            log.add_msg("Corpus snapshot " + snapshotFile + ": " + str(corpus.hits) + " articles read from it, " + str(corpus.misses) + " extracted from XML, " + str(len(corpus)) + " in all.")
+        for o, memo in memos.items():
+            log.add_msg(toponymsFiles[o] + ": " + str(len(memo)) + " toponyms, " + str(memo.hits) + " mentions resolved from the memo.")
+
+        summary = log.summary()
         print ("")
         print ("Finished!!")
-        print ("Processed " + str(log.countArticles) + " articles.")
-        print ("Errors encountered in " + str(log.countErrors) + " articles.")
-        print (str(log.countNoAuthors) + " articles had no authors and were skipped.")
-        print (str(log.countArticlesWritten) + " articles written to the CSV file")
-        print (str(log.countGeoTagged) + " articles had parsed coordinates.")
-        print (str(log.locations) + " total locations found.")
-        
+        for line in summary: print (line)
+
         for msg in log.messages:
             lf.write("\n"+msg)
-        lf.write("\n".join(["","","Finished processing directory "+startDir+" at "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),"Processed " + str(log.countArticles) + " articles.",
-                           "Errors encountered in " + str(log.countErrors) + str(log.countNoAuthors) + " articles had no authors and were skipped." + str(log.countArticlesWritten) + " articles written to the CSV file" + " articles.", str(log.countGeoTagged) + " articles had parsed coordinates.",str(log.locations) + " total locations found.",
-                           "Created output files:",articlesFile,locationsFile,logFile]))
-        lf.close()  
+        outputFiles = list(articlesFiles.values()) + list(locationsFiles.values()) + [logFile] + ([eventsFile] if eventsFile else [])
+        if toponymMemo: outputFiles += list(toponymsFiles.values())
+        lf.write("\n".join(["","","Finished processing directory "+startDir+" at "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')] +
+                           summary + ["Created output files:"] + outputFiles))
+        lf.close()
+        log.close()  
         
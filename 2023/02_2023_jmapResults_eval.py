@@ -1,96 +1,81 @@
 import pandas as pd
-import numpy as np
-from matplotlib import pyplot as plt
-import csv
-import re
 import os
-import haversine as hs
-import ast
 
-doiList = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/PLOSOne_confirmed_locations.csv')
-dois = doiList['doi']
-mordecai = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_mordecai_2023.csv')
-nltk = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_nltk_2023.csv')
-spacy_lg = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_spacy-lg_2023.csv')
-spacy_trf = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_spacy-trf_2023.csv')
-stanza = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_stanza_2023.csv')
-arcgispro = pd.read_csv('C:/Users/bgodfrey/Documents/GitHub/Placenames/2023/locations_arcgispro_2023.csv')
+from jmapEval import evaluate, sweep, sweepThresholds, loadPoints, score
+from jmapStore import ResultsStore
 
+dataDir = 'C:/Users/bgodfrey/Documents/GitHub/Placenames/2023'
+resultsFile = 'results_20230320.csv'
+sweepFile = 'results_sweep_20230320.csv' # results at each of sweepThresholds km ('' to skip the sweep)
+storeFile = '' # also add the confirmed locations and the results, by file name, to this SQLite store (see jmapStore.py)
 
-# Check coordinate location
-#parsers = [mordecai, spacy_lg, spacy_trf, nltk, stanza, arcgispro]
-parsers = [arcgispro]
-#nltk, stanza, mordecai, spacy-trf, arcgispro have latitude out of range on same arctile (#25)
-
+# Precision, recall and F1 with bootstrap confidence intervals, per parser and section
+# level, as one tidy table ('' to skip); resamples are spread over evalWorkers processes
+scoresFile = 'scores_20230320.csv'
+bootstrapResamples = 1000
+evalWorkers = os.cpu_count() or 1
 
+# Parsers to evaluate, each read from its typed locations_<parser>_2023.parquet (or .arrow)
+# dataset if the parse wrote one, otherwise locations_<parser>_2023.csv
+parsers = ['mordecai', 'spacy-lg', 'spacy-trf', 'nltk', 'stanza', 'arcgispro', 'gazetteer']
+#nltk, stanza, mordecai, spacy-trf, arcgispro have latitude out of range on same arctile (#25)
 
-dict = {'DOI':[],'parser':[],'correctPlace':[],'accurates':[],'inaccurates':[]}
-
-results = pd.DataFrame(dict)
+# The locations files are read chunkRows rows at a time, keeping only the located rows of
+# articles in doiList, so out-of-range counts and the sweep's near_any_truth shares are
+# over those articles
+chunkRows = 200000
 
-def checkAccuracy(parser, sourceId, sourceLoc, text):
+# The run itself. Guarded so that the bootstrap worker processes, which import this
+# module on Windows, don't start a run of their own.
+if __name__ == "__main__":
+    doiList = pd.read_csv(dataDir + '/PLOSOne_confirmed_locations.csv')
+    confirmedDois = set(doiList['doi'].dropna())
 
-    loc2 = ast.literal_eval(sourceLoc)
-    #loc1 = (44.71314,-63.7233)
-    
-    accurates = 0
-    inaccurates = 0
-    
-    for index, row in parser.iterrows():
-        if sourceId == row['doi']:
-            if row['parser'] != 'mordecai' and type(row['coordinates']) is not float and "," in row['coordinates']:
-                loc1 = ast.literal_eval(row['coordinates'])
-                dist = hs.haversine(loc1,loc2)
-                if dist > 161:
-                    #print(sourceId, index, row['section'], row['parser'], "Distance: "+str(round(dist, 2))+" km, ", "Not Accurate")
-                    inaccurates += 1
-                else:
-                    #print(sourceId, index, row['section'], row['parser'], "Distance: "+str(round(dist, 2))+" km, ", "Accurate")
-                    accurates += 1
-            elif 'mordecai' in row['parser'] and pd.notnull(row['geo.lat']):
-                lat1 = str(row['geo.lat'])
-                lon1 = str(row['geo.lon'])
-                location = str(lat1)+","+str(lon1)
-                loc1 = ast.literal_eval(location)
-                dist = hs.haversine(loc1,loc2)
-                if dist > 161:
-                    #print(sourceId, index, row['section'], row['parser'], "Distance: "+str(round(dist, 2))+" km, ", "Not Accurate")
-                    inaccurates += 1
-                else:
-                    #print(sourceId, index, row['section'], row['parser'], "Distance: "+str(round(dist, 2))+" km, ", "Accurate")
-                    accurates += 1
-            else:
-                pass
+    tables = {}
+    for parser in parsers:
+        candidates = [dataDir + '/locations_' + parser + '_2023' + ext for ext in ('.parquet', '.arrow', '.csv')]
+        found = [f for f in candidates if os.path.exists(f)]
+        if found:
+            # compact rows: the place names and coordinates are in the toponyms file
+            toponymsFile = dataDir + '/toponyms_' + parser + '_2023.csv'
+            tables[parser] = loadPoints(found[0], confirmedDois, toponymsFile if os.path.exists(toponymsFile) else None, chunkRows)
         else:
-            pass
+            print("No locations file for " + parser + ": " + candidates[-1])
 
-    print("done")
-    results.loc[len(results.index)] = [sourceId, row['parser'], text, accurates, inaccurates]
-    print(sourceId, row['parser'], "Accurates: "+str(accurates))
-    print(sourceId, row['parser'], "Inaccurates: "+str(inaccurates))
 
+    # Check coordinate location: every parser against every confirmed DOI in one pass
+    results, skipped = evaluate(tables, doiList)
 
-loop = 1
+    for parser in tables:
+        r = results[results['parser'] == parser]
+        print(parser, "Accurates: "+str(int(r['accurates'].sum())), "Inaccurates: "+str(int(r['inaccurates'].sum())))
+        if skipped[parser]:
+            print(parser, str(skipped[parser]) + " coordinates out of range were skipped")
 
-try:
-    for parser in parsers:
-        for index, row in doiList.iterrows():
-            print("Article Row: "+str(loop))
-            if pd.notnull(row['doi']) and pd.notnull(row['RE_Lat']):
-                sourceId = row['doi']
-                lat = row['RE_Lat']
-                long = row['RE_Long']
-                text = row['Coordinate Text']
-                sourceLoc = str(lat)+","+str(long)
-                loop +=1
-                checkAccuracy(parser, sourceId, sourceLoc, text) 
-            else:
-                pass
-except Exception as e:
-    print(e)
-    #for any exception to be catched
-    print(type(e))
-    #to know the type of exception.
+    results.to_csv(resultsFile, sep=',', encoding='utf8')
+
+    # The same counts at every sweep threshold, from one set of distances, and how many
+    # predicted points fall that close to any confirmed location in the corpus
+    if sweepFile:
+        sweepResults, coverage = sweep(tables, doiList, sweepThresholds)
+        totals = sweepResults.groupby(['parser', 'threshold'], sort=False)[['accurates', 'inaccurates']].sum()
+        print(totals.join(coverage.set_index(['parser', 'threshold'])['near_any_truth']))
+        sweepResults.to_csv(sweepFile, sep=',', encoding='utf8')
 
+    # Precision, recall, F1 and distance error per parser and level, with bootstrap intervals
+    if scoresFile:
+        scores = score(tables, doiList, resamples=bootstrapResamples, workers=evalWorkers)
+        shown = scores[scores['metric'].isin(['precision', 'recall', 'f1'])]
+        shown = shown.assign(value=shown['value'].map("{:.3f}".format) + " (" + shown['ci_low'].map("{:.3f}".format) +
+                             "-" + shown['ci_high'].map("{:.3f}".format) + ")")
+        print(shown.pivot_table(index=['parser', 'level'], columns='metric', values='value', aggfunc='first', sort=False)
+                   [['precision', 'recall', 'f1']].to_string())
+        scores.to_csv(scoresFile, sep=',', encoding='utf8', index=False)
 
-results.to_csv('results_20230320.csv', sep=',', encoding='utf8')
+    if storeFile:
+        store = ResultsStore(storeFile)
+        store.add_truth(doiList)
+        store.add_results(results, os.path.splitext(resultsFile)[0])
+        if sweepFile: store.add_results(sweepResults, os.path.splitext(sweepFile)[0])
+        store.close()
+        print("Results added to " + storeFile)
@@ -0,0 +1,268 @@
+#####################################################################################
+## jmapBench.py
+## Benchmarks for the JournalMap parse pipeline, stage by stage.
+##
+## Usage:
+##     python jmapBench.py [xmlDir] [--repeat N] [--scale N] [--stages a,b,...]
+##                         [--out results.json] [--compare baseline.json] [--tolerance 0.25]
+##
+## xmlDir defaults to the repository root, which holds the bundled
+## journal.pone.*.xml files; --scale replicates them (and the locations tables
+## for the eval stage) N times to see how things hold up at 10k or 100k
+## articles. The stages are
+##     extract    XML loading and Article construction, per extractor. The
+##                extractors' output is checked against each other, so a
+##                faster one can't quietly change what gets sent to the
+##                geoparsers.
+##     sections   assembling the title/abstract/section texts for each article
+##     requests   sending them to a local stub of the geolocate API
+##                (jmapMockServer.py) and decoding the responses
+##     write      building the locations rows and appending them to a CSV
+##     eval       checkAccuracy() over the locations_*_2023.csv files here
+## Each is timed as the best of --repeat passes. Results are written as JSON
+## with the run's details (commit, Python, platform), and --compare flags any
+## stage that is more than --tolerance slower per item than in a saved run,
+## exiting with status 1 if there are any.
+#####################################################################################
+
+import os, sys, glob, time, json, platform, subprocess, tempfile
+import argparse, tracemalloc
+
+from jmapExtract import extractArticle, extractArticleSoup, articleSections, ExtractError
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+dataDir = os.path.dirname(os.path.abspath(__file__))
+
+extractors = [("soup", extractArticleSoup), ("lxml", extractArticle)]
+stages = ["extract", "sections", "requests", "write", "eval"]
+
+
+def runExtractor(fn, xmlFiles):
+    # Returns {file: (article attributes, sections) or the exception class}
+    out = {}
+    for xmlFile in xmlFiles:
+        try:
+            article, sections, fmt = fn(xmlFile)
+            out[xmlFile] = (article.as_dict(), sections)
+        except ExtractError as inst:
+            out[xmlFile] = type(inst)
+    return out
+
+def bestOf(fn, repeat):
+    # Best of `repeat` calls to fn(), in seconds
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def timeExtractor(fn, xmlFiles, repeat):
+    return bestOf(lambda: runExtractor(fn, xmlFiles), repeat)
+
+def peakMemory(fn, xmlFiles):
+    # Largest Python heap peak for any one article. Note that lxml's own tree
+    # lives in C memory that tracemalloc does not see.
+    peak = 0
+    for xmlFile in xmlFiles:
+        tracemalloc.start()
+        try: fn(xmlFile)
+        except ExtractError: pass
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak
+
+def stageResult(seconds, items, unit, **extra):
+    result = {"seconds": seconds, "items": items, "unit": unit,
+              "ms_per_item": 1000.0 * seconds / items if items else None}
+    result.update(extra)
+    return result
+
+
+###############################
+## Stages                    ##
+###############################
+
+def benchExtract(xmlFiles, repeat=3, labels=None):
+    results = {}
+    reference = None
+    for label, fn in extractors:
+        if labels and label not in labels: continue
+        out = runExtractor(fn, xmlFiles)
+        if reference is None: reference = out
+        mismatches = [f for f in xmlFiles if out[f] != reference[f]]
+        seconds = timeExtractor(fn, xmlFiles, repeat)
+        results["extract_" + label] = stageResult(seconds, len(xmlFiles), "article",
+                                                  peak_bytes=peakMemory(fn, sorted(set(xmlFiles))),
+                                                  mismatches=len(mismatches))
+        for f in mismatches[:5]:
+            print("  " + label + " differs from " + extractors[0][0] + " on " + f)
+    return results
+
+def extracted(xmlFiles):
+    # (xmlFile, article, sections) for every file that extracts
+    out = []
+    for xmlFile in xmlFiles:
+        try:
+            article, sections, fmt = extractArticle(xmlFile)
+            out.append((xmlFile, article, sections))
+        except ExtractError:
+            pass
+    return out
+
+def benchSections(articles, repeat=3):
+    seconds = bestOf(lambda: [articleSections(article, secs) for xmlFile, article, secs in articles], repeat)
+    texts = [text for xmlFile, article, secs in articles for level, title, path, text in articleSections(article, secs)]
+    return {"sections": stageResult(seconds, len(articles), "article", texts=len(texts),
+                                    chars=sum(len(t) for t in texts))}
+
+def stubServer():
+    # The mock geolocate API on a free local port, in a background thread
+    from jmapMockServer import serve
+    return serve()
+
+def benchRequests(articles, repeat=3, parser="spacy-lg"):
+    from jmapClient import GeoClient
+    server = stubServer()
+    url = "http://127.0.0.1:" + str(server.server_address[1]) + "/api/" + parser
+    responses = []
+    client = GeoClient(parser, url=url, rate=1e6, burst=1000)
+    try:
+        def run():
+            del responses[:]
+            for xmlFile, article, secs in articles:
+                texts = [text for level, title, path, text in articleSections(article, secs)]
+                responses.append(client.parse_many(texts))
+        seconds = bestOf(run, repeat)
+        requests = client.countRequests // repeat
+    finally:
+        client.close()
+        server.shutdown()
+    return {"requests": stageResult(seconds, len(articles), "article", http_requests=requests)}, responses
+
+def benchWrite(articles, responses, repeat=3, parser="spacy-lg"):
+    from jmapManifest import appendDurably
+    from jmapWriter import locationsHeader, articleFrame
+    header = locationsHeader([parser])
+    tmpDir = tempfile.mkdtemp()
+    csvFile = os.path.join(tmpDir, 'locations.csv')
+    def run():
+        if os.path.exists(csvFile): os.remove(csvFile)
+        for (xmlFile, article, secs), rjsons in zip(articles, responses):
+            df = articleFrame(articleSections(article, secs), rjsons, os.path.basename(xmlFile), article, parser, header)
+            appendDurably(csvFile, df.to_csv(header=False).encode('utf-8'))
+    try:
+        seconds = bestOf(run, repeat)
+        size = os.path.getsize(csvFile)
+    finally:
+        if os.path.exists(csvFile): os.remove(csvFile)
+        os.rmdir(tmpDir)
+    return {"write": stageResult(seconds, len(articles), "article", bytes=size)}
+
+def benchEval(repeat=3, scale=1):
+    import pandas as pd
+    from jmapEval import truthPoints, locationPoints, checkAccuracy
+    doiList = pd.read_csv(os.path.join(dataDir, 'PLOSOne_confirmed_locations.csv'))
+    tables = {}
+    for locationsFile in sorted(glob.glob(os.path.join(dataDir, 'locations_*_2023.csv'))):
+        tables[os.path.basename(locationsFile)[len('locations_'):-len('_2023.csv')]] = pd.read_csv(locationsFile)
+    if not tables: return {}
+    if scale > 1:
+        # more articles: copies of every table and confirmed location under new dois
+        copy = lambda df, col: pd.concat([df.assign(**{col: df[col] + ('' if i == 0 else '#' + str(i))}) for i in range(scale)],
+                                         ignore_index=True)
+        tables = dict((p, copy(t, 'doi')) for p, t in tables.items())
+        doiList = copy(doiList, 'doi')
+    rows = sum(len(t) for t in tables.values())
+    def run():
+        truth = truthPoints(doiList)
+        for parser, locations in tables.items():
+            points, skipped = locationPoints(locations)
+            checkAccuracy(points, truth, parser)
+    return {"eval": stageResult(bestOf(run, repeat), rows, "location row", parsers=len(tables),
+                                confirmed=len(doiList))}
+
+
+###############################
+## Results                   ##
+###############################
+
+def runInfo(args, xmlFiles):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repoDir,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {"date": time.strftime('%Y-%m-%d %H:%M:%S'), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "xml_dir": args.xmlDir, "files": len(xmlFiles) // args.scale,
+            "scale": args.scale, "repeat": args.repeat}
+
+def compareRuns(results, baseline, tolerance):
+    # Stages at least `tolerance` (a fraction) slower per item than baseline
+    regressions = []
+    for name, r in results["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if not old or not old.get("ms_per_item") or not r.get("ms_per_item"): continue
+        ratio = r["ms_per_item"] / old["ms_per_item"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, old["ms_per_item"], r["ms_per_item"], ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the JournalMap parse pipeline")
+    ap.add_argument("xmlDir", nargs="?", default=repoDir)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--scale", type=int, default=1, help="replicate the corpus this many times")
+    ap.add_argument("--stages", default=",".join(stages))
+    ap.add_argument("--extractors", default=None, help="e.g. lxml (default: all; only lxml when --scale > 1)")
+    ap.add_argument("--out", default=None, help="write the results to this JSON file")
+    ap.add_argument("--compare", default=None, help="flag regressions against this earlier JSON results file")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    args = ap.parse_args()
+
+    xmlFiles = sorted(glob.glob(os.path.join(args.xmlDir, "*.xml")))
+    if not xmlFiles:
+        sys.exit("No XML files in " + args.xmlDir)
+    xmlFiles = xmlFiles * args.scale
+    todo = args.stages.split(",")
+    unknown = [s for s in todo if s not in stages]
+    if unknown:
+        sys.exit("Unknown stage(s): " + ", ".join(unknown))
+    labels = args.extractors.split(",") if args.extractors else (None if args.scale == 1 else ["lxml"])
+
+    print("Benchmarking " + str(len(xmlFiles)) + " articles, best of " + str(args.repeat))
+    results = {"run": runInfo(args, xmlFiles), "stages": {}}
+    if "extract" in todo:
+        results["stages"].update(benchExtract(xmlFiles, args.repeat, labels))
+    if set(todo) & set(["sections", "requests", "write"]):
+        articles = extracted(xmlFiles)
+        if "sections" in todo:
+            results["stages"].update(benchSections(articles, args.repeat))
+        if set(todo) & set(["requests", "write"]):
+            timings, responses = benchRequests(articles, args.repeat)
+            if "requests" in todo: results["stages"].update(timings)
+            if "write" in todo: results["stages"].update(benchWrite(articles, responses, args.repeat))
+    if "eval" in todo:
+        results["stages"].update(benchEval(args.repeat, args.scale))
+
+    for name, r in results["stages"].items():
+        extra = "  ".join(k + "=" + str(v) for k, v in r.items() if k not in ("seconds", "items", "unit", "ms_per_item"))
+        print("%-13s %9.3f s  %9.3f ms/%s  %s" % (name, r["seconds"], r["ms_per_item"], r["unit"], extra))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compareRuns(results, baseline, args.tolerance)
+        for name, old, new, ratio in regressions:
+            print("REGRESSION %s: %.3f -> %.3f ms per item (%.0f%% slower)" % (name, old, new, 100 * (ratio - 1)))
+        if regressions:
+            sys.exit(1)
+        print("No stage more than " + str(int(100 * args.tolerance)) + "% slower than " + args.compare)
@@ -0,0 +1,112 @@
+#####################################################################################
+## jmapCache.py
+## Persistent cache of geoparser responses for the JournalMap parse scripts.
+## Responses are stored in a SQLite file keyed by a SHA-256 of the parser name
+## plus the exact UTF-8 payload that was posted, so re-running the pipeline
+## (or running it with no network at all) does not re-post text we've already
+## geoparsed. The file is bounded in size; least recently used entries are
+## evicted first. Hits are not written back one at a time: their access times
+## are kept and written with the next put, every touchEvery hits and on close.
+#####################################################################################
+
+import hashlib, sqlite3, threading, time, zlib
+
+touchEvery = 256 # hits between writes of their access times
+
+
+def cacheKey(parser, payload):
+    h = hashlib.sha256(parser.encode('utf-8'))
+    h.update(b'\0')
+    h.update(payload)
+    return h.hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Usage example:
+
+    cache = ResponseCache('geoparse_cache.sqlite', maxBytes=512 * 1024**2)
+    body = cache.get('spacy-lg', text.encode('utf-8'))
+    if body is None:
+        body = post(text)
+        cache.put('spacy-lg', text.encode('utf-8'), body)
+    """
+    def __init__(self, path, maxBytes=None):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.touched = {} # key -> access time of the hits not written yet
+        self.lock = threading.Lock()
+        # the geoparse client calls in from its worker threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY,
+                               parser TEXT,
+                               nbytes INTEGER,
+                               accessed REAL,
+                               body BLOB)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM responses").fetchone()[0]
+
+    def get(self, parser, payload):
+        key = cacheKey(parser, payload)
+        with self.lock:
+            row = self.db.execute("SELECT body FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= touchEvery:
+                self.touch()
+                self.db.commit()
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, parser, payload, body):
+        key = cacheKey(parser, payload)
+        blob = zlib.compress(body.encode('utf-8'))
+        with self.lock:
+            self.touch()
+            old = self.db.execute("SELECT nbytes FROM responses WHERE key=?", (key,)).fetchone()
+            if old: self.size -= old[0]
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?)",
+                            (key, parser, len(blob), time.time(), blob))
+            self.size += len(blob)
+            if self.maxBytes and self.size > self.maxBytes:
+                self.evict()
+            self.db.commit()
+
+    def touch(self):
+        # Write the access times of the hits since the last time. Caller holds the lock.
+        if not self.touched: return
+        self.db.executemany("UPDATE responses SET accessed=? WHERE key=?",
+                            [(accessed, key) for key, accessed in self.touched.items()])
+        self.touched = {}
+
+    def evict(self):
+        # Drop least recently used entries until we're back under 90% of maxBytes,
+        # so we don't end up evicting on every single put. Caller holds the lock.
+        target = self.maxBytes * 0.9
+        cur = self.db.execute("SELECT key, nbytes FROM responses ORDER BY accessed")
+        drop = []
+        for key, nbytes in cur:
+            if self.size <= target: break
+            drop.append((key,))
+            self.size -= nbytes
+        cur.close()
+        self.db.executemany("DELETE FROM responses WHERE key=?", drop)
+        self.evictions += len(drop)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.touch()
+            self.db.commit()
+            self.db.close()
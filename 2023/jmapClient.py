@@ -0,0 +1,383 @@
+#####################################################################################
+## jmapClient.py
+## Client for the geolocate API used by the JournalMap parse scripts.
+## Keeps one pooled HTTP session per parser endpoint and sends section texts
+## concurrently, with a bounded number of requests in flight, a token-bucket
+## rate limiter (in place of the old fixed sleep between articles) and retry
+## with exponential backoff for transient failures. An optional ResponseCache
+## (jmapCache.py) short-circuits payloads that have been geoparsed before, and
+## offline mode answers from that cache only, never touching the network.
+##
+## submit_many() packs an article's section texts into as few requests to the
+## endpoint's /batch route as the size caps allow (a JSON {"texts": [...]} in,
+## a list with one response per text out) and hands back one future per text,
+## so callers see exactly what they would from one request per section. A
+## server without the batch route gets one request per text instead.
+##
+## Texts longer than the endpoint's chunkChars are split at paragraph or
+## sentence ends into overlapping chunks sent side by side. The rows for the
+## chunks are shifted back to offsets in the whole text (start_char/end_char,
+## mordecai's spans), each chunk keeps only the mentions starting in its share
+## of the overlap, and a mention cut off at one chunk's edge is reported whole
+## by its neighbour, so the caller sees one list of rows for the text.
+##
+## External Dependencies
+##     requests
+#####################################################################################
+
+import json, random, re, threading, time
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+baseURL = "https://geolocate.nkn.uidaho.edu/api/"
+
+# Per-endpoint settings. concurrency is the number of requests allowed in flight,
+# rate the sustained requests per second and burst the size of the token bucket.
+# The transformer/stanza models are much slower server-side, so keep them gentler.
+# chunkChars is the longest text sent in one piece (0 for no limit) and overlap
+# how far neighbouring chunks overlap; nltk returns no offsets to line chunks up
+# by, so its chunks don't overlap.
+endpoints = {
+    "spacy-lg":  {"concurrency": 8, "rate": 8.0, "burst": 8, "chunkChars": 20000, "overlap": 200},
+    "spacy-trf": {"concurrency": 4, "rate": 4.0, "burst": 4, "chunkChars": 4000, "overlap": 200},
+    "mordecai":  {"concurrency": 4, "rate": 4.0, "burst": 4, "chunkChars": 8000, "overlap": 200},
+    "stanza":    {"concurrency": 4, "rate": 4.0, "burst": 4, "chunkChars": 4000, "overlap": 200},
+    "nltk":      {"concurrency": 8, "rate": 8.0, "burst": 8, "chunkChars": 20000, "overlap": 0},
+}
+
+# HTTP status codes worth retrying
+retryStatus = (429, 500, 502, 503, 504)
+
+# Batch requests carry at most batchBytes of UTF-8 text and batchTexts texts;
+# a longer text goes in a request of its own. batchBytes = 0 turns batching off.
+batchBytes = 256 * 1024
+batchTexts = 64
+# Status codes meaning the server has no batch route
+batchUnsupported = (404, 405, 501)
+
+
+class GeoparseError(Exception):
+    pass
+
+
+###############################
+## Chunking long texts       ##
+###############################
+
+paragraphEnd = re.compile(r'\n\s*\n')
+sentenceEnd = re.compile(r'[.!?]["\')\]]*\s+')
+wordEnd = re.compile(r'\s+')
+
+def cutPoint(window):
+    # Where to end a chunk: after the last paragraph, sentence or word in the
+    # second half of window, or at its end if there is none
+    for pattern in (paragraphEnd, sentenceEnd, wordEnd):
+        ends = [m.end() for m in pattern.finditer(window, len(window) // 2)]
+        if ends: return ends[-1]
+    return len(window)
+
+def chunkText(text, maxChars, overlap=0):
+    """
+    Split text into (offset, chunk) pieces of at most maxChars characters,
+    each starting up to overlap characters (at a word start) before the end
+    of the one before. Short texts come back whole, as [(0, text)].
+    """
+    if not maxChars or len(text) <= maxChars: return [(0, text)]
+    pieces = []
+    start = 0
+    while len(text) - start > maxChars:
+        end = start + cutPoint(text[start:start + maxChars])
+        pieces.append((start, text[start:end]))
+        nxt = end
+        if overlap:
+            space = text.find(' ', max(end - overlap, start + 1), end)
+            if space >= 0: nxt = space + 1
+        start = max(nxt, start + 1)
+    pieces.append((start, text[start:]))
+    return pieces
+
+def rowStart(row):
+    # A response row's offset in its text, or None if the parser gives none
+    if row.get('start_char') is not None: return row['start_char']
+    spans = row.get('spans')
+    if isinstance(spans, list) and spans: return spans[0].get('start')
+    return None
+
+def rowEnd(row):
+    if row.get('end_char') is not None: return row['end_char']
+    spans = row.get('spans')
+    if isinstance(spans, list) and spans: return spans[-1].get('end')
+    return None
+
+def shiftRow(row, offset):
+    # The row with its offsets moved from a chunk to the whole text
+    if not offset: return row
+    row = dict(row)
+    for key in ('start_char', 'end_char'):
+        if row.get(key) is not None: row[key] += offset
+    if isinstance(row.get('spans'), list):
+        row['spans'] = [dict(span, start=span['start'] + offset, end=span['end'] + offset) for span in row['spans']]
+    return row
+
+def mergeChunks(pieces, results):
+    """
+    One list of rows for a chunked text from the rows for each of its
+    pieces. In the overlap between two chunks, each keeps the mentions that
+    start in its half; anything a later chunk reports inside a mention
+    already kept from an earlier one is dropped.
+    """
+    rows = []
+    keptEnd = -1
+    for k, ((offset, chunk), rjson) in enumerate(zip(pieces, results)):
+        lo = (offset + pieces[k - 1][0] + len(pieces[k - 1][1])) / 2.0 if k > 0 else float('-inf')
+        hi = (pieces[k + 1][0] + offset + len(chunk)) / 2.0 if k + 1 < len(pieces) else float('inf')
+        chunkEnd = keptEnd
+        for row in rjson:
+            row = shiftRow(row, offset)
+            start = rowStart(row)
+            if start is not None:
+                if not lo <= start < hi or start < keptEnd: continue
+                end = rowEnd(row)
+                if end is not None: chunkEnd = max(chunkEnd, end)
+            rows.append(row)
+        keptEnd = chunkEnd
+    return rows
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available;
+    tokens refill continuously at `rate` per second up to `burst`.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeoClient(object):
+    """
+    Pooled client for a single geoparser endpoint.
+
+    Usage example:
+
+    client = GeoClient("spacy-lg", cache=ResponseCache('geoparse_cache.sqlite'))
+    rjsons = client.parse_many([article.title, article.abstract])
+    client.close()
+    """
+    def __init__(self, parser, url=None, concurrency=None, rate=None, burst=None,
+                 retries=3, backoff=0.5, timeout=120, cache=None, offline=False,
+                 batchBytes=batchBytes, batchTexts=batchTexts, chunkChars=None, overlap=None, log=None):
+        settings = endpoints.get(parser, {})
+        self.parser = parser
+        self.url = url or baseURL + parser
+        self.batchURL = self.url.rstrip('/') + '/batch' if batchBytes else None
+        self.batchBytes = batchBytes
+        self.batchTexts = batchTexts
+        self.chunkChars = settings.get("chunkChars", 0) if chunkChars is None else chunkChars
+        self.overlap = settings.get("overlap", 0) if overlap is None else overlap
+        self.concurrency = concurrency or settings.get("concurrency", 4)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.log = log # a ParseLog to report each request's latency and size to
+        self.countRequests = 0
+        self.countRetries = 0
+        self.countBatched = 0 # texts sent in batch requests
+        self.countChunked = 0 # texts split into chunks
+
+        rate = rate or settings.get("rate", 4.0)
+        self.bucket = TokenBucket(rate, burst or settings.get("burst", self.concurrency))
+
+        # one session, with enough pooled connections for every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.lock = threading.Lock()
+
+    def post(self, payload):
+        # Answer from the cache if we can, otherwise send the payload
+        if self.cache is not None:
+            body = self.cache.get(self.parser, payload)
+            if body is not None:
+                return body
+        return self.fetch(payload)
+
+    def fetch(self, payload):
+        # Send a payload the cache doesn't have, and cache the response
+        if self.offline:
+            raise GeoparseError("Offline and no cached " + self.parser + " response for this text")
+        body = self.send(payload)
+        if self.cache is not None:
+            self.cache.put(self.parser, payload, body)
+        return body
+
+    def send(self, payload, url=None, headers=None):
+        # Send one UTF-8 payload, retrying transient failures with backoff
+        url = url or self.url
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            retryAfter = None
+            t0 = time.perf_counter()
+            try:
+                resp = self.session.post(url, payload, headers=headers, timeout=self.timeout)
+                if self.log is not None:
+                    self.log.record_request(self.parser, time.perf_counter() - t0, len(payload), len(resp.content), resp.status_code)
+                if resp.status_code not in retryStatus:
+                    resp.raise_for_status()
+                    with self.lock:
+                        self.countRequests += 1
+                    return resp.text
+                retryAfter = resp.headers.get("Retry-After")
+                err = GeoparseError("HTTP " + str(resp.status_code) + " from " + url)
+            except (requests.ConnectionError, requests.Timeout) as inst:
+                if self.log is not None:
+                    self.log.record_request(self.parser, time.perf_counter() - t0, len(payload), 0, None)
+                err = inst
+            if attempt >= self.retries:
+                raise err
+            with self.lock:
+                self.countRetries += 1
+            if self.log is not None:
+                self.log.record_retry(self.parser, str(err))
+            try: delay = float(retryAfter)
+            except (TypeError, ValueError): delay = self.backoff * 2 ** attempt
+            time.sleep(delay + random.uniform(0, self.backoff))
+            attempt += 1
+
+    def parse(self, text):
+        text = text or ''
+        return json.loads(self.post(text.encode('utf-8')))
+
+    def send_batch(self, payloads):
+        # One request for several payloads; returns the parsed response for each
+        body = json.dumps({"texts": [p.decode('utf-8') for p in payloads]}).encode('utf-8')
+        results = json.loads(self.send(body, self.batchURL, {"Content-Type": "application/json"}))
+        if not isinstance(results, list) or len(results) != len(payloads):
+            raise GeoparseError("Batch response from " + self.batchURL + " doesn't have one result per text")
+        if self.cache is not None:
+            for payload, result in zip(payloads, results):
+                self.cache.put(self.parser, payload, json.dumps(result))
+        with self.lock:
+            self.countBatched += len(payloads)
+        return results
+
+    def run_batch(self, batch):
+        # Worker: answer a list of (future, payload), unless the caller has cancelled them
+        live = [(f, payload) for f, payload in batch if f.set_running_or_notify_cancel()]
+        if not live: return
+        payloads = [payload for f, payload in live]
+        try:
+            if self.offline:
+                raise GeoparseError("Offline and no cached " + self.parser + " response for this text")
+            results = None
+            if self.batchURL is not None:
+                try:
+                    results = self.send_batch(payloads)
+                except requests.HTTPError as inst:
+                    if inst.response is None or inst.response.status_code not in batchUnsupported: raise
+                    # no batch route on this server: send these, and everything after, one at a time
+                    self.batchURL = None
+            if results is None:
+                # submit_texts() has looked these up in the cache already
+                results = [json.loads(self.fetch(payload)) for payload in payloads]
+        except Exception as inst:
+            for f, payload in live: f.set_exception(inst)
+            return
+        for (f, payload), result in zip(live, results):
+            f.set_result(result)
+
+    def batches(self, pending):
+        # Pack (future, payload) pairs, in order, into batches within the size caps
+        batch, size = [], 0
+        for f, payload in pending:
+            if batch and (size + len(payload) > self.batchBytes or len(batch) >= self.batchTexts):
+                yield batch
+                batch, size = [], 0
+            batch.append((f, payload))
+            size += len(payload)
+        if batch: yield batch
+
+    def joined(self, pieces, parts):
+        # One future for a chunked text, resolved when all its pieces are
+        f = Future()
+        remaining = [len(parts)]
+        def done(part):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            if not f.set_running_or_notify_cancel(): return
+            errors = [CancelledError() if p.cancelled() else p.exception() for p in parts]
+            errors = [e for e in errors if e is not None]
+            if errors: f.set_exception(errors[0])
+            else: f.set_result(mergeChunks(pieces, [p.result() for p in parts]))
+        # cancelling the text cancels whichever pieces haven't started
+        f.add_done_callback(lambda f: [p.cancel() for p in parts] if f.cancelled() else None)
+        for part in parts: part.add_done_callback(done)
+        return f
+
+    def submit_many(self, texts):
+        # Queue texts without waiting, so several clients can run side by side.
+        # Returns one future per text, in order.
+        pieces = [chunkText(text or '', self.chunkChars, self.overlap) for text in texts]
+        if any(len(p) > 1 for p in pieces):
+            parts = self.submit_texts([chunk for p in pieces for offset, chunk in p])
+            futures = []
+            for p in pieces:
+                mine, parts = parts[:len(p)], parts[len(p):]
+                if len(p) == 1: futures.append(mine[0])
+                else: futures.append(self.joined(p, mine))
+            with self.lock:
+                self.countChunked += sum(1 for p in pieces if len(p) > 1)
+            return futures
+        return self.submit_texts(texts)
+
+    def submit_texts(self, texts):
+        # One future per text, each text sent as it is
+        if self.batchURL is None:
+            return [self.pool.submit(self.parse, text) for text in texts]
+        futures = []
+        pending = []
+        for text in texts:
+            f = Future()
+            payload = (text or '').encode('utf-8')
+            body = self.cache.get(self.parser, payload) if self.cache is not None else None
+            if body is not None:
+                f.set_running_or_notify_cancel()
+                f.set_result(json.loads(body))
+            else:
+                pending.append((f, payload))
+            futures.append(f)
+        for batch in self.batches(pending):
+            self.pool.submit(self.run_batch, batch)
+        return futures
+
+    def parse_many(self, texts):
+        # Results come back in the same order as texts. The first failure
+        # (after retries) is raised so the caller can skip the article.
+        return [f.result() for f in self.submit_many(texts)]
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.session.close()
@@ -0,0 +1,362 @@
+#####################################################################################
+## jmapEval.py
+## Accuracy evaluation of geoparser output against the confirmed study locations
+## (PLOSOne_confirmed_locations.csv).
+##
+## Coordinates are parsed once per locations table into float lat/lon columns,
+## predictions are joined to the confirmed locations on doi, and distances are
+## computed with NumPy in one batch, instead of an iterrows() scan of the whole
+## table for every confirmed DOI. The distances are worked out once, so any
+## number of thresholds can be counted from them (sweepAccuracy), and
+## nearestTruth() finds the closest confirmed location anywhere in the corpus
+## through a grid index (jmapSpatial.py).
+##
+## loadPoints() reads a locations table for evaluation a chunk at a time,
+## keeping only what the evaluation uses, so tables far bigger than memory can
+## be evaluated.
+##
+## score() gives precision (the share of predictions within the threshold of
+## one of their article's confirmed locations), recall (the share of confirmed
+## locations with a prediction that close), F1 and the distance from each
+## prediction to its article's nearest confirmed location, per parser and per
+## level (title, abstract, body, or all), as one tidy table. Confidence
+## intervals come from resampling articles with replacement: every metric is a
+## ratio of per-article sums, so all resamples are one matrix product of
+## resample counts and per-article sums, run for each parser and level in a
+## process pool.
+##
+## External Dependencies
+##     Pandas
+##     NumPy
+#####################################################################################
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+earthRadius = 6371.0088 # km; the mean radius the haversine package uses
+threshold = 161 # km (100 miles) between a predicted and confirmed location to count as accurate
+sweepThresholds = [10, 50, 161, 500] # km; thresholds compared side by side by sweepAccuracy()
+scoreLevels = ['all', 'title', 'abstract', 'body'] # the section levels score() reports, 'all' being every level
+
+# The columns of a locations table the evaluation uses, and those that can hold its coordinates
+pointColumns = ['doi', 'parser', 'level', 'section']
+coordinateFields = ['coordinates', 'geo.lat', 'geo.lon', 'lat', 'lon', 'toponym_id']
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great circle distance in km between arrays of points given in degrees
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * earthRadius * np.arcsin(np.sqrt(a))
+
+
+def coordinateColumns(locations):
+    """
+    Float lat and lon Series for a locations table. Typed tables (see
+    jmapWriter.py) already have them; otherwise mordecai rows take
+    geo.lat/geo.lon and every other parser's rows parse the "lat,lon"
+    coordinates text.
+    """
+    if 'lat' in locations:
+        return locations['lat'].astype(float), locations['lon'].astype(float)
+
+    isMordecai = locations['parser'].astype(str).str.contains('mordecai')
+    lat = pd.Series(np.nan, index=locations.index)
+    lon = pd.Series(np.nan, index=locations.index)
+
+    if 'coordinates' in locations:
+        xy = locations['coordinates'].where(~isMordecai).astype('string').str.strip('()[] ').str.extract(r'^([^,]*),(.*)$')
+        lat = lat.fillna(pd.to_numeric(xy[0], errors='coerce'))
+        lon = lon.fillna(pd.to_numeric(xy[1], errors='coerce'))
+    if 'geo.lat' in locations:
+        lat = lat.where(~isMordecai, pd.to_numeric(locations['geo.lat'], errors='coerce'))
+        lon = lon.where(~isMordecai, pd.to_numeric(locations['geo.lon'], errors='coerce'))
+    return lat, lon
+
+
+def expandToponyms(locations, toponyms):
+    """
+    Compact locations rows (toponym_id and offsets, see jmapToponyms.py)
+    with their toponym's text, coordinates and place fields joined on.
+    """
+    return locations.merge(toponyms.drop(columns=['parser', 'name']), on='toponym_id', how='left')
+
+
+def concatCategorical(pieces, columns):
+    # Stack frames whose columns are categoricals with different categories, keeping them categorical
+    from pandas.api.types import union_categoricals
+    if not pieces: return pd.DataFrame(dict((c, pd.Categorical([])) for c in columns))
+    return pd.DataFrame(dict((c, union_categoricals([p[c].astype('category') for p in pieces]).remove_unused_categories())
+                             for c in columns))
+
+def loadPoints(path, dois=None, toponymsFile=None, chunkRows=100000):
+    """
+    The rows of a locations table (a CSV file or typed dataset) that have
+    coordinates, read a chunk at a time and kept only if their doi is in
+    dois: doi, parser, level and section as categoricals and lat/lon as
+    float32. Coordinates out of range are kept, for locationPoints() to count.
+    Compact rows (with a toponym_id) get their coordinates from toponymsFile.
+    """
+    from jmapWriter import locationChunks
+    dois = set(dois) if dois is not None else None
+    toponyms = None
+    if toponymsFile:
+        toponyms = pd.read_csv(toponymsFile, usecols=['toponym_id', 'lat', 'lon'], index_col='toponym_id').astype('float32')
+    dtype = dict((c, 'category') for c in pointColumns)
+    dtype.update({'coordinates': str, 'geo.lat': str, 'geo.lon': str})
+    pieces = []
+    coords = []
+    for chunk in locationChunks(path, pointColumns + coordinateFields, chunkRows, dtype):
+        if dois is not None: chunk = chunk[chunk['doi'].isin(dois)]
+        if toponyms is not None and 'toponym_id' in chunk:
+            lat, lon = chunk['toponym_id'].map(toponyms['lat']), chunk['toponym_id'].map(toponyms['lon'])
+        else:
+            lat, lon = coordinateColumns(chunk)
+        located = lat.notnull() & lon.notnull()
+        pieces.append(chunk.loc[located, pointColumns])
+        coords.append((lat[located].to_numpy(np.float32), lon[located].to_numpy(np.float32)))
+    points = concatCategorical(pieces, pointColumns)
+    points['lat'] = np.concatenate([lat for lat, lon in coords]) if coords else np.zeros(0, np.float32)
+    points['lon'] = np.concatenate([lon for lat, lon in coords]) if coords else np.zeros(0, np.float32)
+    return points
+
+
+def locationPoints(locations):
+    """
+    One row per predicted coordinate in a locations table, with float lat/lon
+    columns. Rows without coordinates, or with coordinates out of range, are
+    dropped; the number out of range is returned alongside.
+    """
+    lat, lon = coordinateColumns(locations)
+
+    located = lat.notnull() & lon.notnull()
+    inRange = lat.between(-90, 90) & lon.between(-180, 180)
+
+    points = locations.loc[located & inRange, ['doi', 'parser', 'level', 'section']].copy()
+    points['lat'] = lat[located & inRange]
+    points['lon'] = lon[located & inRange]
+    return points, int((located & ~inRange).sum())
+
+
+def truthPoints(doiList):
+    # The confirmed locations that have a doi and coordinates, keeping their row order
+    truth = doiList[doiList['doi'].notnull() & doiList['RE_Lat'].notnull() & doiList['RE_Long'].notnull()]
+    return pd.DataFrame({'doi': truth['doi'],
+                         'lat': truth['RE_Lat'].astype(float),
+                         'lon': truth['RE_Long'].astype(float),
+                         'text': truth['Coordinate Text']})
+
+
+def pairDistances(points, truth):
+    # Every distinct predicted point of a doi paired with each of its confirmed locations,
+    # the km between them, and n, how many predictions there are at that point: a place
+    # mentioned over and over only has its distance worked out once
+    unique = points.groupby(['doi', 'lat', 'lon'], sort=False, observed=True).size().reset_index(name='n')
+    m = truth.reset_index(names='truthRow').merge(unique, on='doi', how='left', suffixes=('_true', ''))
+    m['km'] = haversine(m['lat'], m['lon'], m['lat_true'], m['lon_true'])
+    m['n'] = m['n'].fillna(0)
+    return m
+
+def countWithin(m, truth, threshold):
+    # accurate/inaccurate counts per confirmed location; NaN distances (no prediction) count as neither
+    counts = pd.DataFrame({'truthRow': m['truthRow'], 'accurates': (m['km'] <= threshold) * m['n'],
+                           'inaccurates': (m['km'] > threshold) * m['n']})
+    return counts.groupby('truthRow', sort=False)[['accurates', 'inaccurates']].sum().reindex(truth.index)
+
+def checkAccuracy(points, truth, parser, threshold=threshold):
+    """
+    Count accurate (within threshold km) and inaccurate predictions for every
+    confirmed location. Returns one row per row of truth, in truth's order,
+    with the DOI, parser, correctPlace, accurates, inaccurates columns of the
+    results CSV.
+    """
+    counts = countWithin(pairDistances(points, truth), truth, threshold)
+    return pd.DataFrame({'DOI': truth['doi'].values,
+                         'parser': parser,
+                         'correctPlace': truth['text'].values,
+                         'accurates': counts['accurates'].astype(float).values,
+                         'inaccurates': counts['inaccurates'].astype(float).values})
+
+def sweepAccuracy(points, truth, parser, thresholds=sweepThresholds):
+    """
+    checkAccuracy() at several thresholds from one set of distances. The
+    rows for each threshold follow each other, with a threshold column.
+    """
+    m = pairDistances(points, truth)
+    results = []
+    for t in thresholds:
+        counts = countWithin(m, truth, t)
+        results.append(pd.DataFrame({'DOI': truth['doi'].values,
+                                     'parser': parser,
+                                     'correctPlace': truth['text'].values,
+                                     'threshold': t,
+                                     'accurates': counts['accurates'].astype(float).values,
+                                     'inaccurates': counts['inaccurates'].astype(float).values}))
+    return pd.concat(results, ignore_index=True)
+
+def nearestTruth(points, truth, index=None):
+    """
+    The nearest confirmed location to each predicted point, from any article:
+    points with nearest_doi, nearest_km and same_doi (whether it is one of
+    the point's own article's locations) columns added. Pass a GridIndex over
+    truth to reuse one across parsers.
+    """
+    from jmapSpatial import GridIndex
+    if index is None: index = GridIndex(truth['lat'], truth['lon'])
+    i, km = index.nearest(points['lat'], points['lon'])
+    out = points.copy()
+    out['nearest_doi'] = np.where(i >= 0, truth['doi'].values[np.maximum(i, 0)], None)
+    out['nearest_km'] = km
+    out['same_doi'] = out['nearest_doi'] == out['doi']
+    return out
+
+
+def evaluate(tables, doiList, threshold=threshold):
+    """
+    tables maps parser name -> locations table. Returns the results for every
+    parser in one frame, parsers in the order given, and the number of
+    out-of-range coordinates skipped per parser.
+    """
+    truth = truthPoints(doiList)
+    results = []
+    skipped = {}
+    for parser, locations in tables.items():
+        points, skipped[parser] = locationPoints(locations)
+        results.append(checkAccuracy(points, truth, parser, threshold))
+    return pd.concat(results, ignore_index=True), skipped
+
+
+def sweep(tables, doiList, thresholds=sweepThresholds):
+    """
+    Like evaluate(), at every threshold in thresholds. Also returns, per
+    parser and threshold, the share of predicted points within that distance
+    of any confirmed location in the corpus.
+    """
+    from jmapSpatial import GridIndex
+    truth = truthPoints(doiList)
+    index = GridIndex(truth['lat'], truth['lon'])
+    results = []
+    coverage = []
+    for parser, locations in tables.items():
+        points, skipped = locationPoints(locations)
+        results.append(sweepAccuracy(points, truth, parser, thresholds))
+        km = nearestTruth(points, truth, index)['nearest_km'].values
+        for t in thresholds:
+            coverage.append({'parser': parser, 'threshold': t, 'points': len(km),
+                             'near_any_truth': float((km <= t).mean()) if len(km) else np.nan})
+    return pd.concat(results, ignore_index=True), pd.DataFrame(coverage)
+
+
+def articleSums(points, truth, threshold=threshold):
+    """
+    Per confirmed article (truth's dois, in order of first appearance), the
+    sums score() works from: predictions, those within threshold km of one
+    of the article's confirmed locations (correct), the article's confirmed
+    locations (truths), those with a prediction that close (found), and the
+    km from each prediction to its nearest confirmed location, summed (km).
+    Also returns every prediction's nearest km and its count, for quantiles.
+    """
+    dois = pd.Index(truth['doi'].drop_duplicates())
+    m = pairDistances(points[points['doi'].isin(dois)], truth)
+    predicted = m[m['n'] > 0].groupby(['doi', 'lat', 'lon'], sort=False, observed=True).agg(km=('km', 'min'), n=('n', 'first'))
+    nearest = m.groupby('truthRow', sort=False)['km'].min()
+    found = pd.Series(nearest.reindex(truth.index).values <= threshold, index=truth.index)
+    doiOf = predicted.index.get_level_values('doi')
+    sums = pd.DataFrame({
+        'predictions': predicted['n'].groupby(doiOf).sum(),
+        'correct': (predicted['n'] * (predicted['km'] <= threshold)).groupby(doiOf).sum(),
+        'km': (predicted['n'] * predicted['km']).groupby(doiOf).sum()}).reindex(dois, fill_value=0)
+    sums['truths'] = truth.groupby('doi', sort=False).size().reindex(dois).values
+    sums['found'] = found.groupby(truth['doi'].values, sort=False).sum().reindex(dois).values
+    return sums[['predictions', 'correct', 'truths', 'found', 'km']].astype(float), predicted['km'].values, predicted['n'].values
+
+def ratios(sums):
+    # precision, recall, f1 and mean km from summed (predictions, correct, truths, found, km)
+    # columns, for one row of sums or a matrix of them, one row per resample
+    predictions, correct, truths, found, km = [sums[..., i] for i in range(5)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = correct / predictions
+        recall = found / truths
+        f1 = 2 * precision * recall / (precision + recall)
+        meanKm = km / predictions
+    # f1 is 0 when precision and recall are both 0, and NaN when either is undefined
+    return np.stack([precision, recall, np.where(precision + recall == 0, 0.0, f1), meanKm], axis=-1)
+
+ratioNames = ['precision', 'recall', 'f1', 'mean_km']
+
+def bootstrap(sums, resamples=1000, seed=0, block=None):
+    """
+    ratios() for `resamples` resamples of the rows of sums (one per article)
+    with replacement. The draws are a (resamples x articles) matrix of how
+    often each article is picked, made a block of resamples at a time to keep
+    it small, and the sums of every resample are one product with it.
+    """
+    sums = np.asarray(sums, dtype=float)
+    n = len(sums)
+    rng = np.random.default_rng(seed)
+    block = block or max(1, min(resamples, 20000000 // max(n, 1)))
+    out = []
+    for start in range(0, resamples, block):
+        draws = rng.multinomial(n, np.full(n, 1.0 / n), size=min(block, resamples - start))
+        out.append(ratios(draws @ sums))
+    return np.concatenate(out) if out else np.zeros((0, len(ratioNames)))
+
+def bootstrapTask(args):
+    # Process pool job: (key, sums, resamples, seed) -> (key, bootstrap ratios)
+    key, sums, resamples, seed = args
+    return key, bootstrap(sums, resamples, seed)
+
+def weightedQuantile(values, weights, q):
+    if len(values) == 0 or weights.sum() == 0: return np.nan
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order]) / weights.sum()
+    return float(values[order][min(np.searchsorted(cumulative, q), len(values) - 1)])
+
+def score(tables, doiList, threshold=threshold, resamples=1000, confidence=0.95, levels=scoreLevels,
+          workers=None, seed=0):
+    """
+    Precision, recall, F1 and distance error for every parser in tables
+    (parser -> locations table or loadPoints() output) at each of levels,
+    with bootstrap confidence intervals over the confirmed articles. One row
+    per parser, level and metric: value, ci_low and ci_high (at confidence;
+    empty for the distance quantiles and counts), plus the threshold, the
+    number of articles and resamples. workers > 1 runs the resamples in a
+    process pool; the same seed gives the same intervals either way.
+    """
+    truth = truthPoints(doiList)
+    jobs = []
+    estimates = {}
+    for parser, locations in tables.items():
+        points = locations if 'lat' in locations else locationPoints(locations)[0]
+        points = points[points['lat'].between(-90, 90) & points['lon'].between(-180, 180)]
+        for level in levels:
+            subset = points if level == 'all' else points[points['level'] == level]
+            sums, km, n = articleSums(subset, truth, threshold)
+            estimates[(parser, level)] = (ratios(sums.values.sum(axis=0)), sums, km, n)
+            # each parser and level gets its own stream of resamples, whatever runs it
+            jobs.append(((parser, level), sums.values, resamples, [seed, len(jobs)]))
+
+    if workers is None or workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            draws = dict(pool.map(bootstrapTask, jobs))
+    else:
+        draws = dict(bootstrapTask(job) for job in jobs)
+
+    alpha = (1 - confidence) / 2
+    rows = []
+    for (parser, level), (point, sums, km, n) in estimates.items():
+        common = {'parser': parser, 'level': level, 'threshold': threshold, 'articles': len(sums), 'resamples': resamples}
+        with warnings.catch_warnings():
+            # a metric with no value in any resample (no predictions at that level) has no interval
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low, high = np.nanquantile(draws[(parser, level)], [alpha, 1 - alpha], axis=0) if resamples else (point * np.nan,) * 2
+        for i, metric in enumerate(ratioNames):
+            rows.append(dict(common, metric=metric, value=point[i], ci_low=low[i], ci_high=high[i]))
+        for metric, value in (('median_km', weightedQuantile(km, n, 0.5)), ('p90_km', weightedQuantile(km, n, 0.9)),
+                              ('predictions', sums['predictions'].sum()), ('truths', sums['truths'].sum())):
+            rows.append(dict(common, metric=metric, value=value, ci_low=np.nan, ci_high=np.nan))
+    columns = ['parser', 'level', 'metric', 'value', 'ci_low', 'ci_high', 'threshold', 'articles', 'resamples']
+    return pd.DataFrame(rows, columns=columns)
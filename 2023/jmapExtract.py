@@ -0,0 +1,601 @@
+#####################################################################################
+## jmapExtract.py
+## Pull the citation information and section texts out of a publisher XML file.
+##
+## extractArticle() streams the file through lxml.etree.iterparse and builds the
+## Article and its list of Sections in a single pass, freeing elements as soon
+## as nothing still needs them, so memory per article stays bounded.
+## extractArticleSoup() is the original BeautifulSoup tree walk, kept for
+## comparison (see jmapBench.py) and as a fallback.
+##
+## extractAll() runs either of them over many files in a process pool and hands
+## the results back in order, each with its own ParseLog to merge.
+##
+## Sections nest, and each Section's text is only its own: the text of any
+## <sec> inside it belongs to that inner Section. So every span of the body is
+## sent to the geoparsers once, and its locations land in the deepest section
+## holding them. path gives the titles from the outermost section down.
+##
+## An Article keeps its title, abstract and body in one string, and a Section
+## is just offsets into the body, so the section texts sent to the geoparsers
+## are sliced out when they're needed rather than held as copies alongside it.
+##
+## Both use lxml's HTML parser, as BeautifulSoup(..., "lxml") did, so they read
+## the same files the same way: NLM/JATS and Elsevier XML, and the prettified
+## copies in this repository.
+##
+## External Dependencies
+##     lxml
+##     BeautifulSoup4 (extractArticleSoup only)
+#####################################################################################
+
+import collections, io
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from jmapLog import ParseLog
+
+
+class ExtractError(Exception):
+    pass
+
+class NoAuthorsError(ExtractError):
+    pass
+
+class UnknownFormatError(ExtractError):
+    pass
+
+
+# One <sec>: its title, where its own text (not counting the sections nested in
+# it) starts and ends in the article's body, the titles from the outermost
+# section down to it, the index of its parent in the article's list of sections
+# (-1 at the top level) and how deep it is (0 at the top level).
+Section = collections.namedtuple('Section', ['title', 'start', 'end', 'path', 'parent', 'depth'])
+
+pathSeparator = " > " # joins a Section's path into one string
+
+def sectionPaths(sections):
+    # Fill in each Section's path from its parent's; parents come before their children
+    for i, sec in enumerate(sections):
+        parentPath = sections[sec.parent].path if sec.parent >= 0 else ()
+        sections[i] = sec._replace(path=parentPath + (sec.title,))
+    return sections
+
+def layoutBody(sections, texts):
+    # The body (each section's own text followed by a space, empty ones left out)
+    # and the sections with their offsets into it
+    parts = []
+    pos = 0
+    for i, text in enumerate(texts):
+        sections[i] = sections[i]._replace(start=pos, end=pos + len(text))
+        if text:
+            parts.append(text)
+            parts.append(' ')
+            pos += len(text) + 1
+    return "".join(parts), sections
+
+def articleSections(article, sections):
+    """
+    The texts sent to the geoparsers for an article, as (level, section
+    title, section path, text): the title, the abstract, then each section's
+    own text (nested sections are separate entries, so no text goes twice).
+    """
+    out = [("title", "title", "title", article.title),
+           ("abstract", "abstract", "abstract", article.abstract)]
+    out += [("body", sec.title, pathSeparator.join(sec.path), article.section_text(sec)) for sec in sections]
+    return out
+
+
+class Article(object):
+    """
+    The citation fields of an article, and its text in one string laid out
+    as title, newline, abstract, newline, body. title, abstract and body read
+    (and set) their part of it.
+
+    Usage example:
+
+    article, sections, fmt = extractArticle(xmlFile)
+    text = article.section_text(sections[0])
+    pos = article.start_of("body", sections[0]) + row['start_char']   # in article.text
+    """
+    __slots__ = ('doi', 'year', 'no_keywords', 'no_abstract', 'url', 'publisher_abbreviation', 'publisher_name',
+                 'citation', 'first_author', 'volume_issue_pages', 'volume', 'issue', 'start_page', 'end_page',
+                 'authors', 'keywords', 'text', 'abstractStart', 'bodyStart')
+
+    def __init__(self, doi, title, year):
+        self.doi = doi
+        self.year = year
+        self.layout(title or '', '', '')
+        
+        # Set the remaining attributes to blank
+        self.no_keywords = False
+        self.no_abstract = False
+        self.url = ''
+        self.publisher_abbreviation = ''
+        self.publisher_name = ''
+        self.citation = ''
+        self.first_author = ''
+        self.volume_issue_pages = ''
+        self.volume = ''
+        self.issue = ''
+        self.start_page = ''
+        self.end_page = ''
+        self.authors = []
+        self.keywords = []
+
+    def layout(self, title, abstract, body):
+        self.text = "\n".join((title, abstract, body))
+        self.abstractStart = len(title) + 1
+        self.bodyStart = self.abstractStart + len(abstract) + 1
+
+    @property
+    def title(self):
+        return self.text[:self.abstractStart - 1]
+
+    @title.setter
+    def title(self, title):
+        self.layout(title or '', self.abstract, self.body)
+
+    @property
+    def abstract(self):
+        return self.text[self.abstractStart:self.bodyStart - 1]
+
+    @abstract.setter
+    def abstract(self, abstract):
+        self.layout(self.title, abstract or '', self.body)
+
+    @property
+    def body(self):
+        return self.text[self.bodyStart:]
+
+    @body.setter
+    def body(self, body):
+        self.layout(self.title, self.abstract, body or '')
+
+    def section_text(self, sec):
+        return self.text[self.bodyStart + sec.start:self.bodyStart + sec.end]
+
+    def start_of(self, level, sec=None):
+        # Where the text sent for a level (and section) starts in self.text, so
+        # start_of(level, sec) + start_char places a location in the whole article
+        if level == "title": return 0
+        if level == "abstract": return self.abstractStart
+        return self.bodyStart + (sec.start if sec is not None else 0)
+
+    def as_dict(self):
+        fields = dict((name, getattr(self, name)) for name in self.__slots__)
+        fields.update(title=self.title, abstract=self.abstract, body=self.body)
+        return fields
+        
+    def add_author(self, author):
+        if not author in self.authors:
+            self.authors.append(author)
+    
+    def add_keyword(self, keyword):
+        if not keyword in self.keywords:
+            self.keywords.append(keyword)
+
+    def format_authors(self):
+        return ', '.join(self.authors)
+
+    def format_keywords(self):
+        return ', '.join(self.keywords)
+
+    def format_volisspg(self):
+        #Must have a volume     
+        # check for issue
+        if self.issue: istring = "(" + str(self.issue) + ")"
+        else: istring = ''
+        # Check for pages
+        if self.end_page: pgstring = "-"+str(self.end_page)
+        else: pgstring = ""
+        if self.start_page: pgstring = ":" + str(self.start_page) + pgstring
+        vip = str(self.volume) + istring + pgstring
+        return vip
+
+    def build_citation(self):
+        citation = self.format_authors() + ". " + str(self.year) +". " + self.title + ". " + self.publisher_name + ". "
+        self.citation = citation
+        return citation
+
+
+###############################
+## Streaming extractor       ##
+###############################
+
+# Elements whose whole subtree is still needed when they close. Anything else
+# is cleared as soon as it has been handled, unless it sits inside one of these.
+# <front> and <coredata> are small, so they're simply kept whole until they close.
+keepSubtree = set(['front', 'coredata', 'sec', 'section', 'abstract', 'contrib', 'kwd', 'originaltext'])
+
+# Single-valued NLM <front> fields; the first occurrence wins, as with tree.front.find()
+frontFields = {'journal-title': 'publisher_name', 'volume': 'volume', 'issue': 'issue',
+               'fpage': 'fpage', 'elocation-id': 'elocation-id', 'lpage': 'end_page'}
+
+# Single-valued Elsevier <coredata> fields
+coreFields = {'doi': 'doi', 'title': 'title', 'coverdate': 'year', 'publicationname': 'publisher_name',
+              'volume': 'volume', 'issueidentifier': 'issue', 'startingpage': 'start_page',
+              'endingpage': 'end_page', 'description': 'abstract'}
+
+
+def localName(tag):
+    # Lower-cased tag without namespace or prefix; comments and PIs have no name
+    if not isinstance(tag, str): return ''
+    return tag.rsplit('}', 1)[-1].rsplit(':', 1)[-1].lower()
+
+def textOf(el):
+    # Like BeautifulSoup's .text, which turns whitespace-only strings into a
+    # single newline (or space)
+    return "".join(s if s.strip(' \t\n\r\f') else ('\n' if '\n' in s else ' ') for s in el.itertext())
+
+def strippedStrings(el):
+    return [s.strip() for s in el.itertext() if s.strip()]
+
+def findText(el, name):
+    # Text of the first descendant called name, or None
+    for child in el.iter():
+        if localName(child.tag) == name:
+            return textOf(child)
+    return None
+
+def ownElements(el, nested):
+    # el and its descendants, leaving out the subtree of any descendant named in nested
+    yield el
+    for child in el:
+        if localName(child.tag) in nested: continue
+        for d in ownElements(child, nested): yield d
+
+def ownStrings(el, nested):
+    # strippedStrings(el) without the text inside nested elements (their tails still count)
+    out = []
+    def walk(e):
+        if e.text and isinstance(e.tag, str): out.append(e.text)
+        for child in e:
+            if isinstance(child.tag, str) and localName(child.tag) not in nested: walk(child)
+            if child.tail: out.append(child.tail)
+    walk(el)
+    return [t.strip() for t in out if t.strip()]
+
+def ownTitle(el, name, nested):
+    # Text of the section's own title element, not that of a section inside it
+    for child in ownElements(el, nested):
+        if child is not el and localName(child.tag) == name:
+            return textOf(child)
+    return None
+
+
+def extractArticle(xmlFile, collectionKeyword='', data=None):
+    """
+    Returns (article, sections, fmt) where sections is a list of Section in
+    document order (a section before the ones nested in it). Raises
+    NoAuthorsError or UnknownFormatError for articles the importer should skip.
+    If the file's bytes have already been read, pass them as data.
+    """
+    fmt = None
+    fields = {}
+    abstract = None
+    authors = []
+    authorsOK = True
+    keywords = []
+    body = None
+    sections = []   # Section per <sec>, filled in when the element closes
+    texts = []      # and its own text
+    open_secs = []  # indexes into sections of the <sec> elements currently open
+    inFront = inCore = 0
+    keep = 0
+
+    source = io.BytesIO(data) if data is not None else xmlFile
+    for event, el in etree.iterparse(source, events=('start', 'end'), html=True, huge_tree=True, encoding='utf-8'):
+        name = localName(el.tag)
+        if event == 'start':
+            if name == 'front':
+                inFront += 1
+                fmt = fmt or "NLM"
+            elif name == 'coredata':
+                inCore += 1
+                fmt = fmt or "Elsevier"
+            elif name in ('sec', 'section'):
+                parent = open_secs[-1] if open_secs else -1
+                open_secs.append(len(sections))
+                sections.append(Section('', 0, 0, (), parent, len(open_secs) - 1))
+                texts.append('')
+            if name in keepSubtree: keep += 1
+            continue
+
+        if name in keepSubtree: keep -= 1
+
+        if name == 'front':
+            inFront -= 1
+        elif name == 'coredata':
+            inCore -= 1
+        elif name in ('sec', 'section'):
+            title = ownTitle(el, 'title' if name == 'sec' else 'section-title', ('sec', 'section'))
+            i = open_secs.pop()
+            sections[i] = sections[i]._replace(title=title if title is not None else '')
+            texts[i] = " ".join(ownStrings(el, ('sec', 'section')))
+        elif name == 'abstract':
+            abstract = textOf(el) if el.get('abstract-type') != 'precis' else ''
+        elif name == 'contrib':
+            surname, given = findText(el, 'surname'), findText(el, 'given-names')
+            if surname is None or given is None: authorsOK = False
+            else: authors.append(surname + ", " + given)
+        elif name == 'kwd':
+            keywords.append(textOf(el))
+        elif name == 'originaltext':
+            body = " ".join(strippedStrings(el))
+        elif inFront:
+            if name == 'article-id' and el.get('pub-id-type') == 'doi':
+                fields.setdefault('doi', textOf(el).strip())
+            elif name == 'article-title':
+                fields.setdefault('title', textOf(el).strip())
+            elif name == 'pub-date':
+                year = findText(el, 'year')
+                fields.setdefault('year', year.strip() if year is not None else '')
+            elif name in frontFields:
+                fields.setdefault(frontFields[name], textOf(el))
+        elif inCore:
+            if name in coreFields:
+                fields.setdefault(coreFields[name], textOf(el))
+            elif name == 'subject':
+                keywords.append(textOf(el))
+            elif name == 'creator':
+                authors.append(textOf(el))
+
+        # Free everything we've finished with
+        if keep == 0:
+            el.clear()
+            parent = el.getparent()
+            while parent is not None and el.getprevious() is not None:
+                del parent[0]
+
+    if fmt is None:
+        raise UnknownFormatError("Unknown XML format for " + xmlFile)
+
+    if fmt == "NLM":
+        article = Article(fields.get('doi', ''), '', fields.get('year', ''))
+        article.publisher_name = fields.get('publisher_name', '')
+        article.volume = fields.get('volume', '')
+        article.issue = fields.get('issue', '')
+        article.start_page = fields.get('fpage', fields.get('elocation-id', ''))
+        article.end_page = fields.get('end_page', '')
+        abstract = abstract or ''
+        if not authorsOK: authors = []
+        body, sections = layoutBody(sections, texts)
+        del texts
+    else:
+        article = Article(fields.get('doi', ''), '', fields.get('year', '')[:4])
+        article.publisher_name = fields.get('publisher_name', '')
+        article.volume = fields.get('volume', '')
+        article.issue = fields.get('issue', '')
+        article.start_page = fields.get('start_page', '')
+        article.end_page = fields.get('end_page', '')
+        abs = fields.get('abstract', '')
+        abstract = abs[8:] if abs[:8] == "Abstract" else abs
+    # the one copy of the text the article keeps
+    article.layout(fields.get('title', ''), abstract, body or '')
+
+    article.no_abstract = not abstract
+    for a in authors: article.add_author(a)
+    if not article.authors:
+        raise NoAuthorsError("No authors found for " + xmlFile)
+    for kw in keywords: article.add_keyword(kw)
+    if collectionKeyword: article.add_keyword(collectionKeyword)
+    article.no_keywords = not article.keywords
+
+    return article, sectionPaths(sections), fmt
+
+
+###############################
+## BeautifulSoup extractor   ##
+###############################
+
+def extractArticleSoup(xmlFile, collectionKeyword='', data=None):
+    """
+    The original tree walk: read the whole file into a BeautifulSoup tree and
+    search it. Same return value and exceptions as extractArticle().
+    """
+    from bs4 import BeautifulSoup
+
+    if data is None:
+        with open(xmlFile, 'rb') as f: data = f.read()
+    tree = BeautifulSoup(data.decode('utf-8'),"lxml")
+
+    #############################################
+    ## Process NLM or JATS-formatted XML files ##
+    #############################################
+    if tree.find('front'):  # NLM or JATS formatted XML
+        fmt = "NLM"
+        # Read the first three elements and create the article object
+        try: doi = tree.front.find('article-id', {'pub-id-type':'doi'}).text.strip()
+        except: doi=''
+        try: title = tree.front.find('article-title').text.strip()
+        except: title=''
+        try: year = tree.front.find('pub-date').year.text.strip()
+        except: year = ''
+
+        article = Article(doi, title, year)
+
+        # Add the other single item attributes
+        try: article.publisher_name = tree.front.find('journal-title').text
+        except: article.publisher_name = ''
+
+        try: article.volume = tree.front.find('volume').text
+        except: article.volume = ''
+
+        try: article.issue = tree.front.find('issue').text
+        except: article.issue = ''
+
+        try: article.start_page = tree.front.find('fpage').text
+        except:
+            try: article.start_page = tree.front.find('elocation-id').text
+            except: article.start_page = ''
+
+        try: article.end_page = tree.front.find('lpage').text
+        except: article.end_page = ''
+
+        try:
+            for a in tree.find_all('abstract'):
+                if not a.get('abstract-type')=='precis':
+                    article.abstract = a.text
+                else:
+                    article.abstract = ''
+            if not article.abstract: article.no_abstract = True
+        except:
+            article.abstract = ''
+            article.no_abstract = True
+
+        # Build authors list
+        try:
+            for author in tree.find_all('contrib'):
+                article.add_author(author.find('surname').text + ", " + author.find('given-names').text)
+            if len(article.authors)==0: raise
+        except:
+            raise NoAuthorsError("No authors found for " + xmlFile)
+
+        # Build keywords list
+        if tree.find('kwd'):
+            for kw in tree.find_all('kwd'):
+                article.add_keyword(kw.text)
+        if collectionKeyword: article.add_keyword(collectionKeyword)
+        if not article.keywords: article.no_keywords = True
+
+        # Retrieve article body text and sections, each with only its own text
+        sections = []
+        texts = []
+        index = {}
+        for sec in tree.find_all('sec'):
+            outer = sec.find_parent('sec')
+            parent = index[id(outer)] if outer is not None else -1
+            index[id(sec)] = len(sections)
+            secTitle = sec.find("title")
+            if secTitle and secTitle.find_parent('sec') is not sec: secTitle = None
+            nested = set(id(s) for inner in sec.find_all('sec') for s in inner._all_strings())
+            own = [s.strip() for s in sec._all_strings() if id(s) not in nested and s.strip()]
+            depth = sections[parent].depth + 1 if parent >= 0 else 0
+            sections.append(Section(secTitle.text if secTitle else '', 0, 0, (), parent, depth))
+            texts.append(" ".join(own))
+        body, sections = layoutBody(sectionPaths(sections), texts)
+        article.body = body
+
+    ########################################
+    ## Process Elsevier XML files         ##
+    ########################################
+    elif tree.find('coredata'):
+        fmt = "Elsevier"
+        # Read the first three elements and create the article object
+        try: doi = tree.coredata.find('doi').text
+        except: doi=''
+        try: title = tree.coredata.find('title').text
+        except: title=''
+        try: year = tree.coredata.find('coverDate').text[:4]
+        except: year = ''
+
+        article = Article(doi, title, year)
+
+        # Add the other single item attributes
+        try: article.publisher_name = tree.coredata.find('publicationName').text
+        except: article.publisher_name = ''
+
+        try: article.volume = tree.coredata.find('volume').text
+        except: article.volume = ''
+
+        try: article.issue = tree.coredata.find('issueIdentifier').text
+        except: article.issue = ''
+
+        try: article.start_page = tree.coredata.find('startingPage').text
+        except: article.start_page = ''
+
+        try: article.end_page = tree.coredata.find('endingPage').text
+        except: article.end_page = ''
+
+        try:
+            abs = tree.coredata.find('description').text
+            if abs[:8] == "Abstract":
+                article.abstract = abs[8:]
+            else:
+                article.abstract = abs
+            if not article.abstract: article.no_abstract = True
+        except:
+            article.abstract = ''
+            article.no_abstract = True
+
+        # Build keywords list
+        if tree.coredata.find('subject'):
+            for kw in tree.coredata.find_all('subject'):
+                article.add_keyword(kw.text)
+        if collectionKeyword: article.add_keyword(collectionKeyword)
+        if not article.keywords: article.no_keywords = True
+
+        # Build authors list
+        try:
+            for author in tree.coredata.find_all('creator'):
+                article.add_author(author.text)
+            if len(article.authors)==0: raise
+        except:
+            raise NoAuthorsError("No authors found for " + xmlFile)
+
+        # Retrieve article body text
+        article.body = " ".join(tree.find('originalText').stripped_strings)
+        sections = []
+
+    else:
+        raise UnknownFormatError("Unknown XML format for " + xmlFile)
+
+    return article, sections, fmt
+
+
+###############################
+## Extracting many files     ##
+###############################
+
+def extractLogged(xmlFile, collectionKeyword='', extractor='lxml'):
+    """
+    Extract one file, catching anything that means the article is skipped.
+    Returns (article, sections, log); article is None if it was skipped and
+    log is a ParseLog holding this article's counters, messages and the time
+    spent reading the file and extracting from it.
+    """
+    log = ParseLog()
+    log.add_msg("Processing " + xmlFile)
+    log.countArticles += 1
+    fn = extractArticle if extractor == 'lxml' else extractArticleSoup
+    try:
+        with log.timed('read'):
+            with open(xmlFile, 'rb') as f: data = f.read()
+        with log.timed('extract'):
+            article, sections, fmt = fn(xmlFile, collectionKeyword, data)
+        return article, sections, log
+    except NoAuthorsError:
+        log.add_msg("No authors found for " + xmlFile + ". Skipping this article.")
+        log.countNoAuthors += 1
+    except UnknownFormatError:
+        log.add_msg("Unknown XML format for " + xmlFile + ". Skipping this article.")
+    except Exception as inst:
+        log.add_msg("Error reading XML: " + xmlFile + " (" + type(inst).__name__ + ": " + str(inst) + ")")
+        log.countErrors += 1
+    return None, None, log
+
+def extractAll(xmlFiles, workers=1, collectionKeyword='', extractor='lxml', lookahead=None):
+    """
+    Yields (xmlFile, article, sections, log) for each of xmlFiles, in the order
+    given. With workers > 1 the files are extracted in a process pool, running
+    at most `lookahead` articles (default 4 per worker) ahead of the caller so a
+    slow consumer doesn't pile up extracted text in memory.
+    """
+    if workers <= 1:
+        for xmlFile in xmlFiles:
+            yield (xmlFile,) + extractLogged(xmlFile, collectionKeyword, extractor)
+        return
+
+    lookahead = lookahead or 4 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for xmlFile in xmlFiles:
+            pending.append((xmlFile, pool.submit(extractLogged, xmlFile, collectionKeyword, extractor)))
+            if len(pending) >= lookahead:
+                xmlFile, f = pending.popleft()
+                yield (xmlFile,) + f.result()
+        while pending:
+            xmlFile, f = pending.popleft()
+            yield (xmlFile,) + f.result()
@@ -0,0 +1,174 @@
+#####################################################################################
+## jmapGazetteer.py
+## Local geoparser: place names looked up in a GeoNames gazetteer file, no network.
+##
+## The gazetteer is a GeoNames dump (allCountries.txt, cities15000.txt, a
+## country extract, ...): tab separated, no header, with the standard columns
+## (geonameid, name, asciiname, alternatenames, latitude, longitude, feature
+## class, feature code, country code, ..., population, ...).
+##
+## Names are split into word tokens and loaded into a trie of dicts keyed on
+## those tokens, each token string interned, and every name kept only once
+## with the index of its best entry (the most populous; ties go to the first
+## in the file). Coordinates, populations and feature classes sit in arrays
+## indexed by entry. A section is scanned by tokenizing it with one regular
+## expression and walking the trie from each token for the longest name that
+## starts there, so the scan is linear in the text and names only ever match
+## whole words (no "Nice" inside "Venice"). Matching is case sensitive, which
+## keeps lower case words such as "mobile" or "reading" from matching.
+##
+## Rows come back in the same shape as the spacy/stanza/nltk responses:
+## text, start_char, end_char, coordinates ("lat,lon"), score and type.
+## score is 1 / the number of gazetteer entries sharing the name, so
+## unambiguous names score 1.
+#####################################################################################
+
+import re, sys, io
+from array import array
+from concurrent.futures import Future
+
+tokenPattern = re.compile(r"\w+(?:['’]\w+)*")
+
+# Feature classes loaded by default: A country/state/region, P city/village,
+# H stream/lake/sea, L park/area, T mountain/island, V forest/heath
+featureClasses = "APHLTV"
+
+# Entity type reported per feature class, in spaCy's labels
+featureTypes = {'A': 'GPE', 'P': 'GPE'}
+
+minNameLength = 3 # shorter names (state codes, "Ur") are nearly all false positives
+
+
+def nameTokens(name):
+    # Trie keys for a name: each token, prefixed by any punctuation between it and the
+    # previous one ("St. Louis" -> ["St", ".Louis"]), so text must match it exactly
+    keys = []
+    last = 0
+    for m in tokenPattern.finditer(name):
+        gap = name[last:m.start()].strip()
+        keys.append(sys.intern(gap + m.group() if keys else m.group()))
+        last = m.end()
+    return keys
+
+
+class Gazetteer(object):
+    """
+    Usage example:
+
+    gaz = Gazetteer('allCountries.txt', minPopulation=1000)
+    rows = gaz.geoparse("Samples were taken in the Wadden Sea near Texel.")
+    """
+    def __init__(self, path, featureClasses=featureClasses, minPopulation=0, alternateNames=False):
+        self.path = path
+        self.lat = array('d')
+        self.lon = array('d')
+        self.population = array('q')
+        self.classes = []
+        self.trie = {}
+        self.countNames = 0
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) < 15 or cols[6] not in featureClasses: continue
+                try:
+                    lat, lon, pop = float(cols[4]), float(cols[5]), int(cols[14] or 0)
+                except ValueError:
+                    continue
+                if pop < minPopulation and cols[6] == 'P': continue
+                entry = len(self.lat)
+                self.lat.append(lat)
+                self.lon.append(lon)
+                self.population.append(pop)
+                self.classes.append(cols[6])
+                names = set([cols[1], cols[2]])
+                if alternateNames: names.update(n for n in cols[3].split(',') if n)
+                for name in names:
+                    self.add(name, entry)
+
+    def add(self, name, entry):
+        if len(name) < minNameLength or not name[0].isupper(): return
+        keys = nameTokens(name)
+        if not keys: return
+        node = self.trie
+        for key in keys:
+            node = node.setdefault(key, {})
+        # a name's node holds (best entry, number of entries with the name) under None
+        if None not in node:
+            self.countNames += 1
+            node[None] = (entry, 1)
+        else:
+            best, n = node[None]
+            node[None] = (entry if self.population[entry] > self.population[best] else best, n + 1)
+
+    def __len__(self):
+        return self.countNames
+
+    def geoparse(self, text):
+        # The place names in text, longest match first at each position, as response rows
+        rows = []
+        tokens = [(m.start(), m.end(), m.group()) for m in tokenPattern.finditer(text)]
+        trie = self.trie
+        i = 0
+        while i < len(tokens):
+            node = trie.get(tokens[i][2])
+            if node is None:
+                i += 1
+                continue
+            match = (i, node[None]) if None in node else None
+            j = i + 1
+            while j < len(tokens):
+                gap = text[tokens[j - 1][1]:tokens[j][0]]
+                if '\n' in gap: break
+                node = node.get(gap.strip() + tokens[j][2])
+                if node is None: break
+                if None in node: match = (j, node[None])
+                j += 1
+            if match is None:
+                i += 1
+                continue
+            last, (entry, n) = match
+            start, end = tokens[i][0], tokens[last][1]
+            rows.append({"coordinates": "%s,%s" % (self.lat[entry], self.lon[entry]),
+                         "end_char": end,
+                         "score": 1.0 / n,
+                         "start_char": start,
+                         "text": text[start:end],
+                         "type": featureTypes.get(self.classes[entry], 'LOC')})
+            i = last + 1
+        return rows
+
+
+class GazetteerClient(object):
+    """
+    Stands in for a GeoClient (jmapClient.py) so the parse script can use the
+    gazetteer as one more parser. The lookups are fast enough to run in the
+    caller's thread, so the futures come back already resolved.
+    """
+    def __init__(self, path, **kwds):
+        self.gazetteer = Gazetteer(path, **kwds)
+        # GeoClient's counters, for the run summary; no requests go anywhere
+        self.countRequests = 0
+        self.countRetries = 0
+        self.countBatched = 0
+        self.countChunked = 0
+
+    def parse(self, text):
+        return self.gazetteer.geoparse(text or '')
+
+    def submit_many(self, texts):
+        futures = []
+        for text in texts:
+            f = Future()
+            f.set_running_or_notify_cancel()
+            try:
+                f.set_result(self.parse(text))
+            except Exception as inst:
+                f.set_exception(inst)
+            futures.append(f)
+        return futures
+
+    def parse_many(self, texts):
+        return [f.result() for f in self.submit_many(texts)]
+
+    def close(self):
+        pass
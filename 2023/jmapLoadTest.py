@@ -0,0 +1,141 @@
+#####################################################################################
+## jmapLoadTest.py
+## Load test of the geoparse client (jmapClient.py) against the mock API.
+##
+## Usage:
+##     python jmapLoadTest.py [xmlDir] [--parser spacy-lg] [--articles 50]
+##                            [--concurrency 1,4,8,16] [--batch-bytes 0,262144]
+##                            [--rate 1000] [--url URL] [--out results.json]
+##                            [mock server options: --replay, --latency, --jitter,
+##                             --per-kchar, --error-rate, --throttle, --seed, ...]
+##
+## The texts are the title, abstract and sections of the XML files in xmlDir
+## (by default the articles bundled with this repository), as the parse script
+## would send them. Unless --url points at a running server, a mock server
+## (jmapMockServer.py) is started in this process with the given latency,
+## errors and throttling. Every combination of --concurrency and --batch-bytes
+## then sends the whole corpus, a fresh client each time, and reports texts and
+## requests per second, retries and failures, the latency of single requests
+## and of whole articles (submitted to all answered) at p50/p95/p99, which is
+## what to look at when tuning jmapClient.endpoints.
+#####################################################################################
+
+import os, sys, glob, time, json, argparse, threading
+
+from jmapClient import GeoClient
+from jmapExtract import extractArticle, articleSections, ExtractError
+from jmapLog import ParseLog
+from jmapMockServer import serve, addArguments, apiFromArguments
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def corpusTexts(xmlFiles):
+    # The texts of each article, as the parse script sends them
+    out = []
+    for xmlFile in xmlFiles:
+        try:
+            article, sections, fmt = extractArticle(xmlFile)
+        except ExtractError:
+            continue
+        out.append([text for level, title, path, text in articleSections(article, sections)])
+    return out
+
+def percentile(values, q):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+def runLoad(articles, parser, url, concurrency, batchBytes, rate):
+    """
+    Send every article's texts through one client at once and wait for them
+    all. Returns a dict of throughput, failures and latencies.
+    """
+    log = ParseLog()
+    client = GeoClient(parser, url=url, concurrency=concurrency, rate=rate, burst=concurrency,
+                       batchBytes=batchBytes, log=log)
+    articleSeconds = []
+    failed = [0]
+    lock = threading.Lock()
+    def watch(futures, t0):
+        # Record the article's latency when its last text is answered
+        remaining = [len(futures)]
+        def done(f):
+            with lock:
+                if f.exception() is not None: failed[0] += 1
+                remaining[0] -= 1
+                if remaining[0] == 0: articleSeconds.append(time.perf_counter() - t0)
+        for f in futures: f.add_done_callback(done)
+    t0 = time.perf_counter()
+    try:
+        futures = []
+        for texts in articles:
+            mine = client.submit_many(texts)
+            watch(mine, time.perf_counter())
+            futures += mine
+        for f in futures:
+            try: f.result()
+            except Exception: pass
+        elapsed = time.perf_counter() - t0
+    finally:
+        client.close()
+    stats = log.endpoint(parser)
+    ntexts = sum(len(texts) for texts in articles)
+    return {"concurrency": concurrency, "batch_bytes": batchBytes, "seconds": elapsed,
+            "texts": ntexts, "texts_per_s": ntexts / elapsed, "requests": stats.requests,
+            "requests_per_s": stats.requests / elapsed, "retries": stats.retries, "http_errors": stats.errors,
+            "failed_texts": failed[0], "bytes_sent": stats.bytesSent,
+            "request_p50": stats.latency.percentile(50), "request_p95": stats.latency.percentile(95),
+            "request_p99": stats.latency.percentile(99),
+            "article_p50": percentile(articleSeconds, 50), "article_p95": percentile(articleSeconds, 95),
+            "article_p99": percentile(articleSeconds, 99)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Load test the geoparse client against the mock API")
+    ap.add_argument("xmlDir", nargs="?", default=repoDir)
+    ap.add_argument("--parser", default="spacy-lg")
+    ap.add_argument("--articles", type=int, default=0, help="use only this many articles (0 for all)")
+    ap.add_argument("--concurrency", default="1,4,8,16")
+    ap.add_argument("--batch-bytes", dest="batchBytes", default="0,262144", help="0 sends one request per text")
+    ap.add_argument("--rate", type=float, default=1000.0, help="client rate limit, requests per second")
+    ap.add_argument("--url", default=None, help="a running server's endpoint, instead of a mock in this process")
+    ap.add_argument("--out", default=None, help="write the results to this JSON file")
+    addArguments(ap)
+    args = ap.parse_args()
+
+    xmlFiles = sorted(glob.glob(os.path.join(args.xmlDir, "*.xml")))
+    articles = corpusTexts(xmlFiles[:args.articles] if args.articles else xmlFiles)
+    if not articles:
+        sys.exit("No articles in " + args.xmlDir)
+
+    server = None
+    url = args.url
+    if url is None:
+        api = apiFromArguments(args)
+        server = serve(api)
+        url = "http://127.0.0.1:" + str(server.server_address[1]) + "/api/" + args.parser
+
+    ms = lambda s: "-" if s is None else "%.0f" % (1000.0 * s)
+    print("%d articles, %d texts, to %s" % (len(articles), sum(len(t) for t in articles), url))
+    print("%5s %8s %8s %8s %8s %7s %6s %7s %7s %7s %8s %8s" % ("conc", "batch", "texts/s", "req/s", "requests", "retries",
+                                                          "failed", "req p50", "req p95", "req p99", "art p95", "art p99"))
+    results = []
+    try:
+        for batchBytes in [int(b) for b in args.batchBytes.split(",")]:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                r = runLoad(articles, args.parser, url, concurrency, batchBytes, args.rate)
+                results.append(r)
+                print("%5d %8d %8.1f %8.1f %8d %7d %6d %7s %7s %7s %8s %8s" %
+                      (concurrency, batchBytes, r["texts_per_s"], r["requests_per_s"], r["requests"], r["retries"],
+                       r["failed_texts"], ms(r["request_p50"]), ms(r["request_p95"]), ms(r["request_p99"]),
+                       ms(r["article_p95"]), ms(r["article_p99"])))
+    finally:
+        if server is not None:
+            server.shutdown()
+            print("Mock server: " + ", ".join(k + " " + str(v) for k, v in server.api.counts.items()))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print("Results written to " + args.out)
@@ -0,0 +1,217 @@
+#####################################################################################
+## jmapLog.py
+## Run log for the JournalMap parse scripts: counters, messages, and timings.
+##
+## Besides the counters and the list of messages written to the log file at
+## the end of a run, a ParseLog keeps
+##     - wall time per stage (read, extract, geoparse, frames, write), for the
+##       article in hand and for the whole run
+##     - per geoparser endpoint, a latency histogram of its HTTP requests, the
+##       bytes sent and received and the number of retries
+## and, given an events file, streams everything as it happens to it as JSON
+## lines ({"t": ..., "event": ..., ...}), flushed line by line, so a run that
+## dies still leaves its record behind. summary() gives the end-of-run report.
+##
+## Worker processes keep their own ParseLog per article and the main process
+## merges them.
+#####################################################################################
+
+import json, math, time, threading, contextlib
+
+# Stages timed per article, in pipeline order
+stages = ['read', 'extract', 'geoparse', 'frames', 'write']
+
+
+class LatencyHistogram(object):
+    """
+    Request latencies in log-spaced buckets (10 per decade, 0.1 ms to 10000 s),
+    so percentiles come from a fixed amount of memory however long the run.
+    """
+    perDecade = 10
+    low = 1e-4
+    nbuckets = 80
+
+    def __init__(self):
+        self.counts = [0] * (self.nbuckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = 0 if seconds <= self.low else int(math.log10(seconds / self.low) * self.perDecade) + 1
+        self.counts[min(i, self.nbuckets)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def upper(self, i):
+        # upper edge of bucket i in seconds
+        return self.low * 10 ** (float(i) / self.perDecade)
+
+    def percentile(self, q):
+        # Upper edge of the bucket holding the q-th percentile (never above the max seen)
+        if not self.count: return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.upper(i), self.max)
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        for key in ('requests', 'errors', 'retries', 'bytesSent', 'bytesReceived'):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        return self
+
+
+class ParseLog(object):
+    def __init__(self, eventsFile=None):
+        self.messages = []
+        self.countArticles = 0
+        self.countGeoTagged = 0
+        self.locations = 0
+        self.countErrors = 0
+        self.countNoAuthors = 0
+        self.countArticlesWritten = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.countUnchanged = 0
+        self.countSectionsSkipped = 0
+        self.charsSkipped = 0
+        self.stageSeconds = dict((s, 0.0) for s in stages)   # whole run
+        self.articleSeconds = dict((s, 0.0) for s in stages) # article in hand
+        self.endpoints = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.events = open(eventsFile, 'a', encoding='utf-8', buffering=1) if eventsFile else None
+
+    def __getstate__(self):
+        # Worker logs travel between processes without their lock or events file
+        state = dict(vars(self))
+        state['lock'] = None
+        state['events'] = None
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.lock = threading.Lock()
+
+    def event(self, kind, **fields):
+        # Stream one JSON line to the events file, if there is one
+        if self.events is None: return
+        record = {"t": round(time.time(), 3), "event": kind}
+        record.update(fields)
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            self.events.write(line)
+
+    def add_msg(self, msg):
+        self.messages.append(msg)
+        self.event("message", text=msg)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stageSeconds[stage] = self.stageSeconds.get(stage, 0.0) + seconds
+            self.articleSeconds[stage] = self.articleSeconds.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        # with log.timed('write'): ...  adds the block's wall time to that stage
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    def end_article(self, xmlFile, **fields):
+        # Report the article just finished with its stage times, and start afresh
+        with self.lock:
+            seconds = dict((s, round(t, 6)) for s, t in self.articleSeconds.items())
+            self.articleSeconds = dict((s, 0.0) for s in stages)
+        self.event("article", file=xmlFile, seconds=seconds, **fields)
+
+    def endpoint(self, parser):
+        if parser not in self.endpoints: self.endpoints[parser] = EndpointStats()
+        return self.endpoints[parser]
+
+    def record_request(self, parser, seconds, sent, received, status):
+        # One HTTP request to a geoparser endpoint, whatever its outcome
+        with self.lock:
+            stats = self.endpoint(parser)
+            stats.latency.add(seconds)
+            stats.requests += 1
+            stats.bytesSent += sent
+            stats.bytesReceived += received
+            if status is None or status >= 400: stats.errors += 1
+        self.event("request", parser=parser, seconds=round(seconds, 6), sent=sent, received=received, status=status)
+
+    def record_retry(self, parser, reason):
+        with self.lock:
+            self.endpoint(parser).retries += 1
+        self.event("retry", parser=parser, reason=reason)
+
+    def merge(self, other):
+        # Add another log's counters, timings and messages to this one
+        for key, value in vars(other).items():
+            if key == 'messages':
+                self.messages.extend(value)
+                for msg in value: self.event("message", text=msg)
+            elif key == 'stageSeconds':
+                for stage, seconds in value.items(): self.add_time(stage, seconds)
+            elif key == 'endpoints':
+                for parser, stats in value.items():
+                    with self.lock: self.endpoint(parser).merge(stats)
+            elif key in ('articleSeconds', 'started'):
+                continue
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                setattr(self, key, getattr(self, key, 0) + value)
+        return self
+
+    def summary(self):
+        # The end-of-run report, as lines of text
+        n = max(self.countArticles, 1)
+        lines = ["Processed " + str(self.countArticles) + " articles in " + "%.1f" % (time.time() - self.started) + " s.",
+                 str(self.countUnchanged) + " articles unchanged since the last run, not parsed again.",
+                 "Errors encountered in " + str(self.countErrors) + " articles.",
+                 str(self.countNoAuthors) + " articles had no authors and were skipped.",
+                 str(self.countArticlesWritten) + " articles written to the articles CSV files.",
+                 str(self.countGeoTagged) + " articles had parsed coordinates.",
+                 str(self.locations) + " total locations found.",
+                 str(self.countSectionsSkipped) + " sections (" + str(self.charsSkipped) + " characters) left out by the section filter.",
+                 "Time per stage (total, per article):"]
+        for stage, seconds in self.stageSeconds.items():
+            lines.append("    %-9s %10.1f s %9.1f ms" % (stage, seconds, 1000.0 * seconds / n))
+        for parser, stats in self.endpoints.items():
+            h = stats.latency
+            ms = lambda s: "-" if s is None else "%.0f ms" % (1000.0 * s)
+            lines.append(parser + ": " + str(stats.requests) + " requests (" + str(stats.errors) + " failed, " +
+                         str(stats.retries) + " retries), latency p50 " + ms(h.percentile(50)) + ", p95 " +
+                         ms(h.percentile(95)) + ", p99 " + ms(h.percentile(99)) + ", max " + ms(h.max if h.count else None) +
+                         "; " + "%.1f" % (stats.bytesSent / 1024.0**2) + " MB sent, " +
+                         "%.1f" % (stats.bytesReceived / 1024.0**2) + " MB received.")
+        return lines
+
+    def close(self):
+        self.event("summary", lines=self.summary())
+        if self.events is not None:
+            self.events.close()
+            self.events = None
@@ -0,0 +1,151 @@
+#####################################################################################
+## jmapManifest.py
+## Run manifest for resumable parse runs.
+##
+## The manifest is a CSV with one line per (article XML file, parser) recording
+## the file's size, mtime and SHA-1, the article's doi and how far it got:
+## "started", "done", "failed" or "skipped" (no authors, unknown format). It
+## shares the doi and xmlfile columns of the PLOSOne_manfest.*.csv files.
+##
+## Lines are only ever appended, and flushed to disk as they're written; the
+## last line for a key wins. On start-up the file is compacted, and rows for
+## articles that were left half-written or have changed since are purged from
+## the output CSVs so they can be parsed again cleanly.
+#####################################################################################
+
+import os, io, csv, hashlib, time
+
+fields = ['doi', 'xmlfile', 'parser', 'size', 'mtime', 'sha1', 'status', 'updated']
+
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def appendDurably(path, data):
+    # One write of the whole block, then flush it through to disk
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def csvLine(values):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(values)
+    return buf.getvalue()
+
+def purgeRows(csvFile, dois, parser=None):
+    """
+    Rewrite csvFile without the rows whose doi column is in dois (and, if the
+    file has a parser column and parser is given, only that parser's rows).
+    Streams the file through the csv module, so values are copied through
+    untouched, and swaps the new file into place in one step. A typed
+    locations dataset directory (jmapWriter.py) is purged part by part.
+    """
+    if dois and os.path.isdir(csvFile):
+        from jmapWriter import purgeParts
+        return purgeParts(csvFile, dois, parser)
+    if not dois or not os.path.isfile(csvFile): return 0
+    # keep the rows' line endings, going by the last one; pandas and unicodecsv
+    # don't write the same ones, and the locations files have a unicodecsv
+    # header over pandas rows
+    with open(csvFile, 'rb') as f:
+        f.seek(max(0, os.path.getsize(csvFile) - 2))
+        eol = '\r\n' if f.read() == b'\r\n' else '\n'
+    tmpFile = csvFile + '.tmp'
+    dropped = 0
+    with open(csvFile, newline='', encoding='utf-8') as src, open(tmpFile, 'w', newline='', encoding='utf-8') as dst:
+        headerLine = src.readline()
+        if not headerLine: return 0
+        dst.write(headerLine)
+        header = next(csv.reader([headerLine]))
+        reader = csv.reader(src)
+        writer = csv.writer(dst, lineterminator=eol)
+        col = header.index('doi')
+        pcol = header.index('parser') if parser and 'parser' in header else None
+        for row in reader:
+            if len(row) > col and row[col] in dois and (pcol is None or row[pcol] == parser):
+                dropped += 1
+            else:
+                writer.writerow(row)
+    os.replace(tmpFile, csvFile)
+    return dropped
+
+
+class RunManifest(object):
+    """
+    Usage example:
+
+    manifest = RunManifest(outDir + '/manifest_spacy-lg_2023.csv')
+    manifest.purge('spacy-lg', [locationsFile, articlesFile])
+    for xmlFile in files:
+        if manifest.needs(xmlFile, 'spacy-lg'):
+            manifest.record(xmlFile, 'spacy-lg', doi, 'started')
+            ... write rows ...
+            manifest.record(xmlFile, 'spacy-lg', doi, 'done')
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.stamps = {}
+        if os.path.isfile(path):
+            with open(path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    self.entries[(row['xmlfile'], row['parser'])] = row
+        self.compact()
+
+    def compact(self):
+        # Rewrite the manifest with only the latest line per key
+        tmpFile = self.path + '.tmp'
+        with open(tmpFile, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for row in self.entries.values():
+                writer.writerow(row)
+        os.replace(tmpFile, self.path)
+
+    def stamp(self, xmlFile):
+        # (size, mtime) of the file now; the hash is only worked out if needed
+        if xmlFile not in self.stamps:
+            st = os.stat(xmlFile)
+            self.stamps[xmlFile] = {'size': str(st.st_size), 'mtime': repr(st.st_mtime), 'sha1': None}
+        return self.stamps[xmlFile]
+
+    def changed(self, xmlFile, entry):
+        if not os.path.isfile(xmlFile): return False
+        now = self.stamp(xmlFile)
+        if now['size'] == entry['size'] and now['mtime'] == entry['mtime']: return False
+        # touched but maybe not edited; the content decides
+        if now['sha1'] is None: now['sha1'] = fileHash(xmlFile)
+        return now['sha1'] != entry['sha1']
+
+    def needs(self, xmlFile, parser):
+        # New, changed, or not finished last time?
+        entry = self.entries.get((xmlFile, parser))
+        if entry is None: return True
+        if entry['status'] not in ('done', 'skipped'): return True
+        return self.changed(xmlFile, entry)
+
+    def staleDois(self, parser):
+        # dois whose rows from this parser can't be trusted: half-written or since changed
+        stale = set()
+        for (xmlFile, p), entry in self.entries.items():
+            if p == parser and entry['doi'] and (entry['status'] in ('started', 'failed') or self.changed(xmlFile, entry)):
+                stale.add(entry['doi'])
+        return stale
+
+    def purge(self, parser, csvFiles):
+        # Drop this parser's stale rows from the output files; returns the number of rows dropped
+        stale = self.staleDois(parser)
+        return sum(purgeRows(f, stale, parser) for f in csvFiles)
+
+    def record(self, xmlFile, parser, doi, status):
+        now = self.stamp(xmlFile)
+        if now['sha1'] is None: now['sha1'] = fileHash(xmlFile)
+        row = {'doi': doi, 'xmlfile': xmlFile, 'parser': parser, 'size': now['size'], 'mtime': now['mtime'],
+               'sha1': now['sha1'], 'status': status, 'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.entries[(xmlFile, parser)] = row
+        appendDurably(self.path, csvLine([row[k] for k in fields]).encode('utf-8'))
@@ -0,0 +1,267 @@
+#####################################################################################
+## jmapMockServer.py
+## A stand-in for the geolocate API, for testing and load testing the parse
+## script offline.
+##
+## Usage:
+##     python jmapMockServer.py [--port 8765] [--replay locations_*_2023.csv]
+##                              [--cache geoparse_cache.sqlite] [--latency 0.2]
+##                              [--jitter 0.5] [--per-kchar 0.05] [--error-rate 0.01]
+##                              [--throttle 10] [--burst 10] [--seed 1]
+##
+## then run the parse script with --api-url http://127.0.0.1:8765/api/ (or set
+## apiURL in its config) to parse with no network. POST text to
+## /api/<parser> for one response, or {"texts": [...]} to /api/<parser>/batch
+## for a list of responses, one per text.
+##
+## Answers come from, in order:
+##     --cache    a response cache the parse script filled (jmapCache.py), which
+##                replays the real response for any text it has seen, verbatim
+##     --replay   the place names in earlier locations_<parser>_2023.csv files,
+##                each resolved as the parser resolved it there and found in the
+##                text by whole-word matching
+##     otherwise  a small built-in gazetteer
+## and come back shaped like the real parsers' (mordecai's, or the
+## spacy/stanza/nltk ones).
+##
+## To look like the real service under load, the server can hold each request
+## for a random time (log-normal around --latency seconds, plus --per-kchar
+## seconds per 1000 characters of text, as the models' time grows with the
+## text), fail a share of them with 503 (--error-rate) and allow only
+## --throttle requests per second, answering 429 with a Retry-After header
+## beyond that. jmapLoadTest.py drives the client against it.
+#####################################################################################
+
+import json, re, argparse, math, random, threading, time, glob
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# name: (lat, lon)
+places = {
+    "Australia": (-25.0, 135.0),
+    "Brazil": (-10.0, -55.0),
+    "California": (37.0, -120.0),
+    "Wadden Sea": (53.57, 6.95),
+    "Kenya": (1.0, 38.0),
+    "Panama": (9.0, -80.0),
+    "Greenland": (72.0, -40.0),
+    "Tasmania": (-42.0, 147.0),
+}
+
+
+def geoparse(parser, text):
+    # The rows a parser would return for text
+    out = []
+    for name, (lat, lon) in places.items():
+        for m in re.finditer(re.escape(name), text):
+            if parser == 'mordecai':
+                out.append({"word": name, "spans": [{"start": m.start(), "end": m.end()}],
+                            "country_predicted": "XXX", "country_conf": 0.9,
+                            "geo": {"lat": str(lat), "lon": str(lon), "place_name": name,
+                                    "feature_class": "A", "feature_code": "PCLI", "geonameid": "1",
+                                    "admin1": "NA", "country_code3": "XXX"}})
+            else:
+                out.append({"text": name, "start_char": m.start(), "end_char": m.end(),
+                            "coordinates": "%s,%s" % (lat, lon), "score": 10.0, "type": "GPE"})
+    return out
+
+
+def number(value):
+    try: return float(value)
+    except ValueError: return value
+
+class ReplayGazetteer(object):
+    """
+    The place names parsers found in earlier runs, from locations CSV files,
+    each with the first resolution its parser gave it.
+
+    Usage example:
+
+    replay = ReplayGazetteer(glob.glob('locations_*_2023.csv'))
+    rows = replay.geoparse('spacy-lg', "Samples came from the Wadden Sea.")
+    """
+    def __init__(self, locationsFiles):
+        import pandas as pd
+        self.templates = {}   # parser -> {name: row without offsets}
+        self.patterns = {}    # parser -> regex matching any of its names
+        for path in locationsFiles:
+            df = pd.read_csv(path, dtype=str, keep_default_na=False)
+            df = df[df['status'] == 'True']
+            for parser, rows in df.groupby('parser', sort=False):
+                names = self.templates.setdefault(parser, {})
+                for row in rows.to_dict('records'):
+                    name = row.get('word') if parser == 'mordecai' else row.get('text')
+                    if name and name not in names: names[name] = self.template(parser, row)
+        for parser, names in self.templates.items():
+            alternatives = "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+            self.patterns[parser] = re.compile(r'(?<!\w)(?:' + alternatives + r')(?!\w)')
+
+    def template(self, parser, row):
+        if parser == 'mordecai':
+            geo = dict((k[len('geo.'):], v) for k, v in row.items() if k.startswith('geo.') and v != '')
+            out = {"word": row['word'], "country_predicted": row.get('country_predicted', ''),
+                   "country_conf": number(row.get('country_conf', ''))}
+            if geo: out["geo"] = geo
+            return out
+        return {"text": row['text'], "coordinates": row.get('coordinates', ''),
+                "score": number(row.get('score', '')), "type": row.get('type', '')}
+
+    def __contains__(self, parser):
+        return parser in self.patterns
+
+    def geoparse(self, parser, text):
+        out = []
+        names = self.templates[parser]
+        for m in self.patterns[parser].finditer(text):
+            row = dict(names[m.group()])
+            if parser == 'mordecai':
+                row["spans"] = [{"start": m.start(), "end": m.end()}]
+            else:
+                row["start_char"], row["end_char"] = m.start(), m.end()
+            out.append(row)
+        return out
+
+
+class MockAPI(object):
+    """
+    Where the mock server's answers come from, and the latency, errors and
+    throttling it adds. The defaults answer at once from the built-in
+    gazetteer, as a plain MockHandler server does.
+
+    Usage example:
+
+    api = MockAPI(replay=ReplayGazetteer(files), latency=0.2, errorRate=0.01, throttle=8)
+    server = serve(api, port=0)
+    """
+    def __init__(self, replay=None, cache=None, latency=0.0, jitter=0.5, perKChar=0.0,
+                 errorRate=0.0, throttle=0.0, burst=None, seed=None):
+        self.replay = replay
+        self.cache = cache
+        self.latency = latency
+        self.jitter = jitter
+        self.perKChar = perKChar
+        self.errorRate = errorRate
+        self.throttle = throttle
+        self.burst = burst or max(1.0, throttle)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.counts = {'requests': 0, 'texts': 0, 'errors': 0, 'throttled': 0, 'replayed': 0}
+
+    def count(self, key, n=1):
+        with self.lock: self.counts[key] += n
+
+    def geoparse(self, parser, text):
+        if self.cache is not None:
+            body = self.cache.get(parser, text.encode('utf-8'))
+            if body is not None:
+                self.count('replayed')
+                return json.loads(body)
+        if self.replay is not None and parser in self.replay:
+            return self.replay.geoparse(parser, text)
+        return geoparse(parser, text)
+
+    def admit(self):
+        # None if a request may go ahead now, or the seconds until it could (throttled)
+        if not self.throttle: return None
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.throttle)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.throttle
+
+    def fails(self):
+        with self.lock: return self.errorRate > 0 and self.random.random() < self.errorRate
+
+    def delay(self, nchars):
+        # How long to hold a request carrying nchars of text
+        with self.lock:
+            base = self.random.lognormvariate(math.log(self.latency), self.jitter) if self.latency > 0 else 0.0
+        return base + self.perKChar * nchars / 1000.0
+
+defaultAPI = MockAPI()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, obj, headers=()):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers: self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        api = getattr(self.server, 'api', defaultAPI)
+        parts = self.path.strip('/').split('/')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        api.count('requests')
+        wait = api.admit()
+        if wait is not None:
+            api.count('throttled')
+            return self.reply(429, {"error": "too many requests"}, [('Retry-After', "%.3f" % wait)])
+        if len(parts) == 2 and parts[0] == 'api':
+            texts = [body.decode('utf-8')]
+        elif len(parts) == 3 and parts[0] == 'api' and parts[2] == 'batch':
+            texts = json.loads(body.decode('utf-8'))['texts']
+        else:
+            return self.reply(404, {"error": "no such route: " + self.path})
+        time.sleep(api.delay(sum(len(t) for t in texts)))
+        if api.fails():
+            api.count('errors')
+            return self.reply(503, {"error": "injected failure"})
+        api.count('texts', len(texts))
+        results = [api.geoparse(parts[1], text) for text in texts]
+        self.reply(200, results[0] if len(parts) == 2 else results)
+
+
+def serve(api=None, host='127.0.0.1', port=0):
+    # A mock server for api in a background thread; port 0 picks a free one
+    # (server.server_address[1]). Stop it with server.shutdown().
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.api = api or defaultAPI
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def addArguments(ap):
+    # The options that configure a MockAPI, shared with jmapLoadTest.py
+    ap.add_argument("--replay", nargs="*", default=None, help="locations CSV files to replay place names from")
+    ap.add_argument("--cache", default=None, help="response cache (sqlite) to replay exact responses from")
+    ap.add_argument("--latency", type=float, default=0.0, help="median seconds to hold each request")
+    ap.add_argument("--jitter", type=float, default=0.5, help="log-normal sigma of the latency")
+    ap.add_argument("--per-kchar", dest="perKChar", type=float, default=0.0, help="extra seconds per 1000 characters")
+    ap.add_argument("--error-rate", dest="errorRate", type=float, default=0.0, help="share of requests failed with 503")
+    ap.add_argument("--throttle", type=float, default=0.0, help="requests per second allowed (429 beyond)")
+    ap.add_argument("--burst", type=float, default=None)
+    ap.add_argument("--seed", type=int, default=None)
+
+def apiFromArguments(args):
+    replay = None
+    if args.replay is not None:
+        files = [f for pattern in (args.replay or ['locations_*_2023.csv']) for f in sorted(glob.glob(pattern))]
+        replay = ReplayGazetteer(files)
+    cache = None
+    if args.cache:
+        from jmapCache import ResponseCache
+        cache = ResponseCache(args.cache)
+    return MockAPI(replay, cache, args.latency, args.jitter, args.perKChar, args.errorRate,
+                   args.throttle, args.burst, args.seed)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Mock geolocate API")
+    ap.add_argument("--port", type=int, default=8765)
+    addArguments(ap)
+    args = ap.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), MockHandler)
+    server.api = apiFromArguments(args)
+    print("Mock geolocate API on http://127.0.0.1:" + str(args.port) + "/api/")
+    server.serve_forever()
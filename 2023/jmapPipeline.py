@@ -0,0 +1,193 @@
+#####################################################################################
+## jmapPipeline.py
+## Run items through a chain of stages, each in its own threads, joined by
+## bounded queues.
+##
+## A Pipeline takes items from a source (any iterable, e.g. a generator
+## walking a directory) and passes each through its stages in turn. Every
+## stage has its own worker threads and a bounded queue in front of it, so a
+## fast stage blocks once it is far enough ahead of a slow one. On top of that,
+## at most `window` items are anywhere in the pipeline at once, counting the
+## one the caller has in hand, which keeps memory flat however big the source.
+## Items come out of the last stage in source order, for the caller to
+## consume (the parse script writes them there, in its own thread).
+##
+## Threads suit the parse script's stages: the geoparse stage spends its time
+## waiting on sockets, and extraction either runs in a process pool or in lxml.
+##
+## Shutdown: if a stage raises, or the caller stops iterating (an error while
+## writing, Ctrl-C), no more items are taken from the source, each worker
+## finishes the item in hand and the threads are joined. Nothing downstream of
+## the caller happens for items it never received, so output written by the
+## caller is never left half done. A stage's exception is raised again to the
+## caller once the threads have stopped.
+#####################################################################################
+
+import threading, queue, time
+
+# Marks the end of the items in a queue
+done = object()
+
+
+class StageStats(object):
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0      # seconds spent in the stage function, over all workers
+        self.blocked = 0.0   # seconds spent waiting for room in the next queue
+        self.lock = threading.Lock()
+
+    def add(self, busy, blocked):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.blocked += blocked
+
+
+class Pipeline(object):
+    """
+    Usage example:
+
+    pipe = Pipeline(walkXML(startDir), window=32)
+    pipe.stage('extract', extractOne, workers=2)
+    pipe.stage('geoparse', geoparseOne, workers=4)
+    with pipe:
+        for item in pipe:
+            write(item)
+    """
+    poll = 0.1 # how often blocked threads check whether the pipeline is stopping
+
+    def __init__(self, source, window=16):
+        self.source = source
+        self.window = threading.Semaphore(window)
+        self.stages = []
+        self.queues = []
+        self.threads = []
+        self.stopping = threading.Event()
+        self.error = None
+        self.started = None
+
+    def stage(self, name, fn, workers=1, maxsize=None):
+        # Add a stage calling fn(item) -> item in `workers` threads, behind a queue of
+        # at most maxsize items (default 2 per worker)
+        workers = max(1, int(workers))
+        self.stages.append((fn, workers, StageStats(name, workers)))
+        self.queues.append(queue.Queue(maxsize or 2 * workers))
+        return self
+
+    def put(self, q, item):
+        # Put an item on a queue, giving up if the pipeline stops; returns the seconds spent waiting
+        t0 = time.perf_counter()
+        while not self.stopping.is_set():
+            try:
+                q.put(item, timeout=self.poll)
+                break
+            except queue.Full:
+                continue
+        return time.perf_counter() - t0
+
+    def get(self, q):
+        # The next item on a queue, or done if the pipeline stops
+        while not self.stopping.is_set():
+            try:
+                return q.get(timeout=self.poll)
+            except queue.Empty:
+                continue
+        return done
+
+    def fail(self, inst):
+        if self.error is None: self.error = inst
+        self.stopping.set()
+
+    def feed(self):
+        # Source thread: number the items and hand them to the first stage
+        try:
+            for seq, item in enumerate(self.source):
+                while not self.window.acquire(timeout=self.poll):
+                    if self.stopping.is_set(): return
+                if self.stopping.is_set(): return
+                self.put(self.queues[0], (seq, item))
+        except Exception as inst:
+            self.fail(inst)
+        finally:
+            for i in range(self.stages[0][1]): self.put(self.queues[0], done)
+
+    def work(self, i, remaining):
+        # Worker thread of stage i; the last of its workers to finish tells the next stage
+        fn, workers, stats = self.stages[i]
+        out = self.queues[i + 1]
+        try:
+            while True:
+                got = self.get(self.queues[i])
+                if got is done: break
+                seq, item = got
+                t0 = time.perf_counter()
+                try:
+                    item = fn(item)
+                except Exception as inst:
+                    self.fail(inst)
+                    break
+                busy = time.perf_counter() - t0
+                stats.add(busy, self.put(out, (seq, item)))
+        finally:
+            with stats.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                nextWorkers = self.stages[i + 1][1] if i + 1 < len(self.stages) else 1
+                for j in range(nextWorkers): self.put(out, done)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.queues.append(queue.Queue())  # last stage -> caller; the window bounds it
+        self.threads = [threading.Thread(target=self.feed, name='pipeline-source', daemon=True)]
+        for i, (fn, workers, stats) in enumerate(self.stages):
+            remaining = [workers]
+            self.threads += [threading.Thread(target=self.work, args=(i, remaining), daemon=True,
+                                              name='pipeline-' + stats.name + '-' + str(w))
+                             for w in range(workers)]
+        for t in self.threads: t.start()
+
+    def __iter__(self):
+        # The items out of the last stage, in source order
+        self.start()
+        waiting = {}
+        nextSeq = 0
+        try:
+            while True:
+                got = self.get(self.queues[-1])
+                if got is done: break
+                seq, item = got
+                waiting[seq] = item
+                while nextSeq in waiting:
+                    item = waiting.pop(nextSeq)
+                    nextSeq += 1
+                    yield item
+                    self.window.release()
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Stop taking items and wait for every worker to finish the one in hand
+        self.stopping.set()
+        for t in self.threads:
+            if t is not threading.current_thread(): t.join()
+
+    def summary(self):
+        # One line per stage: items, time busy and time held up by the stage after it
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        lines = []
+        for fn, workers, stats in self.stages:
+            use = 100.0 * stats.busy / (elapsed * workers) if elapsed else 0.0
+            lines.append("Stage %s: %d items, %d workers %.0f%% busy, %.1f s waiting on the next stage." %
+                         (stats.name, stats.items, workers, use, stats.blocked))
+        return lines
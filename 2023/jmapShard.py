@@ -0,0 +1,175 @@
+#####################################################################################
+## jmapShard.py
+## Split a parse run across machines, and put the pieces back together.
+##
+## A run with --shard i/N (i from 0 to N-1) only parses the XML files whose
+## name hashes to i, and writes all of its output (articles, locations,
+## toponyms, manifest, logs) to its own directory outDir/shard_<i>_of_<N>. The
+## hash is MD5 of the file's name, not its path, so every node puts a file in
+## the same shard wherever the corpus is mounted; the PLOS file names are the
+## DOIs, so in effect articles are sharded by DOI. Shards can be rerun and
+## resumed on their own.
+##
+## mergeShards() then builds the canonical output in outDir from the N shard
+## directories: CSV tables are concatenated under one header, typed dataset
+## part files are copied into one dataset, toponym ids are renumbered into
+## one memo (and the compact locations rows remapped to match), and logs and
+## event streams are appended one after another. Each merged file is written
+## under a temporary name and moved into place, so an interrupted merge leaves
+## nothing half written.
+#####################################################################################
+
+import os, shutil, hashlib, glob
+
+import pandas as pd
+
+from jmapToponyms import ToponymMemo
+from jmapWriter import parts
+
+
+def parseShard(text):
+    # "3/16" -> (3, 16)
+    try:
+        i, n = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise ValueError("A shard is i/N, e.g. 3/16, not " + repr(text))
+    if n < 1 or not 0 <= i < n:
+        raise ValueError("Shard " + text + " is out of range: i goes from 0 to N-1")
+    return i, n
+
+def shardOf(xmlFile, n):
+    # Which of n shards a file belongs to, from its name alone
+    digest = hashlib.md5(os.path.basename(xmlFile).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % n
+
+def inShard(xmlFiles, shard):
+    i, n = shard
+    for xmlFile in xmlFiles:
+        if shardOf(xmlFile, n) == i:
+            yield xmlFile
+
+def shardDir(outDir, shard):
+    i, n = shard
+    return os.path.join(outDir, 'shard_%03d_of_%03d' % (i, n))
+
+
+def replaceWith(dest, write):
+    # Build dest with write(tmpPath), then move it into place
+    tmpFile = dest + '.merging'
+    if os.path.isdir(tmpFile): shutil.rmtree(tmpFile)
+    write(tmpFile)
+    if os.path.isdir(dest): shutil.rmtree(dest)
+    os.replace(tmpFile, dest)
+
+def mergeCSV(sources, dest):
+    # One header (the first file's), then every file's rows in turn, copied as bytes
+    def write(tmpFile):
+        with open(tmpFile, 'wb') as out:
+            header = None
+            for source in sources:
+                with open(source, 'rb') as f:
+                    first = f.readline()
+                    if header is None:
+                        header = first
+                        out.write(first)
+                    elif first != header:
+                        raise ValueError(source + " has different columns to " + sources[0])
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+    replaceWith(dest, write)
+
+def mergeDatasets(sources, dest):
+    # Every part file of every shard's dataset, prefixed with its shard so names don't clash
+    def write(tmpDir):
+        os.makedirs(tmpDir)
+        for k, source in enumerate(sources):
+            for part in parts(source):
+                shutil.copyfile(part, os.path.join(tmpDir, 'part-s%03d-' % k + os.path.basename(part)[len('part-'):]))
+    replaceWith(dest, write)
+
+def mergeText(sources, dest, banner=None):
+    # Append text files (logs, event streams) one after another, each under banner(source) if given
+    def write(tmpFile):
+        with open(tmpFile, 'wb') as out:
+            for source in sources:
+                if banner: out.write(banner(source).encode('utf-8'))
+                with open(source, 'rb') as f:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+    replaceWith(dest, write)
+
+def mergeToponyms(locationSources, toponymSources, locationsDest, toponymsDest, chunkRows=100000):
+    """
+    Merge compact locations tables with their toponym memos: the same
+    toponym gets one id across all the shards, and every row's toponym_id is
+    rewritten to it.
+    """
+    memo = ToponymMemo()
+    remaps = []
+    for source in toponymSources:
+        remap = {}
+        if os.path.isfile(source):
+            for record in pd.read_csv(source, dtype=str, keep_default_na=False).to_dict('records'):
+                remap[int(record['toponym_id'])] = memo.add(record)
+        remaps.append(remap)
+
+    def writeLocations(tmpFile):
+        header = True
+        for source, remap in zip(locationSources, remaps):
+            for chunk in pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunkRows):
+                ids = pd.to_numeric(chunk['toponym_id'], errors='coerce').map(remap)
+                chunk['toponym_id'] = ids.astype('Int64').astype(str).replace('<NA>', '')
+                chunk.to_csv(tmpFile, mode='w' if header else 'a', header=header, index=False)
+                header = False
+    replaceWith(locationsDest, writeLocations)
+
+    def writeToponyms(tmpFile):
+        memo.path = tmpFile
+        memo.flush()
+    replaceWith(toponymsDest, writeToponyms)
+    return len(memo)
+
+
+def shardDirs(outDir, n):
+    # The n shard directories, in order; raises if any are missing
+    dirs = [shardDir(outDir, (i, n)) for i in range(n)]
+    missing = [d for d in dirs if not os.path.isdir(d)]
+    if missing:
+        raise ValueError("Missing shard output: " + ", ".join(missing))
+    return dirs
+
+def countShards(outDir):
+    # N from the shard directories in outDir (None if there are none, or they disagree)
+    found = set(int(d.rsplit('_', 1)[1]) for d in glob.glob(os.path.join(outDir, 'shard_*_of_*')))
+    return found.pop() if len(found) == 1 else None
+
+def mergeShards(outDir, n, names, toponymPairs=(), logs=()):
+    """
+    Build the canonical output files in outDir from n shards. names are
+    the file names of the tables each shard wrote (CSV files or typed dataset
+    directories); toponymPairs the (locations, toponyms) file names that go
+    through mergeToponyms instead; logs the text files to append. Returns
+    the merged paths.
+    """
+    dirs = shardDirs(outDir, n)
+    merged = []
+    pairedLocations = set(locations for locations, toponyms in toponymPairs)
+    for name in names:
+        if name in pairedLocations: continue
+        sources = [os.path.join(d, name) for d in dirs if os.path.exists(os.path.join(d, name))]
+        if not sources: continue
+        dest = os.path.join(outDir, name)
+        if os.path.isdir(sources[0]): mergeDatasets(sources, dest)
+        else: mergeCSV(sources, dest)
+        merged.append(dest)
+    for locations, toponyms in toponymPairs:
+        present = [d for d in dirs if os.path.isfile(os.path.join(d, locations))]
+        if not present: continue
+        mergeToponyms([os.path.join(d, locations) for d in present], [os.path.join(d, toponyms) for d in present],
+                      os.path.join(outDir, locations), os.path.join(outDir, toponyms))
+        merged += [os.path.join(outDir, locations), os.path.join(outDir, toponyms)]
+    for name in logs:
+        sources = [os.path.join(d, name) for d in dirs if os.path.isfile(os.path.join(d, name))]
+        if not sources: continue
+        banner = None if name.endswith('.jsonl') else (lambda source: "\n===== " + os.path.dirname(source) + " =====\n")
+        mergeText(sources, os.path.join(outDir, name), banner)
+        merged.append(os.path.join(outDir, name))
+    return merged
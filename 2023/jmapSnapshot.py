@@ -0,0 +1,214 @@
+#####################################################################################
+## jmapSnapshot.py
+## Snapshot of the extracted corpus, so the XML is only parsed once.
+##
+## Extraction gives the same Article and Sections for an XML file every time,
+## so a snapshot keeps them: corpus_snapshot.bin holds one record per article,
+## and corpus_snapshot.index.csv says where each record is, with the doi, the
+## XML file's size, mtime and SHA-1 (as the run manifest has them) and a CRC
+## of the record. Opening a snapshot only reads the index; the data file is
+## memory-mapped and a record is decoded when it is asked for, by file or by
+## doi, so a run starts at once however big the corpus.
+##
+## A record is the length of a JSON header (4 bytes), the header (the
+## Article's fields and its Sections) and the article's text in UTF-8. It is
+## only used while its XML file is unchanged and the collection keyword is the
+## same; otherwise the file is extracted again and the new record appended.
+## Index lines are appended too, the last one for a file wins, and the files
+## are compacted when more than half the data is superseded records. A record
+## whose CRC doesn't match (a crash mid-write) is treated as missing.
+##
+## Usage:
+##     python jmapSnapshot.py startDir [corpus_snapshot.bin] [--workers 4] [--keyword KW]
+## extracts every XML file under startDir that the snapshot doesn't have yet.
+#####################################################################################
+
+import os, csv, json, mmap, struct, threading, time, zlib
+
+from jmapExtract import Article, Section, sectionPaths
+from jmapLog import ParseLog
+from jmapManifest import fileHash, appendDurably, csvLine
+
+indexFields = ['xmlfile', 'doi', 'keyword', 'size', 'mtime', 'sha1', 'offset', 'length', 'crc32']
+header = struct.Struct('<I')
+
+# The Article fields in a record's header; the text goes after it
+articleFields = [name for name in Article.__slots__ if name != 'text']
+
+
+def packArticle(article, sections):
+    meta = dict((name, getattr(article, name)) for name in articleFields)
+    meta['sections'] = [(s.title, s.start, s.end, s.parent, s.depth) for s in sections]
+    meta = json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return header.pack(len(meta)) + meta + article.text.encode('utf-8')
+
+def unpackArticle(record):
+    n = header.unpack_from(record)[0]
+    meta = json.loads(bytes(record[header.size:header.size + n]).decode('utf-8'))
+    sections = [Section(title, start, end, (), parent, depth) for title, start, end, parent, depth in meta.pop('sections')]
+    article = Article.__new__(Article)
+    for name, value in meta.items(): setattr(article, name, value)
+    article.text = bytes(record[header.size + n:]).decode('utf-8')
+    return article, sectionPaths(sections)
+
+
+class CorpusSnapshot(object):
+    """
+    Usage example:
+
+    snapshot = CorpusSnapshot(outDir + '/corpus_snapshot.bin')
+    got = snapshot.load(xmlFile)              # (article, sections, log), or None
+    if got is None:
+        article, sections, log = extractLogged(xmlFile)
+        if article is not None: snapshot.add(xmlFile, article, sections)
+    article, sections = snapshot.by_doi('10.1371/journal.pone.0098931')
+    snapshot.close()
+    """
+    def __init__(self, path, keyword=''):
+        self.path = path
+        self.indexPath = os.path.splitext(path)[0] + '.index.csv'
+        self.keyword = keyword
+        self.entries = {}  # xmlFile -> index row
+        self.dois = {}     # doi -> xmlFile
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.isfile(self.indexPath):
+            with open(self.indexPath, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    self.entries[row['xmlfile']] = row
+        if not os.path.isfile(self.path):
+            # no data, so nothing the index says is there
+            self.entries = {}
+            self.writeIndex(self.indexPath)
+        elif os.path.getsize(self.path) > 2 * sum(int(row['length']) for row in self.entries.values()):
+            self.compact()
+        for xmlFile, row in self.entries.items():
+            self.dois[row['doi']] = xmlFile
+        self.data = open(self.path, 'ab')
+        self.reader = open(self.path, 'rb')
+        self.map = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def writeIndex(self, path):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=indexFields)
+            writer.writeheader()
+            for row in self.entries.values():
+                writer.writerow(row)
+
+    def compact(self):
+        # Rewrite the data file with only the live records, then the index to match
+        tmpFile = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmpFile, 'wb') as dst:
+            for row in self.entries.values():
+                src.seek(int(row['offset']))
+                record = src.read(int(row['length']))
+                row['offset'] = str(dst.tell())
+                dst.write(record)
+        self.writeIndex(self.indexPath + '.tmp')
+        os.replace(tmpFile, self.path)
+        os.replace(self.indexPath + '.tmp', self.indexPath)
+
+    def fresh(self, xmlFile, row):
+        # Is the record still what extracting xmlFile would give?
+        if row['keyword'] != self.keyword or not os.path.isfile(xmlFile): return False
+        st = os.stat(xmlFile)
+        if str(st.st_size) == row['size'] and repr(st.st_mtime) == row['mtime']: return True
+        return fileHash(xmlFile) == row['sha1']
+
+    def record(self, row):
+        # The bytes of a record, or None if they aren't all there
+        offset, length = int(row['offset']), int(row['length'])
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                self.data.flush()
+                if self.map is not None: self.map.close()
+                size = os.path.getsize(self.path)
+                self.map = mmap.mmap(self.reader.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            if self.map is None or offset + length > len(self.map): return None
+            record = self.map[offset:offset + length]
+        return record if zlib.crc32(record) == int(row['crc32']) else None
+
+    def get(self, xmlFile):
+        # (article, sections) for xmlFile, or None if the snapshot doesn't have it as it is now
+        row = self.entries.get(xmlFile)
+        record = self.record(row) if row is not None and self.fresh(xmlFile, row) else None
+        with self.lock:
+            if record is None: self.misses += 1
+            else: self.hits += 1
+        return unpackArticle(record) if record is not None else None
+
+    def by_doi(self, doi):
+        # (article, sections) for a doi, as the snapshot has it, or None
+        xmlFile = self.dois.get(doi)
+        record = self.record(self.entries[xmlFile]) if xmlFile is not None else None
+        return unpackArticle(record) if record is not None else None
+
+    def load(self, xmlFile):
+        # Like extractLogged(): (article, sections, log), or None to extract the file instead
+        log = ParseLog()
+        t0 = time.perf_counter()
+        got = self.get(xmlFile)
+        if got is None: return None
+        log.add_time('read', time.perf_counter() - t0)
+        log.add_msg("Processing " + xmlFile)
+        log.countArticles += 1
+        return got + (log,)
+
+    def add(self, xmlFile, article, sections):
+        record = packArticle(article, sections)
+        st = os.stat(xmlFile)
+        row = {'xmlfile': xmlFile, 'doi': article.doi, 'keyword': self.keyword, 'size': str(st.st_size),
+               'mtime': repr(st.st_mtime), 'sha1': fileHash(xmlFile), 'length': str(len(record)),
+               'crc32': str(zlib.crc32(record))}
+        with self.lock:
+            row['offset'] = str(self.data.seek(0, os.SEEK_END))
+            self.data.write(record)
+            self.data.flush()
+            appendDurably(self.indexPath, csvLine([row[k] for k in indexFields]).encode('utf-8'))
+            self.entries[xmlFile] = row
+            self.dois[article.doi] = xmlFile
+
+    def articles(self):
+        # Every (xmlFile, article, sections) in the snapshot, fresh or not
+        for xmlFile, row in list(self.entries.items()):
+            record = self.record(row)
+            if record is not None: yield (xmlFile,) + unpackArticle(record)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None: self.map.close()
+            self.map = None
+            self.data.close()
+            self.reader.close()
+
+
+if __name__ == "__main__":
+    import argparse, fnmatch
+    from jmapExtract import extractAll
+    ap = argparse.ArgumentParser(description="Extract a directory of XML files into a corpus snapshot")
+    ap.add_argument("startDir")
+    ap.add_argument("snapshotFile", nargs="?", default="corpus_snapshot.bin")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="XML extraction processes")
+    ap.add_argument("--keyword", default="", help="collection keyword, as the parse script's collectionKeyword")
+    ap.add_argument("--extractor", default="lxml", choices=["lxml", "soup"])
+    args = ap.parse_args()
+
+    snapshot = CorpusSnapshot(args.snapshotFile, args.keyword)
+    xmlFiles = [os.path.join(root, name) for root, dirs, files in os.walk(args.startDir)
+                for name in sorted(fnmatch.filter(files, '*.xml'))]
+    todo = [f for f in xmlFiles if f not in snapshot.entries or not snapshot.fresh(f, snapshot.entries[f])]
+    t0 = time.perf_counter()
+    skipped = 0
+    for xmlFile, article, sections, log in extractAll(todo, args.workers, args.keyword, args.extractor):
+        if article is None:
+            skipped += 1
+            for msg in log.messages[1:]: print(msg)
+        else:
+            snapshot.add(xmlFile, article, sections)
+    print("%d XML files, %d extracted into %s in %.1f s (%d skipped), %d articles in the snapshot." %
+          (len(xmlFiles), len(todo) - skipped, args.snapshotFile, time.perf_counter() - t0, skipped, len(snapshot)))
+    snapshot.close()
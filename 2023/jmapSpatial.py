@@ -0,0 +1,126 @@
+#####################################################################################
+## jmapSpatial.py
+## Grid index over lat/lon points for radius and nearest-neighbour queries in km.
+##
+## Points are bucketed into cellDeg x cellDeg degree cells and sorted by cell,
+## so the points of any run of cells along a row are one slice of the sorted
+## array. A query works out which cells its search cap can touch (all of a
+## row's columns if the cap covers a pole), turns those into slices, and only
+## measures great circle distances to the points in them. Everything is done
+## for a whole array of query points at once with NumPy.
+##
+## External Dependencies
+##     NumPy
+#####################################################################################
+
+import numpy as np
+
+from jmapEval import haversine, earthRadius
+
+
+def expandRanges(starts, ends):
+    # Concatenated np.arange(s, e) for each pair, and which pair each value came from
+    counts = np.maximum(ends - starts, 0)
+    owner = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, owner
+
+
+class GridIndex(object):
+    """
+    Usage example:
+
+    index = GridIndex(truth['lat'], truth['lon'])
+    q, i, km = index.within(points['lat'], points['lon'], 161)   # every pair within 161 km
+    i, km = index.nearest(points['lat'], points['lon'])          # nearest truth for each point
+    """
+    def __init__(self, lat, lon, cellDeg=1.0):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.cellDeg = float(cellDeg)
+        self.nrows = int(np.ceil(180.0 / self.cellDeg))
+        self.ncols = int(np.ceil(360.0 / self.cellDeg))
+        cells = self.cellOf(self.lat, self.lon)
+        self.order = np.argsort(cells, kind='stable')
+        self.cells = cells[self.order]
+
+    def __len__(self):
+        return len(self.lat)
+
+    def rowOf(self, lat):
+        return np.clip(np.floor((lat + 90.0) / self.cellDeg).astype(int), 0, self.nrows - 1)
+
+    def colOf(self, lon):
+        return np.floor(((lon + 180.0) % 360.0) / self.cellDeg).astype(int) % self.ncols
+
+    def cellOf(self, lat, lon):
+        return self.rowOf(lat) * self.ncols + self.colOf(lon)
+
+    def candidates(self, lat, lon, radius):
+        # (query, point) index pairs for every point in a cell the query's cap touches
+        d = np.degrees(min(radius / earthRadius, np.pi)) + 1e-9
+        r0 = self.rowOf(lat - d)
+        r1 = self.rowOf(lat + d)
+        # widest longitude reach of the cap; it covers a pole if it reaches 90
+        polar = np.abs(lat) + d >= 90.0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dlon = np.degrees(np.arcsin(np.clip(np.sin(np.radians(d)) / np.cos(np.radians(lat)), -1, 1)))
+        full = polar | (dlon >= 180.0)
+
+        # one entry per (query, row)
+        q = np.repeat(np.arange(len(lat)), r1 - r0 + 1)
+        rows = np.repeat(r0, r1 - r0 + 1) + expandRanges(np.zeros(len(lat), dtype=int), r1 - r0 + 1)[0]
+        c0 = np.floor((lon[q] - dlon[q] + 180.0) / self.cellDeg).astype(int)
+        c1 = np.floor((lon[q] + dlon[q] + 180.0) / self.cellDeg).astype(int)
+        c0[full[q]], c1[full[q]] = 0, self.ncols - 1
+
+        # a span running off either end of the row wraps round to the other end
+        wrapLo, wrapHi = c0 < 0, c1 >= self.ncols
+        spans = [(np.where(wrapLo, 0, c0), np.where(wrapHi, self.ncols - 1, c1), np.ones(len(q), dtype=bool)),
+                 (np.where(wrapLo, c0 + self.ncols, 0), np.where(wrapLo, self.ncols - 1, c1 - self.ncols), wrapLo | wrapHi)]
+
+        pairs = []
+        for lo, hi, use in spans:
+            lo, hi = np.clip(lo, 0, self.ncols - 1), np.clip(hi, 0, self.ncols - 1)
+            starts = np.searchsorted(self.cells, rows[use] * self.ncols + lo[use], 'left')
+            ends = np.searchsorted(self.cells, rows[use] * self.ncols + hi[use], 'right')
+            idx, owner = expandRanges(starts, ends)
+            pairs.append((q[use][owner], self.order[idx]))
+        return np.concatenate([p[0] for p in pairs]), np.concatenate([p[1] for p in pairs])
+
+    def within(self, lat, lon, radius):
+        """
+        Every (query, point) pair no more than radius km apart, as arrays of
+        query index, point index and distance in km.
+        """
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        q, i = self.candidates(lat, lon, radius)
+        km = haversine(lat[q], lon[q], self.lat[i], self.lon[i])
+        keep = km <= radius
+        return q[keep], i[keep], km[keep]
+
+    def nearest(self, lat, lon, maxRadius=None):
+        """
+        Index of and distance to the nearest point for every query point
+        (-1 and inf if there is none within maxRadius km). The search radius
+        starts at one cell and doubles for the queries still unresolved.
+        """
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        best = np.full(len(lat), -1)
+        bestKm = np.full(len(lat), np.inf)
+        if not len(self): return best, bestKm
+        limit = np.pi * earthRadius if maxRadius is None else maxRadius
+        radius = min(self.cellDeg * np.pi / 180.0 * earthRadius, limit)
+        todo = np.arange(len(lat))
+        while len(todo):
+            q, i, km = self.within(lat[todo], lon[todo], radius)
+            if len(q):
+                # closest hit per query: sort by distance, keep each query's first
+                o = np.lexsort((km, q))
+                first = np.r_[True, q[o][1:] != q[o][:-1]]
+                hit = todo[q[o][first]]
+                best[hit], bestKm[hit] = i[o][first], km[o][first]
+                todo = np.setdiff1d(todo, hit)
+            if radius >= limit: break
+            radius = min(radius * 2, limit)
+        return best, bestKm
@@ -0,0 +1,321 @@
+#####################################################################################
+## jmapStore.py
+## One SQLite database for the articles, the locations the parsers found and
+## the evaluation results, indexed for the usual questions.
+##
+## Tables:
+##     articles    one row per doi, the columns of the articles CSV files
+##     locations   the typed locations rows (jmapWriter.locationsSchema), indexed
+##                 on (parser, doi), (section) and (lat, lon), and in an R-tree on
+##                 their coordinates where SQLite has the R-tree module
+##     truth       the confirmed study locations (PLOSOne_confirmed_locations.csv)
+##     results     evaluation counts per confirmed location, parser and threshold,
+##                 for each named run
+##
+## The parse script adds each article and its locations as it writes them
+## (storeFile), one transaction per article; an article parsed again replaces
+## its rows. The evaluation script adds the truth and its results. The
+## database is in WAL mode and writers wait for each other, so sharded or
+## parallel runs can write to one file at the same time.
+##
+## Queries return DataFrames:
+##     store.locations(parser='mordecai', doi=doi, section='Methods')
+##     store.near_truth(50, parser='mordecai', doi=doi, section='Methods')
+##     store.near(44.5, -110.6, 25)     # everything found within 25 km of a point
+##     store.results(parser='spacy-lg', threshold=161)
+##
+## Usage:
+##     python jmapStore.py jmap_results.sqlite [dataDir]
+## imports the articles_*, locations_* (CSV or typed datasets) and results_*.csv
+## files and PLOSOne_confirmed_locations.csv found in dataDir.
+##
+## External Dependencies
+##     Pandas
+##     NumPy
+#####################################################################################
+
+import os, sqlite3, threading, time, glob
+
+import numpy as np
+import pandas as pd
+
+from jmapEval import haversine, earthRadius, threshold, truthPoints, expandToponyms
+from jmapWriter import locationsSchema, locationsHeader, typedLocations, locationChunks, articleFrame
+
+articleColumns = ['doi', 'publisher_name', 'publisher_abbreviation', 'citation', 'title', 'publish_year',
+                  'first_author', 'authors_list', 'volume_issue_pages', 'volume', 'issue', 'start_page',
+                  'end_page', 'keywords_list', 'no_keywords_list', 'abstract', 'no_abstract', 'url']
+locationColumns = [name for name, t in locationsSchema]
+resultColumns = ['run', 'threshold', 'doi', 'parser', 'correctPlace', 'accurates', 'inaccurates']
+sqlTypes = {'int32': 'INTEGER', 'float64': 'REAL', 'bool': 'INTEGER', 'string': 'TEXT'}
+
+schema = ["CREATE TABLE IF NOT EXISTS articles (" + ", ".join(c + (" TEXT PRIMARY KEY" if c == 'doi' else " TEXT")
+                                                                for c in articleColumns) + ")",
+          "CREATE TABLE IF NOT EXISTS locations (id INTEGER PRIMARY KEY, " +
+          ", ".join(name + " " + sqlTypes[t] for name, t in locationsSchema) + ")",
+          "CREATE INDEX IF NOT EXISTS locations_parser_doi ON locations (parser, doi)",
+          "CREATE INDEX IF NOT EXISTS locations_section ON locations (section)",
+          "CREATE INDEX IF NOT EXISTS locations_lat_lon ON locations (lat, lon)",
+          "CREATE TABLE IF NOT EXISTS truth (id INTEGER PRIMARY KEY, doi TEXT, lat REAL, lon REAL, text TEXT)",
+          "CREATE INDEX IF NOT EXISTS truth_doi ON truth (doi)",
+          "CREATE TABLE IF NOT EXISTS results (run TEXT, threshold REAL, doi TEXT, parser TEXT, correctPlace TEXT, "
+          "accurates REAL, inaccurates REAL)",
+          "CREATE INDEX IF NOT EXISTS results_parser_doi ON results (parser, doi)",
+          "CREATE INDEX IF NOT EXISTS results_run ON results (run, threshold)"]
+rtreeSchema = "CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree USING rtree(id, minLat, maxLat, minLon, maxLon)"
+
+
+def boundingBox(lat, lon, km):
+    # (minLat, maxLat, minLon, maxLon) around a point, at least km from it on every side
+    dLat = np.degrees(km / earthRadius)
+    if abs(lat) + dLat >= 90: return lat - dLat, lat + dLat, -180.0, 180.0
+    dLon = np.degrees(km / (earthRadius * np.cos(np.radians(abs(lat) + dLat))))
+    return lat - dLat, lat + dLat, lon - dLon, lon + dLon
+
+def responseLocations(name, article, parser, sections, rjsons):
+    # Typed locations rows for one parser's responses to an article's sections
+    return typedLocations(articleFrame(sections, rjsons, name, article, parser, locationsHeader([parser])))
+
+def articleRecord(article):
+    # An Article as a row of the articles table, as the parse script writes it to the articles CSV
+    return dict(zip(articleColumns, [article.doi, article.publisher_name, '', article.build_citation(), article.title,
+                                     str(article.year), article.authors[0], article.format_authors(),
+                                     article.format_volisspg(), article.volume, article.issue, article.start_page,
+                                     article.end_page, article.format_keywords(), article.no_keywords,
+                                     article.abstract, article.no_abstract, article.url]))
+
+def cellValue(value):
+    # A DataFrame value as sqlite3 takes it
+    if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)): return None
+    if isinstance(value, np.generic): return value.item()
+    return value
+
+
+class ResultsStore(object):
+    """
+    Usage example:
+
+    store = ResultsStore(outDir + '/jmap_results.sqlite')
+    store.add_article(articleRecord(article), 'spacy-lg', responseLocations(name, article, 'spacy-lg', sections, rjsons))
+    hits = store.near_truth(50, parser='mordecai', doi='10.1371/journal.pone.0098931', section='Methods')
+    store.close()
+    """
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.lock = threading.Lock()
+        # other processes writing to the same file are waited for, up to timeout seconds
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema: self.db.execute(statement)
+        try:
+            self.db.execute(rtreeSchema)
+            self.rtree = True
+        except sqlite3.OperationalError:
+            self.rtree = False
+        self.db.commit()
+
+    def write(self, fn):
+        # Run fn(db) in one transaction, taking the write lock at the start
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                fn(self.db)
+            except BaseException:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def insertLocations(self, db, locations):
+        locations = locations.reindex(columns=locationColumns)
+        rows = [tuple(cellValue(v) for v in row) for row in locations.itertuples(index=False, name=None)]
+        insert = "INSERT INTO locations (" + ", ".join(locationColumns) + ") VALUES (" + ", ".join("?" * len(locationColumns)) + ")"
+        last = db.execute("SELECT COALESCE(MAX(id), 0) FROM locations").fetchone()[0]
+        db.executemany(insert, rows)
+        if self.rtree:
+            db.execute("INSERT INTO locations_rtree SELECT id, lat, lat, lon, lon FROM locations "
+                       "WHERE id > ? AND lat IS NOT NULL AND lon IS NOT NULL", (last,))
+
+    def deleteLocations(self, db, parser, dois):
+        for doi in dois:
+            if self.rtree:
+                db.execute("DELETE FROM locations_rtree WHERE id IN (SELECT id FROM locations WHERE parser=? AND doi=?)",
+                           (parser, doi))
+            db.execute("DELETE FROM locations WHERE parser=? AND doi=?", (parser, doi))
+
+    def add_article(self, article, parser, locations):
+        """
+        An article (a dict of articleColumns, see articleRecord()) and one parser's typed
+        locations rows for it, replacing any rows that parser had for it.
+        """
+        def write(db):
+            db.execute("INSERT OR REPLACE INTO articles VALUES (" + ", ".join("?" * len(articleColumns)) + ")",
+                       [cellValue(article.get(c)) for c in articleColumns])
+            self.deleteLocations(db, parser, [article['doi']])
+            self.insertLocations(db, locations)
+        self.write(write)
+
+    def add_locations(self, locations, cleared=None):
+        """
+        Typed locations rows for any articles and parsers, replacing what the store
+        had for them. To add one file's rows in chunks, pass the same set as cleared
+        with each: the (parser, doi) keys in it are not replaced again, so an
+        article whose rows span two chunks keeps the first chunk's rows.
+        """
+        keys = set(locations[['parser', 'doi']].dropna().drop_duplicates().itertuples(index=False, name=None))
+        if cleared is not None:
+            keys -= cleared
+            cleared |= keys
+        def write(db):
+            for parser, doi in keys: self.deleteLocations(db, parser, [doi])
+            self.insertLocations(db, locations)
+        self.write(write)
+
+    def count_locations(self, keys):
+        # The number of locations rows the store has for these (parser, doi) keys
+        counts = self.query("SELECT parser, doi, COUNT(*) AS n FROM locations GROUP BY parser, doi")
+        counts = dict(((parser, doi), n) for parser, doi, n in counts.itertuples(index=False, name=None))
+        return sum(counts.get(key, 0) for key in keys)
+
+    def add_articles(self, articles):
+        # Rows of an articles table (articleColumns), replacing those with the same doi
+        rows = [[cellValue(v) for v in row] for row in articles.reindex(columns=articleColumns).itertuples(index=False, name=None)]
+        self.write(lambda db: db.executemany("INSERT OR REPLACE INTO articles VALUES (" +
+                                             ", ".join("?" * len(articleColumns)) + ")", rows))
+
+    def add_truth(self, doiList):
+        # The confirmed locations, replacing those the store had
+        truth = truthPoints(doiList)
+        rows = [tuple(cellValue(v) for v in row) for row in truth[['doi', 'lat', 'lon', 'text']].itertuples(index=False, name=None)]
+        def write(db):
+            db.execute("DELETE FROM truth")
+            db.executemany("INSERT INTO truth (doi, lat, lon, text) VALUES (?,?,?,?)", rows)
+        self.write(write)
+
+    def add_results(self, results, run, threshold=threshold):
+        """
+        Evaluation results (jmapEval.evaluate() or sweep() output, with a
+        DOI or doi column) under a run name, replacing that run's results at
+        the same thresholds. threshold is for results without a threshold
+        column (evaluate()'s default, unless given).
+        """
+        results = results.rename(columns={'DOI': 'doi'}).assign(run=run)
+        if 'threshold' not in results: results['threshold'] = threshold
+        rows = [tuple(cellValue(v) for v in row) for row in results.reindex(columns=resultColumns).itertuples(index=False, name=None)]
+        thresholds = results['threshold'].drop_duplicates().tolist()
+        def write(db):
+            for t in thresholds:
+                db.execute("DELETE FROM results WHERE run=? AND threshold IS ?", (run, cellValue(t)))
+            db.executemany("INSERT INTO results VALUES (" + ", ".join("?" * len(resultColumns)) + ")", rows)
+        self.write(write)
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return pd.read_sql_query(sql, self.db, params=params)
+
+    def where(self, **equal):
+        # " WHERE a=? AND b=?" and its parameters, for the arguments that aren't None
+        given = [(k, v) for k, v in equal.items() if v is not None]
+        if not given: return "", []
+        return " WHERE " + " AND ".join("l." + k + "=?" for k, v in given), [v for k, v in given]
+
+    def locations(self, parser=None, doi=None, level=None, section=None, columns=None):
+        clause, params = self.where(parser=parser, doi=doi, level=level, section=section)
+        select = ", ".join("l." + c for c in columns) if columns else "l.*"
+        return self.query("SELECT " + select + " FROM locations l" + clause, params)
+
+    def articles(self, doi=None):
+        if doi is None: return self.query("SELECT * FROM articles")
+        return self.query("SELECT * FROM articles WHERE doi=?", (doi,))
+
+    def truth(self, doi=None):
+        if doi is None: return self.query("SELECT doi, lat, lon, text FROM truth")
+        return self.query("SELECT doi, lat, lon, text FROM truth WHERE doi=?", (doi,))
+
+    def results(self, run=None, parser=None, doi=None, threshold=None):
+        given = [(k, v) for k, v in (('run', run), ('parser', parser), ('doi', doi), ('threshold', threshold)) if v is not None]
+        clause = " WHERE " + " AND ".join(k + "=?" for k, v in given) if given else ""
+        return self.query("SELECT * FROM results" + clause, [v for k, v in given])
+
+    def near(self, lat, lon, km, parser=None):
+        # The locations within km of a point, nearest first, with a km column
+        minLat, maxLat, minLon, maxLon = boundingBox(lat, lon, km)
+        clause, params = self.where(parser=parser)
+        clause = clause.replace(" WHERE ", " AND ") if clause else ""
+        if self.rtree:
+            sql = ("SELECT l.* FROM locations_rtree r JOIN locations l ON l.id = r.id "
+                   "WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLon >= ? AND r.minLon <= ?" + clause)
+        else:
+            sql = "SELECT l.* FROM locations l WHERE l.lat BETWEEN ? AND ? AND l.lon BETWEEN ? AND ?" + clause
+        found = self.query(sql, [minLat, maxLat, minLon, maxLon] + params)
+        found['km'] = haversine(found['lat'], found['lon'], lat, lon)
+        return found[found['km'] <= km].sort_values('km').reset_index(drop=True)
+
+    def near_truth(self, km, parser=None, doi=None, level=None, section=None):
+        """
+        The locations within km of a confirmed location of their article,
+        each with the distance to the nearest one (km) and its text (truth_text).
+        """
+        clause, params = self.where(parser=parser, doi=doi, level=level, section=section)
+        pairs = self.query("SELECT l.*, t.id AS truth_id, t.lat AS truth_lat, t.lon AS truth_lon, t.text AS truth_text "
+                           "FROM locations l JOIN truth t ON t.doi = l.doi" + clause, params)
+        pairs['km'] = haversine(pairs['lat'], pairs['lon'], pairs['truth_lat'], pairs['truth_lon'])
+        nearest = pairs.sort_values('km').drop_duplicates('id')
+        nearest = nearest[nearest['km'] <= km].drop(columns=['truth_lat', 'truth_lon'])
+        return nearest.sort_values(['doi', 'id']).reset_index(drop=True)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def importDir(store, dataDir, chunkRows=100000):
+    # Load the output files of earlier runs in dataDir into the store; returns the files loaded
+    loaded = []
+    confirmed = os.path.join(dataDir, 'PLOSOne_confirmed_locations.csv')
+    if os.path.isfile(confirmed):
+        store.add_truth(pd.read_csv(confirmed))
+        loaded.append(confirmed)
+    for path in sorted(glob.glob(os.path.join(dataDir, 'articles_*.csv'))):
+        store.add_articles(pd.read_csv(path, dtype=str, keep_default_na=False))
+        loaded.append(path)
+    for path in sorted(glob.glob(os.path.join(dataDir, 'locations_*'))):
+        name = os.path.basename(path)
+        toponymsFile = os.path.join(dataDir, name.replace('locations_', 'toponyms_', 1).split('.')[0] + '.csv')
+        toponyms = pd.read_csv(toponymsFile) if os.path.isfile(toponymsFile) else None
+        cleared, rows = set(), 0
+        for chunk in locationChunks(path, chunkRows=chunkRows):
+            if 'row' not in chunk:
+                # a locations CSV file; compact rows get their toponyms' fields
+                chunk = chunk.set_index('pandas.index') if 'pandas.index' in chunk else chunk
+                if toponyms is not None and 'toponym_id' in chunk:
+                    chunk = expandToponyms(chunk.reset_index(), toponyms).set_index(chunk.index.name or 'index')
+                chunk = typedLocations(chunk)
+            store.add_locations(chunk, cleared)
+            rows += len(chunk)
+        stored = store.count_locations(cleared)
+        if stored != rows:
+            raise RuntimeError("%s: %d locations rows read but %d in the store" % (path, rows, stored))
+        loaded.append(path)
+    for path in sorted(glob.glob(os.path.join(dataDir, 'results*.csv'))):
+        results = pd.read_csv(path, index_col=0)
+        if {'parser', 'accurates', 'inaccurates'} <= set(results.columns):
+            store.add_results(results, os.path.splitext(os.path.basename(path))[0])
+            loaded.append(path)
+    return loaded
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Load the output of earlier runs into a results store")
+    ap.add_argument("storeFile")
+    ap.add_argument("dataDir", nargs="?", default=".")
+    args = ap.parse_args()
+    t0 = time.perf_counter()
+    store = ResultsStore(args.storeFile)
+    for path in importDir(store, args.dataDir): print("Loaded " + path)
+    counts = dict((table, store.query("SELECT COUNT(*) AS n FROM " + table)['n'][0])
+                  for table in ('articles', 'locations', 'truth', 'results'))
+    print(", ".join("%d %s" % (n, table) for table, n in counts.items()) + " in %s (%.1f s)." % (args.storeFile, time.perf_counter() - t0))
+    store.close()
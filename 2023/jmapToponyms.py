@@ -0,0 +1,135 @@
+#####################################################################################
+## jmapToponyms.py
+## Memo of resolved place names, shared by every article and section in a run.
+##
+## The same names come back from the geoparsers over and over ("United States",
+## "Brazil", the study sites). A ToponymMemo gives each distinct resolution one
+## id: the key is the parser, the name normalized (Unicode NFKC, case folded,
+## whitespace collapsed, surrounding punctuation dropped) and what the parser
+## resolved it to (coordinates, score, type, or mordecai's geo.* fields and
+## country guess). If a parser resolves one name to different places in
+## different contexts, each gets its own id, so nothing is lost.
+##
+## The memo lives in a toponyms_<parser>_2023.csv next to the locations file,
+## and compact locations rows carry just the toponym_id and the mention's
+## offsets. New toponyms are appended (durably) before any row that refers to
+## them, and ids never change, so resumed runs and purged rows stay valid.
+#####################################################################################
+
+import os, csv, unicodedata
+
+from jmapManifest import appendDurably, csvLine
+
+# One toponym: its id, then what it was resolved to
+toponymFields = ['toponym_id', 'parser', 'name', 'text', 'lat', 'lon', 'coordinates', 'score', 'type',
+                 'place_name', 'feature_class', 'feature_code', 'geonameid', 'admin1', 'country_code3',
+                 'country_predicted', 'country_conf']
+
+# The resolution fields of a response row, as (response field, toponym field).
+# mordecai's geo.lat/geo.lon go into coordinates, as "lat,lon" like the others'.
+resolutionFields = [('coordinates', 'coordinates'), ('score', 'score'), ('type', 'type'),
+                    ('geo.place_name', 'place_name'),
+                    ('geo.feature_class', 'feature_class'), ('geo.feature_code', 'feature_code'),
+                    ('geo.geonameid', 'geonameid'), ('geo.admin1', 'admin1'),
+                    ('geo.country_code3', 'country_code3'), ('country_predicted', 'country_predicted'),
+                    ('country_conf', 'country_conf')]
+
+# Columns compact locations rows have after the article fields
+mentionFields = ['toponym_id', 'start_char', 'end_char']
+
+
+def normalizeName(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return " ".join(text.split()).strip(".,;:!?()[]{}'\"“”‘’")
+
+def flatRow(row):
+    # A response row with nested dicts (mordecai's geo) flattened to "geo.lat" etc.,
+    # as pd.json_normalize(max_level=1) does
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            for k, v in value.items(): flat[key + '.' + k] = v
+        else:
+            flat[key] = value
+    return flat
+
+def surface(row):
+    # The mention as written: text for most parsers, word for mordecai
+    return row.get('text') if row.get('text') is not None else row.get('word', '')
+
+def offsets(row):
+    spans = row.get('spans')
+    if row.get('start_char') is None and isinstance(spans, list) and spans:
+        return spans[0].get('start'), spans[0].get('end')
+    return row.get('start_char'), row.get('end_char')
+
+def latLon(record):
+    # Float coordinates from the "lat,lon" coordinates text
+    try:
+        lat, lon = str(record.get('coordinates') or '').strip('()[] ').split(',')
+        return float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None, None
+
+def cell(value):
+    return '' if value is None else str(value)
+
+
+class ToponymMemo(object):
+    """
+    Usage example:
+
+    memo = ToponymMemo(outDir + '/toponyms_spacy-lg_2023.csv')
+    ids = [memo.resolve('spacy-lg', row) for row in rjson]
+    memo.flush()   # before writing rows that use the ids
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = {}
+        self.pending = []
+        self.hits = 0
+        if path and os.path.isfile(path):
+            with open(path, newline='', encoding='utf-8') as f:
+                for record in csv.DictReader(f):
+                    self.ids[self.key(record)] = int(record['toponym_id'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def key(self, record):
+        return (record['parser'], record['name']) + tuple(cell(record.get(field)) for r, field in resolutionFields)
+
+    def resolve(self, parser, row):
+        # The id for a response row's toponym, made up if it's new
+        row = flatRow(row)
+        record = {'parser': parser, 'name': normalizeName(surface(row)), 'text': surface(row)}
+        for rowField, field in resolutionFields:
+            if row.get(rowField) is not None: record[field] = row[rowField]
+        if row.get('geo.lat') is not None:
+            record['coordinates'] = cell(row['geo.lat']) + ',' + cell(row.get('geo.lon'))
+        return self.add(record)
+
+    def add(self, record):
+        # The id for a toponym record (as resolve() makes, or read back from a memo file)
+        key = self.key(record)
+        if key in self.ids:
+            self.hits += 1
+            return self.ids[key]
+        toponymId = len(self.ids) + 1
+        self.ids[key] = toponymId
+        record = dict(record, toponym_id=toponymId)
+        if record.get('lat') in (None, ''): record['lat'], record['lon'] = latLon(record)
+        self.pending.append(record)
+        return toponymId
+
+    def mentions(self, parser, rjson):
+        # (toponym_id, start_char, end_char) for each row of a response
+        return [(self.resolve(parser, row),) + offsets(row) for row in rjson]
+
+    def flush(self):
+        # Append the toponyms made up since the last flush to the memo file
+        if not self.path or not self.pending: return
+        lines = [] if os.path.isfile(self.path) and os.path.getsize(self.path) else [csvLine(toponymFields)]
+        lines += [csvLine([cell(record.get(field)) for field in toponymFields]) for record in self.pending]
+        appendDurably(self.path, "".join(lines).encode('utf-8'))
+        self.pending = []
@@ -0,0 +1,278 @@
+#####################################################################################
+## jmapWriter.py
+## Output for the locations table: the rows built from each geoparser response
+## (articleFrame), and the columnar (Parquet or Arrow IPC) version of them.
+##
+## Every parser's rows are converted to one typed schema: coordinates become
+## float lat/lon columns (from mordecai's geo.lat/geo.lon or the other
+## parsers' "lat,lon" text), score is a float, and mordecai's word/spans map
+## onto text/start_char/end_char. Rows are buffered and written out a batch
+## at a time, each batch as its own complete part file in a dataset
+## directory (locations_<parser>_2023.parquet/part-*.parquet), so a crash
+## never leaves a half-written file behind and later runs just add parts.
+##
+## External Dependencies
+##     Pandas
+##     pyarrow
+#####################################################################################
+
+import os, ast, glob, time
+
+import numpy as np
+import pandas as pd
+
+from jmapEval import coordinateColumns
+from jmapToponyms import flatRow
+
+# Locations columns: the article/section fields, then the fields each parser returns.
+# section is the deepest section holding the text, section_path its titles from the top down.
+articleFields = ['pandas.index','filename','doi','title','level','section','section_path','nchar','status','parser']
+responseFields = {
+    'spacy-lg':  ['coordinates','end_char','score','start_char','text','type'],
+    'spacy-trf': ['coordinates','end_char','score','start_char','text','type'],
+    'stanza':    ['coordinates','end_char','score','start_char','text','type'],
+    'nltk':      ['coordinates','score','text','type'],
+    'gazetteer': ['coordinates','end_char','score','start_char','text','type'],
+    'mordecai':  ['country_conf','country_predicted','geo.admin1',
+                  'geo.country_code3', 'geo.feature_class', 'geo.feature_code',
+                  'geo.geonameid', 'geo.lat', 'geo.lon', 'geo.place_name','spans','word'],
+}
+
+
+def locationsHeader(parsers):
+    # Union of the response fields for these parsers, in first-seen order
+    header = list(articleFields)
+    for p in parsers:
+        for field in responseFields[p]:
+            if field not in header: header.append(field)
+    return header
+
+def articleFrame(sections, responses, name, article, parser, header):
+    # Build the locations rows for all of an article's sections at once, lined up with
+    # header. responses holds one list of rows (dicts) per section: a geoparser response,
+    # whose nested dicts are flattened as pd.json_normalize(max_level=1) would, or
+    # ToponymMemo mentions as dicts of mentionFields. Each row's position in its
+    # section's list becomes the pandas.index column; an empty section gets one row
+    # with status False.
+    rows, index = [], []
+    for (level, section, path, text), response in zip(sections, responses):
+        fields = {'filename': name, 'doi': article.doi, 'title': article.title, 'level': level, 'section': section,
+                  'section_path': path, 'nchar': len(text), 'parser': parser}
+        if len(response) > 0:
+            rows += [dict(flatRow(row), status="True", **fields) for row in response]
+            index += range(len(response))
+        else:
+            rows.append(dict(fields, status="False"))
+            index.append(0)
+    return pd.DataFrame(rows, index=index).reindex(header[1:], axis=1)
+
+
+# The typed locations schema: (column, Arrow type)
+locationsSchema = [
+    ('row', 'int32'),           # position of the location in its section's response
+    ('filename', 'string'),
+    ('doi', 'string'),
+    ('title', 'string'),
+    ('level', 'string'),
+    ('section', 'string'),
+    ('section_path', 'string'),
+    ('nchar', 'int32'),
+    ('status', 'bool'),
+    ('parser', 'string'),
+    ('text', 'string'),
+    ('start_char', 'int32'),
+    ('end_char', 'int32'),
+    ('lat', 'float64'),
+    ('lon', 'float64'),
+    ('score', 'float64'),
+    ('type', 'string'),
+    ('place_name', 'string'),
+    ('feature_class', 'string'),
+    ('feature_code', 'string'),
+    ('geonameid', 'string'),
+    ('admin1', 'string'),
+    ('country_code3', 'string'),
+    ('country_predicted', 'string'),
+    ('country_conf', 'float64'),
+]
+
+extensions = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def arrowSchema():
+    import pyarrow as pa
+    return pa.schema([(name, pa.type_for_alias(t)) for name, t in locationsSchema])
+
+def column(df, name):
+    # A column of df, or an all-missing one if this parser doesn't return it
+    return df[name] if name in df else pd.Series(np.nan, index=df.index, dtype=object)
+
+def firstSpan(spans, key):
+    # mordecai gives [{'start': s, 'end': e}, ...] per mention; read back from a
+    # locations CSV file, that is the text of the list
+    if isinstance(spans, str):
+        try: spans = ast.literal_eval(spans)
+        except (ValueError, SyntaxError): return None
+    if isinstance(spans, list) and spans and isinstance(spans[0], dict): return spans[0].get(key)
+    return None
+
+def typedLocations(df):
+    """
+    Convert rows as built by the parse script (the locations CSV columns,
+    pandas.index as the index) to the typed schema.
+    """
+    isMordecai = column(df, 'parser').astype(str).str.contains('mordecai')
+    lat, lon = coordinateColumns(df)
+    spans = column(df, 'spans')
+    num = lambda s: pd.to_numeric(s, errors='coerce')
+    text = lambda s: s.astype(object).where(s.notnull(), None).map(lambda v: v if v is None else str(v))
+
+    out = pd.DataFrame({
+        'row': np.asarray(df.index, dtype='int32'),
+        'filename': text(column(df, 'filename')).values,
+        'doi': text(column(df, 'doi')).values,
+        'title': text(column(df, 'title')).values,
+        'level': text(column(df, 'level')).values,
+        'section': text(column(df, 'section')).values,
+        'section_path': text(column(df, 'section_path')).values,
+        'nchar': num(column(df, 'nchar')).astype('Int32').values,
+        'status': column(df, 'status').astype(str).eq('True').values,
+        'parser': text(column(df, 'parser')).values,
+        'text': text(column(df, 'text').where(~isMordecai, column(df, 'word'))).values,
+        'start_char': num(column(df, 'start_char').where(~isMordecai, spans.map(lambda s: firstSpan(s, 'start')))).astype('Int32').values,
+        'end_char': num(column(df, 'end_char').where(~isMordecai, spans.map(lambda s: firstSpan(s, 'end')))).astype('Int32').values,
+        'lat': lat.astype(float).values,
+        'lon': lon.astype(float).values,
+        'score': num(column(df, 'score')).astype(float).values,
+        'type': text(column(df, 'type')).values,
+        'place_name': text(column(df, 'geo.place_name')).values,
+        'feature_class': text(column(df, 'geo.feature_class')).values,
+        'feature_code': text(column(df, 'geo.feature_code')).values,
+        'geonameid': text(column(df, 'geo.geonameid')).values,
+        'admin1': text(column(df, 'geo.admin1')).values,
+        'country_code3': text(column(df, 'geo.country_code3')).values,
+        'country_predicted': text(column(df, 'country_predicted')).values,
+        'country_conf': num(column(df, 'country_conf')).astype(float).values,
+    })
+    return out
+
+
+def writePart(table, path, fmt):
+    # Write a whole part file under a temporary name, then move it into place
+    tmpFile = path + '.tmp'
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmpFile)
+    else:
+        import pyarrow as pa
+        with pa.OSFile(tmpFile, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    os.replace(tmpFile, path)
+
+def readPart(path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if path.endswith('.parquet'): return pq.read_table(path)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+def parts(dataset):
+    return sorted(glob.glob(os.path.join(dataset, 'part-*.parquet')) + glob.glob(os.path.join(dataset, 'part-*.arrow')))
+
+
+class LocationsWriter(object):
+    """
+    Buffered writer for one locations dataset directory.
+
+    add() takes the rows for one article and parser, plus a tag for them, and
+    returns the tags of every article whose rows have now been written to
+    disk (empty until a batch fills). close() writes whatever is left and
+    returns the remaining tags.
+    """
+    def __init__(self, dataset, fmt='parquet', batchRows=50000):
+        if fmt not in extensions:
+            raise ValueError("Unknown locations format: " + fmt)
+        self.dataset = dataset
+        self.fmt = fmt
+        self.batchRows = batchRows
+        self.schema = arrowSchema()
+        self.stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.seq = 0
+        self.buffer = []
+        self.tags = []
+        self.nrows = 0
+        os.makedirs(dataset, exist_ok=True)
+
+    def add(self, df, tag=None):
+        self.buffer.append(typedLocations(df))
+        self.nrows += len(df)
+        if tag is not None: self.tags.append(tag)
+        if self.nrows >= self.batchRows:
+            return self.flush()
+        return []
+
+    def flush(self):
+        import pyarrow as pa
+        if self.buffer:
+            table = pa.Table.from_pandas(pd.concat(self.buffer, ignore_index=True), schema=self.schema, preserve_index=False)
+            partFile = os.path.join(self.dataset, 'part-' + self.stamp + '-' + '%05d' % self.seq + extensions[self.fmt])
+            writePart(table, partFile, self.fmt)
+            self.seq += 1
+        tags = self.tags
+        self.buffer, self.tags, self.nrows = [], [], 0
+        return tags
+
+    def close(self):
+        return self.flush()
+
+
+def readLocations(path, columns=None):
+    """
+    Load a locations table: a typed dataset directory written by
+    LocationsWriter, or one of the locations CSV files.
+    """
+    if os.path.isdir(path):
+        import pyarrow as pa
+        tables = [readPart(p) for p in parts(path)]
+        if not tables: return pd.DataFrame(columns=[name for name, t in locationsSchema])
+        table = pa.concat_tables(tables)
+        if columns: table = table.select(columns)
+        return table.to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def locationChunks(path, columns=None, chunkRows=100000, dtype=None):
+    """
+    A locations table (as readLocations() takes) a piece at a time: CSV in
+    chunks of chunkRows rows, a dataset one part file at a time. Only the
+    given columns the table has are read.
+    """
+    if os.path.isdir(path):
+        for partFile in parts(path):
+            table = readPart(partFile)
+            if columns: table = table.select([c for c in columns if c in table.column_names])
+            yield table.to_pandas()
+        return
+    keep = (lambda c: c in columns) if columns else None
+    for chunk in pd.read_csv(path, usecols=keep, dtype=dtype, chunksize=chunkRows):
+        yield chunk
+
+
+def purgeParts(dataset, dois, parser=None):
+    # Rewrite the part files without the rows for dois (from parser, if given)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    dropped = 0
+    for partFile in parts(dataset):
+        table = readPart(partFile)
+        drop = pc.is_in(table['doi'], value_set=pa.array(sorted(dois), pa.string()))
+        if parser: drop = pc.and_(drop, pc.equal(table['parser'], parser))
+        n = pc.sum(drop).as_py() or 0
+        if not n: continue
+        dropped += n
+        if n == len(table):
+            os.remove(partFile)
+        else:
+            writePart(table.filter(pc.invert(drop)), partFile, 'parquet' if partFile.endswith('.parquet') else 'arrow')
+    return dropped